@@ -3,7 +3,8 @@ Created Mar 15, 2022
 
 @author: Wang Liao, z5306312
 
-Usage: python3 client.py [port]
+Usage: python3 client.py [port] [--window N] [--chunk-size BYTES] [--streams N] [--digest crc32|blake2b|sha256]
+                         [--compress zlib|lzma|bz2|none] [--cache-size BYTES]
 
 Python 3.9.7
 '''
@@ -17,6 +18,15 @@ import os
 import sys
 import json
 import time
+import struct
+import threading
+import random
+import hashlib
+import zlib
+import lzma
+import bz2
+import shutil
+from collections import OrderedDict
 from socket import *
 from _thread import *
 
@@ -26,10 +36,88 @@ from _thread import *
 #                                                                                                                      #
 ########################################################################################################################
 PORT = None
-commands = ['CRT', 'LST', 'MSG', 'DLT', 'RDT', 'EDT', 'UPD', 'DWN', 'RMV', 'XIT']
+USAGE = '''Usage: python3 client.py [port] [--window N] [--chunk-size BYTES] [--streams N] [--digest crc32|blake2b|sha256]
+                         [--compress zlib|lzma|bz2|none] [--cache-size BYTES]'''
+options = {
+    'window': 1, # requests in flight at once, 1 waits for every response before the next command
+    'chunk-size': 1 << 18, # bytes of an uploaded file read and sent at once
+    'streams': 1, # TCP connections a file is downloaded with, each receives a byte range of the file
+    'digest': 'crc32', # algorithm of the chunk digests of an uploaded file
+    'compress': 'zlib', # compression of the large messages and the file transfers, none to disable
+    'cache-size': 256 << 20, # bytes of downloaded files kept to skip their repeated downloads, 0 to disable
+}
+commands = ['CRT', 'LST', 'MSG', 'DLT', 'RDT', 'EDT', 'UPD', 'DWN', 'RMV', 'XIT', 'SUB', 'UNSUB', 'SRC']
 user_info = {}
 user_info['username'] = ''
-user_info['password'] = ''
+user_info['session_id'] = 0
+user_info['codec'] = 'json'
+user_info['compression'] = None
+user_info['ordered'] = False
+last_request_id = random.randrange(1 << 30) # a restarted client does not reuse the ids of its replies cached by the server
+INITIAL_RTO = 1 # seconds before the first retransmission while no round trip was measured
+MIN_RTO = 0.2
+MAX_RTO = 5
+RTO_JITTER = 0.25 # share of the timeout added at random, so clients do not retransmit in lockstep
+MAX_RETRANSMISSIONS = 5
+MAX_DATAGRAM = 65535
+FRAGMENT_SIZE = 1024 # bytes of payload per fragment, larger messages are split
+FRAGMENT_MAGIC = b'FRG'
+FRAGMENT_HEADER = struct.Struct('!3sIHH') # magic, message id, fragment index, fragment count
+REASSEMBLY_LIMIT = 64 << 20 # bytes of incomplete responses buffered at most
+REASSEMBLY_TIMEOUT = 10 # seconds before the fragments of an incomplete response are dropped
+NACK_TIMEOUT = 0.2 # seconds without fragments before the missing ones are requested
+NACK_LIMIT = 256 # fragment indexes per NACK
+RANGE_HEADER = struct.Struct('!QQ') # offset and length of the bytes of a file, sent before them
+TRANSFER_ID_DIGITS = 32 # hex digits of a transfer id, it names the partial file of a transfer
+TRANSFER_ATTEMPTS = 3 # times an interrupted transfer is resumed before giving up
+TCP_TIMEOUT = 10 # seconds without progress before a transfer counts as interrupted
+DIGEST_CHUNK = 4 << 20 # bytes of a file covered by one chunk digest, a corrupted chunk is sent again on its own
+DIGEST_ALGORITHMS = ['crc32', 'blake2b', 'sha256']
+COMPRESSIONS = { # name -> (compress, decompressor factory)
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompressobj), # the fastest level keeps up with the link
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor),
+    'bz2': (bz2.compress, bz2.BZ2Decompressor),
+}
+COMPRESSION_NAMES = [None, 'zlib', 'lzma', 'bz2'] # 0 is no compression
+COMPRESSION_CODES = {name: code for code, name in enumerate(COMPRESSION_NAMES) if name is not None}
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+COMPRESSED_MAGIC = 0xC5 # first byte of a compressed message
+COMPRESSED_HEADER = struct.Struct('!BBII') # magic, compression code, request id, size of the message before compression
+COMPRESSION_THRESHOLD = FRAGMENT_SIZE # bytes of a message above which it is compressed, smaller ones fit in one datagram
+COMPRESSION_FRAME = 1 << 18 # bytes of a file compressed at once in a compressed range
+FRAME_HEADER = struct.Struct('!II') # size of a frame before and after compression, equal if it is sent as it is
+COMPRESSION_SAMPLE = 1 << 16 # bytes compressed at the start, the middle and the end of a file to estimate its ratio
+COMPRESSIBLE_RATIO = 0.9 # a file whose samples compress worse than this is sent as it is
+CODECS = ['binary', 'json'] # in the order of preference
+BINARY_MAGIC = 0xB1 # first byte of a binary message, a json message starts with '{'
+BINARY_HEADER = struct.Struct('!BBIQ') # magic, command code, request id, session id
+VALUE_HEADER = struct.Struct('!BI') # type, length
+HEADER_FIELDS = ['command', 'request_id', 'session_id']
+TYPE_NONE, TYPE_BOOL, TYPE_INT, TYPE_FLOAT, TYPE_STR, TYPE_LIST, TYPE_DICT = range(7)
+COMMAND_NAMES = [None, 'AUTH', 'CRT', 'LST', 'MSG', 'DLT', 'RDT', 'EDT', 'UPD', 'DWN', 'RMV', 'XIT', 'NACK',
+                 'SUB', 'UNSUB', 'SRC'] # 0 is a response
+COMMAND_CODES = {name: code for code, name in enumerate(COMMAND_NAMES) if name is not None}
+FIELD_NAMES = [None, 'username', 'password', 'thread_title', 'message', 'message_id', 'file_name', 'file_size',
+               'status', 'type', 'threads', 'messages', 'since_id', 'version', 'limit', 'next_cursor', 'more',
+               'reset', 'retry_after', 'step', 'codecs', 'codec', 'missing', 'token', 'transfer_id',
+               'offset', 'streams', 'tokens', 'digest_algorithm', 'digests', 'ranges',
+               'content_hash', 'compressions', 'compression', 'event_port', 'events', 'query', 'author',
+               'results', 'total', 'truncated', 'ordered'] # 0 is a field carrying its own name
+FIELD_CODES = {name: code for code, name in enumerate(FIELD_NAMES) if name is not None}
+last_message_id = 0
+reassembler = None # fragments of incomplete responses
+rtt = None # round trip times to the server
+PAGE_SIZE = 200 # records per RDT request
+SEARCH_PAGE = 10 # results per SRC request
+SEARCH_FILTERS = ['thread', 'user', 'page'] # SRC terms like thread:title that are not searched for
+read_cache = {} # thread title -> {'cursor', 'version', 'messages'} of what RDT has already read
+PIPELINED_COMMANDS = ['MSG', 'EDT', 'DLT'] # commands sent without waiting for the earlier responses
+pipeline = None # requests in flight when the window is larger than 1
+download_cache = None # copies of the downloaded files
+event_socket = None # receives the events of the subscribed threads, opened by the first SUB
+CACHE_DIR = '.download_cache'
+CACHE_INDEX = 'index.json' # (server, thread title, file name) -> hash of the cached copy, and the copies in LRU order
+HASH_DIGITS = 64 # hex digits of a SHA-256
 
 ########################################################################################################################
 #                                                                                                                      #
@@ -40,8 +128,8 @@ def port_checker():
     '''
     Check if the port is valid.
     '''
-    if len(sys.argv) != 2:
-        print('Usage: python3 client.py [port]')
+    if len(sys.argv) < 2:
+        print(USAGE)
         sys.exit()
 
     port = int(sys.argv[1])
@@ -51,6 +139,32 @@ def port_checker():
     
     return port
 
+def option_parser():
+    '''
+    Parse the optional switches given after the port, e.g. --window 32.
+    '''
+    args = sys.argv[2:]
+    if len(args) % 2 != 0:
+        print(USAGE)
+        sys.exit()
+
+    for name, value in zip(args[::2], args[1::2]):
+        if not name.startswith('--') or name[2:] not in options:
+            print(USAGE)
+            sys.exit()
+
+        # the value takes the type of the default, e.g. --window 32 becomes an int
+        try:
+            options[name[2:]] = type(options[name[2:]])(value)
+        except ValueError:
+            print(USAGE)
+            sys.exit()
+
+    if options['window'] < 1 or options['chunk-size'] < 1 or options['streams'] < 1 or options['cache-size'] < 0 or options['digest'] not in DIGEST_ALGORITHMS or \
+            options['compress'] not in list(COMPRESSIONS) + ['none']:
+        print(USAGE)
+        sys.exit()
+
 def command_error_checker(input_commands):
     '''
     Check if the command is valid.
@@ -64,12 +178,15 @@ def command_error_checker(input_commands):
     elif command == 'LST' and len_command != 1:
         print('Incorrect syntax for {}'.format(command))
         return True
-    elif command in ['CRT','RDT', 'RMV'] and len_command != 2:
+    elif command in ['CRT','RDT', 'RMV', 'SUB', 'UNSUB'] and len_command != 2:
         print('Incorrect syntax for {}'.format(command))
         return True
     elif command == 'DLT' and len_command != 3:
         print('Incorrect syntax for {}'.format(command))
         return True
+    elif command == 'SRC' and len_command < 2:
+        print('Incorrect syntax for {}'.format(command))
+        return True
     elif command in ['MSG', 'UPD', 'DWN'] and len_command < 3:
         print('Incorrect syntax for {}'.format(command))
         return True
@@ -106,76 +223,931 @@ def command_executer(input_commands, udp_s):
         REMOVE_THREAD(input_commands, udp_s)
     elif command == 'XIT':
         EXIT_USER(input_commands, udp_s)
+    elif command == 'SUB':
+        SUBSCRIBE_THREAD(input_commands, udp_s)
+    elif command == 'UNSUB':
+        UNSUBSCRIBE_THREAD(input_commands, udp_s)
+    elif command == 'SRC':
+        SEARCH_MESSAGES(input_commands, udp_s)
 
 def client_startup(port):
     '''
     Start the client.
     '''
+    global pipeline
     # create a UDP socket
     udp_socket = socket(AF_INET, SOCK_DGRAM)
     udp_socket.settimeout(5)
 
     AUTH_USER(udp_socket)
+    # the thread and asyncio engines run the requests of a client concurrently, the posts would commit out of order
+    if options['window'] > 1 and user_info['ordered']:
+        pipeline = Pipeline(udp_socket, options['window'])
+    elif options['window'] > 1:
+        print('The server does not run requests in order, --window is ignored')
     
     is_error = False
     while True:
-        input_commands = input('Enter one of the following commands: CRT, MSG, DLT, EDT, LST, RDT, UPD, DWN, RMV, XIT:').strip()
+        try:
+            input_commands = input('Enter one of the following commands: CRT, MSG, DLT, EDT, LST, RDT, UPD, DWN, RMV, SUB, UNSUB, SRC, XIT:').strip()
+        except EOFError: # the end of a script
+            break
         is_error = command_error_checker(input_commands)
         if is_error: # if the command has error, re-enter the command
             continue
+
+        # the other commands wait for the requests in flight, e.g. RDT shows the messages posted before it
+        if pipeline is not None and input_commands.split()[0] not in PIPELINED_COMMANDS:
+            pipeline.flush()
         command_executer(input_commands, udp_socket)
 
+    if pipeline is not None:
+        pipeline.flush()
     udp_socket.close()
 
-def udp_send_request(client_udp_socket, request):
+def event_startup():
+    '''
+    Open the socket the server pushes the events of the subscribed threads to, and return its port.
+    The events are received and printed alongside the prompt.
+    '''
+    global event_socket
+    if event_socket is None:
+        event_socket = socket(AF_INET, SOCK_DGRAM)
+        event_socket.bind(('', 0))
+        listener = threading.Thread(target=event_listener, args=(event_socket,))
+        listener.daemon = True # the client can exit while the listener waits for events
+        listener.start()
+    return event_socket.getsockname()[1]
+
+def event_listener(event_soc):
     '''
-    send the request to the server and get the response.
+    Print the events pushed by the server, each push carries the events of a burst.
+    '''
+    event_reassembler = Reassembler(REASSEMBLY_LIMIT, REASSEMBLY_TIMEOUT) # apart from the fragments of the responses
+    while True:
+        raw, server_address = event_soc.recvfrom(MAX_DATAGRAM)
+        try:
+            # a large push comes in fragments, the missing ones are not asked for since pushes are not retransmitted
+            if raw[:len(FRAGMENT_MAGIC)] == FRAGMENT_MAGIC:
+                raw = event_reassembler.add(raw)
+                if raw is None:
+                    continue
+            raw, request_id = decompress_message(raw, REASSEMBLY_LIMIT)
+            push = decode_message(raw) if raw is not None else None
+        except (ValueError, IndexError, struct.error):
+            push = None
+        if push is None or push.get('status') != 'PUSH':
+            continue
+
+        for event_type, thread_title, msg_id, username, message in push['events']:
+            if event_type == 'MSG':
+                print('\nNew message in Thread {}: {} {}: {}'.format(thread_title, msg_id, username, message))
+            elif event_type == 'EDT':
+                print('\nMessage {} in Thread {} edited by {}: {}'.format(msg_id, thread_title, username, message))
+            elif event_type == 'DLT':
+                print('\nMessage {} in Thread {} deleted by {}'.format(msg_id, thread_title, username))
+            elif event_type == 'RMV':
+                print('\nThread {} removed by {}'.format(thread_title, username))
+
+def udp_send_request(client_udp_socket, request, interim=None):
+    '''
+    send the request to the server and get the response, None if the server did not answer.
+    Responses with the interim status are skipped, as udp_receive_response does.
     '''
     global PORT
-    con_trails = 0
-    client_udp_socket.sendto(json.dumps(request).encode('utf-8'), ('', PORT))
+    global last_request_id
+
+    # follow-ups reuse the id of the request they answer, new requests get the next one
+    if 'request_id' not in request:
+        last_request_id += 1
+        request['request_id'] = last_request_id
+    udp_send_payload(client_udp_socket, udp_encode(request))
     # print('Sent request {} to server'.format(request))  
 
+    return udp_receive_response(client_udp_socket, request, interim)
+
+def udp_receive_response(client_udp_socket, request, interim=None):
+    '''
+    get the response of the request from the server, None once the retransmissions are exhausted.
+    The request is retransmitted with exponential backoff and jitter until the response arrives,
+    the server replays its reply instead of running the request twice. Responses with the
+    interim status are skipped, e.g. to wait for the final response of UPD.
+    '''
+    global PORT
+    con_trails = 0
+    rto = rtt.timeout()
+    sent = time.time()
+    deadline = sent + rto
+
     while 1:
         try:
-            con_trails = 0
-            response, server_address = client_udp_socket.recvfrom(1024)
-            response = json.loads(response.decode('utf-8'))
+            response = udp_receive_datagram(client_udp_socket, deadline - time.time())
+            # a fragment of the response, or a late reply of an earlier request
+            if response is None or response.get('request_id') != request['request_id']:
+                continue
             # print('Received response {} from server'.format(response))
+
+            # the server queues are full, send the request again once it asks to
+            if response['status'] == 'BUSY':
+                print('Server busy, retrying in {} seconds'.format(response['retry_after']))
+                time.sleep(response['retry_after'])
+                udp_send_payload(client_udp_socket, udp_encode(request))
+                sent = time.time()
+                deadline = sent + rto
+                continue
+
+            # the server does not know the session, e.g. it restarted since the login
+            if response['status'] == 'NO_SESSION':
+                print('Session expired, please log in again')
+                sys.exit()
+            if response['status'] == interim:
+                continue
+
+            # only the round trips of requests sent once are measured (Karn's algorithm)
+            if con_trails == 0 and interim is None:
+                rtt.sample(time.time() - sent)
             return response
         except timeout:
             print('No response from server')
             con_trails += 1
-            if con_trails < 3:
+            if con_trails <= MAX_RETRANSMISSIONS:
                 print('Retransmitting...')
+                rto = min(rto * 2, MAX_RTO)
+                udp_send_payload(client_udp_socket, udp_encode(request))
+                deadline = time.time() + rto * random.uniform(1, 1 + RTO_JITTER)
                 continue
             else:
                 print('Connection failed')
                 break
 
-def udp_receive_response(client_udp_socket):
+def udp_submit_request(client_udp_socket, request, handler):
     '''
-    get the response from the server.
+    Send the request and hand the request and its response to the handler, through the pipeline
+    if the client has one, otherwise once the response arrived.
     '''
-    global PORT
-    con_trails = 0
-    while 1:
-        # print('Waiting for response...')
-        try:
-            con_trails = 0
-            response, server_address = client_udp_socket.recvfrom(1024)
-            response = json.loads(response.decode('utf-8'))
-            # print('Received response {} from server'.format(response))
-            return response
-        except timeout:
-            print('No response from server')
-            con_trails += 1
-            if con_trails < 3:
-                print('Retransmitting...')
+    if pipeline is None:
+        response = udp_send_request(client_udp_socket, request)
+        if response is not None:
+            handler(request, response)
+    else:
+        pipeline.submit(request, handler)
+
+class Pipeline:
+    '''
+    Requests sent without waiting for the responses of the earlier ones, at most window of them in flight.
+    The responses may arrive in any order, they are matched to their requests by request id and
+    handed to the handlers in the order of the requests. The window halves when the server is busy
+    and grows back by one request per window of responses.
+    '''
+    def __init__(self, udp_socket, window):
+        self.udp_socket = udp_socket
+        self.limit = window
+        self.window = window
+        self.flights = OrderedDict() # request id -> request in flight, in the order they were submitted
+
+    def submit(self, request, handler):
+        '''
+        Send the request once the window has room for it and no request waits to be sent again after BUSY.
+        '''
+        global last_request_id
+        while len(self.flights) >= int(self.window) or any([flight['busy'] for flight in self.flights.values()]):
+            self.poll()
+
+        last_request_id += 1
+        request['request_id'] = last_request_id
+        flight = {
+            'request': request,
+            'handler': handler,
+            'response': None, # False once the request is given up
+            'rto': rtt.timeout(),
+            'retransmissions': 0,
+            'busy': False,
+        }
+        self.flights[last_request_id] = flight
+        self.send(flight, flight['rto'])
+
+    def flush(self):
+        '''
+        Wait for the responses of all the requests in flight.
+        '''
+        while self.flights:
+            self.poll()
+
+    def send(self, flight, wait):
+        '''
+        Send the request and wait at most wait seconds for its response.
+        '''
+        udp_send_payload(self.udp_socket, udp_encode(flight['request']))
+        flight['sent'] = time.time()
+        flight['deadline'] = flight['sent'] + wait
+
+    def poll(self):
+        '''
+        Wait for the next datagram or timeout, then hand the responses at the head of the window to their handlers.
+        '''
+        waiting = [flight for flight in self.flights.values() if flight['response'] is None]
+        if waiting:
+            try:
+                response = udp_receive_datagram(self.udp_socket, min([flight['deadline'] for flight in waiting]) - time.time())
+                if response is not None:
+                    self.receive(response)
+            except timeout:
+                pass
+            self.retransmit()
+
+        # a response waits for the responses of the requests sent before it
+        while self.flights:
+            request_id, flight = next(iter(self.flights.items()))
+            if flight['response'] is None:
+                break
+            del self.flights[request_id]
+            if flight['response'] is not False:
+                flight['handler'](flight['request'], flight['response'])
+
+    def receive(self, response):
+        '''
+        Match the response to its request.
+        '''
+        flight = self.flights.get(response.get('request_id'))
+        # a response of a request that is no longer in flight, or a replay of one already received
+        if flight is None or flight['response'] is not None:
+            return
+
+        # the server queues are full, send the request again once it asks to; the requests after
+        # the first one answered BUSY are answered BUSY too, the window halves once for them all
+        if response['status'] == 'BUSY':
+            if not any([other['busy'] for other in self.flights.values() if other is not flight]):
+                self.window = max(1, self.window / 2)
+            flight['busy'] = True
+            flight['deadline'] = time.time() + response['retry_after']
+            return
+
+        # the server does not know the session, e.g. it restarted since the login
+        if response['status'] == 'NO_SESSION':
+            print('Session expired, please log in again')
+            sys.exit()
+
+        # only the round trips of requests sent once are measured (Karn's algorithm)
+        if flight['retransmissions'] == 0:
+            rtt.sample(time.time() - flight['sent'])
+        flight['response'] = response
+        self.window = min(self.limit, self.window + 1 / self.window)
+
+    def retransmit(self):
+        '''
+        Send the requests whose timeout expired again, with exponential backoff and jitter.
+        The requests answered BUSY are sent again in order, none before an earlier one.
+        '''
+        now = time.time()
+        held = None # when the earliest request answered BUSY is sent again
+        for flight in self.flights.values():
+            if flight['busy'] and held is not None:
+                flight['deadline'] = max(flight['deadline'], held)
                 continue
-            else:
+            if flight['busy'] and flight['deadline'] > now:
+                held = flight['deadline']
+                continue
+            if flight['response'] is not None or flight['deadline'] > now:
+                continue
+            if flight['busy']:
+                flight['busy'] = False
+                self.send(flight, flight['rto'])
+                continue
+
+            flight['retransmissions'] += 1
+            if flight['retransmissions'] > MAX_RETRANSMISSIONS:
                 print('Connection failed')
+                flight['response'] = False
+                continue
+            flight['rto'] = min(flight['rto'] * 2, MAX_RTO)
+            self.send(flight, flight['rto'] * random.uniform(1, 1 + RTO_JITTER))
+
+class RttEstimator:
+    '''
+    Smoothed round trip time and its variation (RFC 6298), they set the retransmission timeout.
+    '''
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        '''
+        Update the estimate with the round trip time of a request.
+        '''
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        '''
+        Seconds to wait for a response before retransmitting the request.
+        '''
+        if self.srtt is None:
+            return INITIAL_RTO
+        return min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+def udp_send_payload(client_udp_socket, payload):
+    '''
+    Send the payload in one datagram, or split it into numbered fragments if it is too large.
+    '''
+    global PORT
+    global last_message_id
+    if len(payload) <= FRAGMENT_SIZE:
+        client_udp_socket.sendto(payload, ('', PORT))
+        return
+
+    last_message_id += 1
+    total = (len(payload) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+    for index in range(total):
+        fragment = payload[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+        client_udp_socket.sendto(FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, last_message_id, index, total) + fragment, ('', PORT))
+
+def udp_receive_datagram(client_udp_socket, wait):
+    '''
+    Receive one datagram of the server within wait seconds, None while it is a fragment of an
+    incomplete response. While a response is incomplete, the fragments that stop arriving are
+    requested again.
+    '''
+    global PORT
+    client_udp_socket.settimeout(NACK_TIMEOUT if reassembler.messages else max(wait, 0.001))
+    try:
+        response, server_address = client_udp_socket.recvfrom(MAX_DATAGRAM)
+    except timeout:
+        if not reassembler.messages:
+            raise
+        # ask for the missing fragments instead of waiting for the whole response again
+        for message_id, missing in reassembler.missing():
+            nack = {
+                'command': 'NACK',
+                'username': user_info['username'],
+                'message_id': message_id,
+                'missing': missing[:NACK_LIMIT]
+            }
+            client_udp_socket.sendto(udp_encode(nack), ('', PORT))
+        return None
+
+    if response[:len(FRAGMENT_MAGIC)] == FRAGMENT_MAGIC:
+        response = reassembler.add(response)
+        if response is None:
+            return None
+    response, request_id = decompress_message(response, REASSEMBLY_LIMIT)
+    if response is None:
+        print('Dropped a compressed response that does not decompress')
+        return None
+    response = decode_message(response)
+    if request_id != 0: # the request id of a compressed message is in its header
+        response['request_id'] = request_id
+    return response
+
+def tcp_send_range(tcp_soc, f, start, end, compression=None):
+    '''
+    Send the offset and length and then the [start, end) bytes of the file through one buffer of chunk-size bytes,
+    or in compressed frames if the transfer has a compression.
+    '''
+    tcp_soc.sendall(RANGE_HEADER.pack(start, end - start))
+    if compression is not None:
+        tcp_send_frames(tcp_soc, f, start, end - start, compression)
+        return
+    buffer = bytearray(options['chunk-size'])
+    view = memoryview(buffer)
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        size = f.readinto(view[:min(remaining, len(buffer))])
+        if not size:
+            break
+        tcp_soc.sendall(view[:size])
+        remaining -= size
+
+def tcp_send_frames(tcp_soc, f, offset, count, compression):
+    '''
+    Send count bytes of the file from the offset on in frames of compressed bytes, each after its size
+    before and after compression. A frame that does not shrink is sent as it is.
+    '''
+    compress = COMPRESSIONS[compression][0]
+    f.seek(offset)
+    remaining = count
+    while remaining > 0:
+        data = f.read(min(remaining, COMPRESSION_FRAME))
+        if not data:
+            break
+        frame = compress(data)
+        if len(frame) >= len(data):
+            frame = data
+        tcp_soc.sendall(FRAME_HEADER.pack(len(data), len(frame)))
+        tcp_soc.sendall(frame)
+        remaining -= len(data)
+
+def tcp_receive_exact(tcp_soc, size):
+    '''
+    Receive exactly size bytes, None if the connection closes before.
+    '''
+    data = b''
+    while len(data) < size:
+        chunk = tcp_soc.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def tcp_receive_frame(tcp_soc, compression, limit):
+    '''
+    Receive one frame of a compressed range and return its bytes, None if the connection closes
+    or the frame is larger than limit or does not decompress to its size.
+    '''
+    header = tcp_receive_exact(tcp_soc, FRAME_HEADER.size)
+    if header is None:
+        return None
+    size, sent = FRAME_HEADER.unpack(header)
+    if size == 0 or size > min(limit, COMPRESSION_FRAME) or sent > size:
+        return None
+    frame = tcp_receive_exact(tcp_soc, sent)
+    if frame is None or sent == size:
+        return frame
+    return decompress(frame, compression, size)
+
+def tcp_receive_range(token, fd, start, end, file_size, algorithm, digests, compression=None):
+    '''
+    Receive the [start, end) byte range of a download on its own connection and write it to the file with os.pwrite.
+    The digests of the chunks it covers are added to digests while the bytes stream through, frame by frame
+    if the transfer has a compression.
+    '''
+    file_s = socket(AF_INET, SOCK_STREAM)
+    file_s.settimeout(TCP_TIMEOUT)
+    try:
+        file_s.connect(('', PORT))
+        file_s.sendall(bytes.fromhex(token) + RANGE_HEADER.pack(start, end - start))
+
+        buffer = bytearray(options['chunk-size'])
+        view = memoryview(buffer)
+        chunk_digests = ChunkDigests(algorithm, start, digests)
+        while start < end:
+            if compression is None:
+                size = file_s.recv_into(view[:min(end - start, len(buffer))])
+                if not size:
+                    return
+                data = view[:size]
+            else:
+                data = tcp_receive_frame(file_s, compression, end - start)
+                if data is None:
+                    return
+            os.pwrite(fd, data, start)
+            chunk_digests.update(data)
+            start += len(data)
+        # the last chunk of the file is shorter than the others
+        if end == file_size:
+            chunk_digests.close()
+    except OSError as e:
+        print('Download interrupted: {}'.format(e))
+    finally:
+        file_s.close() # close the socket immediately after file transfer
+
+def file_chunk_digests(path, algorithm, end, content=None):
+    '''
+    The digests of the chunks of the first end bytes of the file, end is the size of the file or the end of a chunk.
+    The bytes are also added to the content hash if there is one.
+    '''
+    digests = {}
+    chunk_digests = ChunkDigests(algorithm, 0, digests)
+    buffer = bytearray(options['chunk-size'])
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        remaining = end
+        while remaining > 0:
+            size = f.readinto(view[:min(remaining, len(buffer))])
+            if not size:
                 break
+            chunk_digests.update(view[:size])
+            if content is not None:
+                content.update(view[:size])
+            remaining -= size
+    chunk_digests.close()
+    return digests
+
+def offered_compressions():
+    '''
+    The compressions the client offers the server, none if compression is disabled.
+    '''
+    return [] if options['compress'] == 'none' else [options['compress']]
+
+def compression_ratio(path, compression):
+    '''
+    The size of samples of the file after compression over their size, 1 if the file is empty.
+    The samples are taken at the start, the middle and the end of the file.
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if size <= 3 * COMPRESSION_SAMPLE:
+            sample = f.read()
+        else:
+            sample = b''
+            for offset in [0, size // 2, size - COMPRESSION_SAMPLE]:
+                f.seek(offset)
+                sample += f.read(COMPRESSION_SAMPLE)
+    if not sample:
+        return 1
+    return len(COMPRESSIONS[compression][0](sample)) / len(sample)
+
+def decompress(data, compression, size):
+    '''
+    Decompress data that was size bytes before compression, None if it does not decompress to them.
+    At most size bytes are decompressed, whatever the data claims.
+    '''
+    try:
+        data = COMPRESSIONS[compression][1]().decompress(data, size)
+    except DECOMPRESSION_ERRORS:
+        return None
+    return data if len(data) == size else None
+
+def chunk_ranges(indexes, file_size):
+    '''
+    The byte ranges of the chunks, adjacent chunks are merged.
+    '''
+    ranges = []
+    for index in sorted(indexes):
+        start, end = index * DIGEST_CHUNK, min((index + 1) * DIGEST_CHUNK, file_size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+class Crc32:
+    '''
+    zlib.crc32 with the interface of the hashlib digests.
+    '''
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+def new_digest(algorithm):
+    '''
+    An empty digest of the algorithm.
+    '''
+    if algorithm == 'crc32':
+        return Crc32()
+    return hashlib.new(algorithm)
+
+class ChunkDigests:
+    '''
+    Digests of the chunks of a file, computed while its bytes stream through from the start of a chunk on.
+    '''
+    def __init__(self, algorithm, offset, digests):
+        self.algorithm = algorithm
+        self.index = offset // DIGEST_CHUNK
+        self.filled = 0 # bytes of the current chunk
+        self.digest = new_digest(algorithm)
+        self.digests = digests # chunk index -> digest
+
+    def update(self, data):
+        '''
+        Add the next bytes of the file.
+        '''
+        while len(data) > 0:
+            size = min(len(data), DIGEST_CHUNK - self.filled)
+            self.digest.update(data[:size])
+            self.filled += size
+            data = data[size:]
+            if self.filled == DIGEST_CHUNK:
+                self.close()
+
+    def close(self):
+        '''
+        Finish the current chunk, e.g. the last chunk of the file.
+        '''
+        if self.filled > 0:
+            self.digests[self.index] = self.digest.hexdigest()
+        self.index += 1
+        self.filled = 0
+        self.digest = new_digest(self.algorithm)
+
+class DownloadCache:
+    '''
+    Copies of the downloaded files in the cache directory, named by the hash of their content.
+    An index maps every (server, thread title, file name) to the hash of its copy and is kept
+    next to the copies. Once the copies exceed limit bytes, the least recently used ones are evicted.
+    '''
+    def __init__(self, root, limit):
+        self.root = root
+        self.limit = limit
+        self.files = {} # (server, thread title, file name) -> hash of its copy
+        self.copies = OrderedDict() # hash -> size of the copy, least recently used first
+        self.size = 0
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(os.path.join(root, CACHE_INDEX)) as f:
+                index = json.load(f)
+            for server, title, file_name, content_hash in index['files']:
+                self.files[(server, title, file_name)] = content_hash
+            for content_hash, size in index['copies']:
+                self.copies[content_hash] = size
+                self.size += size
+        except (OSError, ValueError, KeyError, TypeError):
+            self.files, self.copies, self.size = {}, OrderedDict(), 0
+
+    def path(self, content_hash):
+        '''
+        The path of the copy.
+        '''
+        return os.path.join(self.root, content_hash)
+
+    def lookup(self, key):
+        '''
+        The hash of the cached copy of the file, None if there is no intact copy.
+        '''
+        content_hash = self.files.get(key)
+        if content_hash is None:
+            return None
+        if content_hash not in self.copies or not os.path.exists(self.path(content_hash)) or \
+                os.path.getsize(self.path(content_hash)) != self.copies[content_hash]:
+            del self.files[key]
+            return None
+        return content_hash
+
+    def use(self, key, file_name):
+        '''
+        Copy the cached copy of the file to file_name, False if the copy is gone.
+        '''
+        content_hash = self.lookup(key)
+        if content_hash is None:
+            return False
+        try:
+            shutil.copyfile(self.path(content_hash), file_name + '.part')
+        except OSError:
+            return False
+        os.replace(file_name + '.part', file_name)
+        self.copies.move_to_end(content_hash)
+        self.save()
+        return True
+
+    def store(self, key, content_hash, file_name):
+        '''
+        Keep a copy of the downloaded file, unless it is larger than the whole cache.
+        '''
+        if not valid_hash(content_hash):
+            return
+        size = os.path.getsize(file_name)
+        if size > self.limit:
+            return
+        if content_hash not in self.copies:
+            shutil.copyfile(file_name, self.path(content_hash) + '.part')
+            os.replace(self.path(content_hash) + '.part', self.path(content_hash))
+            self.copies[content_hash] = size
+            self.size += size
+        self.files[key] = content_hash
+        self.copies.move_to_end(content_hash)
+        self.evict()
+        self.save()
+
+    def evict(self):
+        '''
+        Remove the least recently used copies until the cache fits in its limit, with the files referring to them.
+        '''
+        while self.size > self.limit:
+            content_hash, size = self.copies.popitem(last=False)
+            self.size -= size
+            if os.path.exists(self.path(content_hash)):
+                os.remove(self.path(content_hash))
+            for key in [key for key, value in self.files.items() if value == content_hash]:
+                del self.files[key]
+
+    def save(self):
+        '''
+        Write the index next to the copies, a crash leaves the old index or the new one.
+        '''
+        index = {
+            'files': [list(key) + [content_hash] for key, content_hash in self.files.items()],
+            'copies': [[content_hash, size] for content_hash, size in self.copies.items()],
+        }
+        with open(os.path.join(self.root, CACHE_INDEX + '.part'), 'w') as f:
+            json.dump(index, f)
+        os.replace(os.path.join(self.root, CACHE_INDEX + '.part'), os.path.join(self.root, CACHE_INDEX))
+
+def valid_hash(content_hash):
+    '''
+    Check the hash of the server, it becomes part of a file name.
+    '''
+    return isinstance(content_hash, str) and len(content_hash) == HASH_DIGITS and \
+        all([digit in '0123456789abcdef' for digit in content_hash])
+
+def udp_encode(request):
+    '''
+    Encode the request with the codec of the session. After AUTH a request names the session
+    instead of carrying the username, the password is only sent to log in.
+    '''
+    if user_info['session_id'] == 0:
+        return compress_message(encode_message(request, 'json'), user_info['compression'], request.get('request_id') or 0)
+
+    request = {name: value for name, value in request.items() if name not in ['username', 'password']}
+    request['session_id'] = user_info['session_id']
+    return compress_message(encode_message(request, user_info['codec']), user_info['compression'], request.get('request_id') or 0)
+
+class Reassembler:
+    '''
+    Buffers the fragments of incomplete responses until all of them arrived. At most limit bytes
+    are buffered, the oldest incomplete responses are dropped first.
+    '''
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.size = 0
+        self.messages = OrderedDict() # message id -> [fragment count, {index: chunk}, last arrival]
+
+    def add(self, raw):
+        '''
+        Buffer the fragment, return the whole response once its last fragment arrived.
+        '''
+        magic, message_id, index, total = FRAGMENT_HEADER.unpack_from(raw)
+        chunk = raw[FRAGMENT_HEADER.size:]
+        self.expire()
+
+        message = self.messages.get(message_id)
+        if message is None:
+            # a response that can never fit in the buffer is dropped at once
+            if total * FRAGMENT_SIZE > self.limit:
+                print('Response of {} fragments is too large'.format(total))
+                return None
+            message = self.messages[message_id] = [total, {}, time.time()]
+        message[2] = time.time()
+        if index >= message[0] or index in message[1]:
+            return None
+
+        message[1][index] = chunk
+        self.size += len(chunk)
+        if len(message[1]) == message[0]:
+            self.drop(message_id)
+            return b''.join([message[1][i] for i in range(message[0])])
+
+        while self.size > self.limit:
+            self.drop(next(iter(self.messages)))
+        return None
+
+    def missing(self):
+        '''
+        The indexes of the fragments that did not arrive yet, for every incomplete response.
+        '''
+        self.expire()
+        return [(message_id, [index for index in range(total) if index not in chunks])
+                for message_id, (total, chunks, last) in self.messages.items()]
+
+    def expire(self):
+        '''
+        Drop the incomplete responses that got no fragment for longer than the timeout.
+        '''
+        for message_id, (total, chunks, last) in list(self.messages.items()):
+            if time.time() - last >= self.timeout:
+                self.drop(message_id)
+
+    def drop(self, message_id):
+        '''
+        Forget the fragments of the response.
+        '''
+        total, chunks, last = self.messages.pop(message_id)
+        self.size -= sum([len(chunk) for chunk in chunks.values()])
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   CODEC FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def encode_message(message, codec):
+    '''
+    Encode the message with the codec.
+    The binary codec packs the command, the request id and the session id into a fixed header,
+    the other fields follow as (field code, type, length, value).
+    '''
+    if codec == 'json':
+        return json.dumps(message).encode('utf-8')
+
+    header = BINARY_HEADER.pack(BINARY_MAGIC, COMMAND_CODES.get(message.get('command'), 0),
+                                message.get('request_id') or 0, message.get('session_id') or 0)
+    fields = [encode_field(name, value) for name, value in message.items() if name not in HEADER_FIELDS]
+    return header + b''.join(fields)
+
+def compress_message(payload, compression, request_id=0):
+    '''
+    Compress an encoded message larger than the threshold behind a header naming the compression and
+    carrying the request id, the message is sent as it is if there is no compression or it does not shrink.
+    '''
+    if compression is None or len(payload) <= COMPRESSION_THRESHOLD:
+        return payload
+    compressed = COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, COMPRESSION_CODES[compression], request_id, len(payload)) + \
+        COMPRESSIONS[compression][0](payload)
+    return compressed if len(compressed) < len(payload) else payload
+
+def decompress_message(raw, limit):
+    '''
+    The encoded message of a compressed message and the request id in its header, 0 if there is none.
+    Other messages are returned as they are. None if it does not decompress or would be larger than limit.
+    '''
+    if raw[0] != COMPRESSED_MAGIC:
+        return raw, 0
+    magic, code, request_id, size = COMPRESSED_HEADER.unpack_from(raw)
+    if not 0 < code < len(COMPRESSION_NAMES) or size > limit:
+        return None, 0
+    return decompress(raw[COMPRESSED_HEADER.size:], COMPRESSION_NAMES[code], size), request_id
+
+def decode_message(raw):
+    '''
+    Decode a message of either codec, the first byte tells them apart.
+    '''
+    if raw[0] != BINARY_MAGIC:
+        return json.loads(raw.decode('utf-8'))
+
+    magic, command, request_id, session_id = BINARY_HEADER.unpack_from(raw)
+    message = {'request_id': request_id}
+    if command != 0:
+        message['command'] = COMMAND_NAMES[command]
+    if session_id != 0:
+        message['session_id'] = session_id
+
+    position = BINARY_HEADER.size
+    while position < len(raw):
+        name, value, position = decode_field(raw, position)
+        message[name] = value
+    return message
+
+def encode_field(name, value):
+    '''
+    Encode one field, unknown field names are carried along with the field.
+    '''
+    if name in FIELD_CODES:
+        return struct.pack('!B', FIELD_CODES[name]) + encode_value(value)
+    return struct.pack('!B', 0) + encode_value(name) + encode_value(value)
+
+def decode_field(raw, position):
+    '''
+    Decode the field at the position, return its name, its value and the position after it.
+    '''
+    code = raw[position]
+    position += 1
+    if code == 0:
+        name, position = decode_value(raw, position)
+    else:
+        name = FIELD_NAMES[code]
+    value, position = decode_value(raw, position)
+    return name, value, position
+
+def encode_value(value):
+    '''
+    Encode the value as its type, its length and its bytes.
+    '''
+    if value is None:
+        kind, data = TYPE_NONE, b''
+    elif isinstance(value, bool):
+        kind, data = TYPE_BOOL, struct.pack('!?', value)
+    elif isinstance(value, int):
+        kind, data = TYPE_INT, struct.pack('!q', value)
+    elif isinstance(value, float):
+        kind, data = TYPE_FLOAT, struct.pack('!d', value)
+    elif isinstance(value, str):
+        kind, data = TYPE_STR, value.encode('utf-8')
+    elif isinstance(value, (list, tuple)):
+        kind, data = TYPE_LIST, b''.join([encode_value(item) for item in value])
+    elif isinstance(value, dict):
+        kind, data = TYPE_DICT, b''.join([encode_value(key) + encode_value(item) for key, item in value.items()])
+    else:
+        raise TypeError('Cannot encode {}'.format(type(value).__name__))
+    return VALUE_HEADER.pack(kind, len(data)) + data
+
+def decode_value(raw, position):
+    '''
+    Decode the value at the position, return it and the position after it.
+    '''
+    kind, length = VALUE_HEADER.unpack_from(raw, position)
+    start = position + VALUE_HEADER.size
+    end = start + length
+    if kind == TYPE_NONE:
+        value = None
+    elif kind == TYPE_BOOL:
+        value = struct.unpack_from('!?', raw, start)[0]
+    elif kind == TYPE_INT:
+        value = struct.unpack_from('!q', raw, start)[0]
+    elif kind == TYPE_FLOAT:
+        value = struct.unpack_from('!d', raw, start)[0]
+    elif kind == TYPE_STR:
+        value = bytes(raw[start:end]).decode('utf-8')
+    elif kind == TYPE_LIST:
+        value = []
+        position = start
+        while position < end:
+            item, position = decode_value(raw, position)
+            value.append(item)
+    else:
+        value = {}
+        position = start
+        while position < end:
+            key, position = decode_value(raw, position)
+            value[key], position = decode_value(raw, position)
+    return value, end
 
 ########################################################################################################################
 #                                                                                                                      #
@@ -191,8 +1163,10 @@ def AUTH_USER(udp_socket):
         username = username.strip()
         password = ''
 
-        request = {'command': 'AUTH', 'username': username}
+        request = {'command': 'AUTH', 'username': username, 'codecs': CODECS, 'compressions': offered_compressions()}
         response = udp_send_request(udp_socket, request)
+        if response is None: # there is no session to go on with
+            sys.exit()
 
         # if the user is already logged in, ask re-enter the username
         if response['type'] == 'ONLINE':
@@ -204,9 +1178,12 @@ def AUTH_USER(udp_socket):
         elif response['type'] == 'NEW':
             password = input('New user, enter password: ')
         
-        # get the password and send it to the server
-        request = {'command': 'AUTH', 'username': username, 'password': password}
-        response = udp_send_request(udp_socket, request)
+        # get the password and send it to the server as the follow-up of the request, it shares the id of the request
+        # so a late or replayed PWDNEED is skipped instead of being taken as the answer to the password
+        request = {'command': 'AUTH', 'username': username, 'password': password, 'request_id': request['request_id'], 'step': 1}
+        response = udp_send_request(udp_socket, request, 'PWDNEED')
+        if response is None:
+            sys.exit()
 
         # if authentication success
         if response['status'] == 'OK':
@@ -214,7 +1191,10 @@ def AUTH_USER(udp_socket):
             global user_info
             # get the user info
             user_info['username'] = username
-            user_info['password'] = password
+            user_info['session_id'] = response.get('session_id', 0)
+            user_info['codec'] = response.get('codec', 'json')
+            user_info['compression'] = response.get('compression')
+            user_info['ordered'] = response.get('ordered', False)
             break
         elif response['status'] == 'FAIL':
             print('Invalid password')
@@ -229,11 +1209,12 @@ def CREATE_THREAD(input_commands, udp_s):
     thread_request = {
         'command': 'CRT',
         'username': user_info['username'],
-        'password': user_info['password'],
         'thread_title': thread_title
     }
 
     response = udp_send_request(udp_s, thread_request)
+    if response is None:
+        return
 
     # if the thread is created successfully
     if response['status'] == 'OK':
@@ -248,11 +1229,12 @@ def LIST_THREADS(input_commands, udp_s):
     global user_info
     thread_request = {
         'command': 'LST',
-        'username': user_info['username'],
-        'password': user_info['password']
+        'username': user_info['username']
     }
 
     response = udp_send_request(udp_s, thread_request)
+    if response is None:
+        return
 
     # if the threads is not empty, list them
     if response['status'] == 'OK':
@@ -272,13 +1254,17 @@ def POST_MESSAGE(input_commands, udp_s):
     message_request = {
         'command': 'MSG',
         'username': user_info['username'],
-        'password': user_info['password'],
         'thread_title': thread_title,
         'message': ' '.join(message)
     }
 
-    response = udp_send_request(udp_s, message_request)
+    udp_submit_request(udp_s, message_request, MESSAGE_POSTED)
 
+def MESSAGE_POSTED(message_request, response):
+    '''
+    Show the response of a MSG request.
+    '''
+    thread_title = message_request['thread_title']
     # if the message is posted successfully
     if response['status'] == 'OK':
         print('Message posted to {} thread'.format(thread_title))
@@ -296,13 +1282,16 @@ def DELETE_MESSAGE(input_commands, udp_s):
     message_request = {
         'command': 'DLT',
         'username': user_info['username'],
-        'password': user_info['password'],
         'thread_title': thread_title,
         'message_id': message_id
     }
 
-    response = udp_send_request(udp_s, message_request)
-    
+    udp_submit_request(udp_s, message_request, MESSAGE_DELETED)
+
+def MESSAGE_DELETED(message_request, response):
+    '''
+    Show the response of a DLT request.
+    '''
     # if the message is deleted successfully
     if response['status'] == 'OK':
         print('The message has been deleted')
@@ -321,19 +1310,40 @@ def READ_THREAD(input_commands, udp_s):
     Return the messages in the thread.
     '''
     global user_info
+    global read_cache
     thread_title = input_commands.split()[1]
-    thread_request = {
-        'command': 'RDT',
-        'username': user_info['username'],
-        'password': user_info['password'],
-        'thread_title': thread_title
-    }
+    cache = read_cache.setdefault(thread_title, {'cursor': 0, 'version': 0, 'messages': []})
 
-    response = udp_send_request(udp_s, thread_request)
+    # only fetch the records after the ones already read, a page at a time
+    while True:
+        thread_request = {
+            'command': 'RDT',
+            'username': user_info['username'],
+                'thread_title': thread_title,
+            'since_id': cache['cursor'],
+            'version': cache['version'],
+            'limit': PAGE_SIZE
+        }
+
+        response = udp_send_request(udp_s, thread_request)
+        if response is None:
+            return
+        if response['status'] != 'OK':
+            del read_cache[thread_title]
+            break
+
+        # the thread changed before the cursor, the server sent it from the start
+        if response['reset']:
+            cache['messages'] = []
+        cache['messages'].extend(response['messages'])
+        cache['cursor'] = response['next_cursor']
+        cache['version'] = response['version']
+        if not response['more']:
+            break
 
     # if the thread is not empty, list them
     if response['status'] == 'OK':
-        for message in response['messages']:
+        for message in cache['messages']:
             print('{}'.format(message.strip()))
     # if the thread does not exist
     elif response['status'] == 'FAIL':
@@ -353,14 +1363,17 @@ def EDIT_MESSAGE(input_commands, udp_s):
     message_request = {
         'command': 'EDT',
         'username': user_info['username'],
-        'password': user_info['password'],
         'thread_title': thread_title,
         'message_id': message_id,
         'message': ' '.join(message)
     }
 
-    response = udp_send_request(udp_s, message_request)
+    udp_submit_request(udp_s, message_request, MESSAGE_EDITED)
 
+def MESSAGE_EDITED(message_request, response):
+    '''
+    Show the response of an EDT request.
+    '''
     # if the message is edited successfully
     if response['status'] == 'OK':
         print('The message has been edited')
@@ -391,38 +1404,76 @@ def UPLOAD_FILE(input_commands, udp_s):
     # get the file size
     file_size = os.path.getsize(file_name)
 
-    file_request = {
-        'command': 'UPD',
-        'username': user_info['username'],
-        'password': user_info['password'],
-        'thread_title': thread_title,
-        'file_name': file_name,
-        'file_size': file_size
-    }
+    # the same file keeps its transfer id, so the server resumes its upload with the chunks it does not hold
+    stat = os.stat(file_name)
+    transfer_id = hashlib.sha256('{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns).encode('utf-8')).hexdigest()[:TRANSFER_ID_DIGITS]
 
-    response = udp_send_request(udp_s, file_request)
+    # the server checks every chunk it receives against its digest, and skips the transfer if it holds the content
+    content = hashlib.sha256()
+    digests = file_chunk_digests(file_name, options['digest'], file_size, content)
+    digests = [digests[index] for index in range(len(digests))]
 
-    # if the thread does not exist
-    if response['status'] == 'FAIL':
-        print('Thread {} does not exist'.format(thread_title))
-    else:
-        # the thread exists, create a tcp socket to send the file
+    # compression is only offered for a file whose samples compress well
+    compressions = offered_compressions()
+    if compressions and compression_ratio(file_name, compressions[0]) > COMPRESSIBLE_RATIO:
+        compressions = []
+
+    for attempt in range(TRANSFER_ATTEMPTS):
+        file_request = {
+            'command': 'UPD',
+            'username': user_info['username'],
+                'thread_title': thread_title,
+            'file_name': file_name,
+            'file_size': file_size,
+            'transfer_id': transfer_id,
+            'digest_algorithm': options['digest'],
+            'digests': digests,
+            'content_hash': content.hexdigest(),
+            'compressions': compressions
+        }
+
+        response = udp_send_request(udp_s, file_request)
+        if response is None:
+            return
+
+        # if the thread does not exist
+        if response['status'] == 'FAIL':
+            print('Thread {} does not exist'.format(thread_title))
+            return
+        # if the server already holds the same content
+        elif response['status'] == 'OK':
+            print('{} uploaded to {} thread'.format(file_name, thread_title))
+            return
+
+        # the thread exists, create a tcp socket to send the chunks the server asks for, the token names the transfer
         file_s = socket(AF_INET, SOCK_STREAM)
-        file_s.connect(('', PORT))
+        file_s.settimeout(TCP_TIMEOUT)
+        try:
+            file_s.connect(('', PORT))
+            file_s.sendall(bytes.fromhex(response['token']))
 
-        # send the file to the server
-        with open(file_name, 'rb') as f:
-            file_s.sendall(f.read())
-        file_s.close() # close the socket immediately after file transfer
+            # send every range after its offset and length, a chunk at a time
+            with open(file_name, 'rb') as f:
+                for start, end in response['ranges']:
+                    tcp_send_range(file_s, f, start, end, response.get('compression'))
+        except OSError as e:
+            print('Upload of {} interrupted: {}'.format(file_name, e))
+        finally:
+            file_s.close() # close the socket immediately after file transfer
 
-        response = udp_receive_response(udp_s)
+        response = udp_receive_response(udp_s, file_request, 'UPLOAD_FILE')
+        if response is None:
+            return
 
         # if the file is uploaded successfully
         if response['status'] == 'OK':
             print('{} uploaded to {} thread'.format(file_name, thread_title))
-        # if the file size is incorrect
-        elif response['status'] == 'FAIL':
-            print('{} has been corrupted'.format(file_name))
+            return
+        # if chunks were lost or corrupted, send them again
+        elif response['status'] == 'INCOMPLETE':
+            print('Upload of {} stopped with {} of {} bytes missing'.format(file_name, sum([end - start for start, end in response['ranges']]), file_size))
+
+    print('Upload of {} incomplete, issue UPD again to resume it'.format(file_name))
 
 def DOWNLOAD_FILE(input_commands, udp_s):
     '''
@@ -432,50 +1483,102 @@ def DOWNLOAD_FILE(input_commands, udp_s):
     global PORT
     thread_title = input_commands.split()[1]
     file_name = input_commands.split()[2]
-    file_request = {
-        'command': 'DWN',
-        'username': user_info['username'],
-        'password': user_info['password'],
-        'thread_title': thread_title,
-        'file_name': file_name,
-        'status': ''
-    }
+    transfer_id = None
 
-    response = udp_send_request(udp_s, file_request)
+    # the server skips the transfer if the cached copy of the file has the hash of the file in the thread
+    key = ('localhost:{}'.format(PORT), thread_title, file_name)
+    cached = download_cache.lookup(key) if download_cache is not None else None
 
-    # if the thread does not exist
-    if response['status'] == 'FAIL':
-        print('Thread {} does not exist'.format(thread_title))
-    # if the file does not exist
-    elif response['status'] == 'FILE_NOT_FOUND':
-        print('File does not exist in Thread {}'.format(thread_title))
-    # if the file exists
-    elif response['status'] == 'FILE_FOUND':
+    for attempt in range(TRANSFER_ATTEMPTS):
+        file_request = {
+            'command': 'DWN',
+            'username': user_info['username'],
+                'thread_title': thread_title,
+            'file_name': file_name,
+            'streams': options['streams'] if transfer_id is None else len(pending),
+            'compressions': offered_compressions(),
+            'status': ''
+        }
+        if cached is not None:
+            file_request['content_hash'] = cached
 
-        # create a tcp socket to receive the file from the server
-        file_s = socket(AF_INET, SOCK_STREAM)
-        file_s.connect(('', PORT))
+        response = udp_send_request(udp_s, file_request)
+        if response is None:
+            return
 
-        # receive the file
-        with open(file_name, 'wb') as f:
-            while True:
-                data = file_s.recv(1024)
-                if not data:
-                    break
-                f.write(data)
-        file_s.close() # close the socket immediately after file transfer
+        # if the thread does not exist
+        if response['status'] == 'FAIL':
+            print('Thread {} does not exist'.format(thread_title))
+            return
+        # if the file does not exist
+        elif response['status'] == 'FILE_NOT_FOUND':
+            print('File does not exist in Thread {}'.format(thread_title))
+            return
+        # if the file did not change since it was cached
+        elif response['status'] == 'NOT_MODIFIED':
+            if download_cache.use(key, file_name):
+                print('{} successfully downloaded from the cache'.format(file_name))
+                return
+            # the cached copy is gone, download the file
+            cached = None
+            continue
 
-        file_size = response['file_size'] # get the file size
+        # if the file exists, it is received next to its final name
+        file_size = int(response['file_size']) # get the file size
+        tokens, algorithm = response['tokens'], response['digest_algorithm']
+        if response['transfer_id'] != transfer_id: # a new download, or the file changed since the last attempt
+            transfer_id = response['transfer_id']
+            if len(tokens) == 1:
+                # one stream resumes from the whole chunks already held, also by a later DWN
+                partial_file = '{}.{}.part'.format(file_name, transfer_id)
+                offset = min(os.path.getsize(partial_file), file_size) // DIGEST_CHUNK * DIGEST_CHUNK if os.path.exists(partial_file) else 0
+                with open(partial_file, 'r+b' if offset else 'wb') as f:
+                    f.truncate(offset)
+                received = file_chunk_digests(partial_file, algorithm, offset)
+                pending = [[offset, file_size]]
+            else:
+                # parallel streams write ranges of whole chunks into the preallocated file, they resume within this DWN only
+                partial_file = '{}.{}.ranges.part'.format(file_name, transfer_id)
+                with open(partial_file, 'wb') as f:
+                    f.truncate(file_size)
+                received = {}
+                step = (file_size + DIGEST_CHUNK * len(tokens) - 1) // (DIGEST_CHUNK * len(tokens)) * DIGEST_CHUNK
+                pending = [[min(index * step, file_size), min((index + 1) * step, file_size)] for index in range(len(tokens))]
 
-        # if the size of downloaded file is same as the size of the file in the server
-        if os.path.getsize(file_name) == int(file_size):
+        # receive the ranges on their own tcp sockets, the token names the transfer
+        fd = os.open(partial_file, os.O_WRONLY)
+        try:
+            receivers = []
+            for token, (start, end) in zip(tokens, pending):
+                receiver = threading.Thread(target=tcp_receive_range, args=(token, fd, start, end, file_size, algorithm, received, response.get('compression')))
+                receiver.start()
+                receivers.append(receiver)
+            for receiver in receivers:
+                receiver.join()
+        finally:
+            os.close(fd)
+
+        # the chunks that did not arrive or do not match their digest are received again
+        pending = chunk_ranges([index for index, digest in enumerate(response['digests']) if received.get(index) != digest], file_size)
+
+        # if all the chunks of the file in the server arrived intact
+        if not pending:
+            os.replace(partial_file, file_name)
             print('{} successfully downloaded'.format(file_name))
             file_request['status'] = 'OK'
+            if download_cache is not None:
+                download_cache.store(key, response.get('content_hash'), file_name)
         else:
-            print('{} has been corrupted'.format(file_name))
+            print('Download of {} stopped with {} of {} bytes missing'.format(file_name, sum([end - start for start, end in pending]), file_size))
             file_request['status'] = 'FAIL'
 
-        udp_s.sendto(json.dumps(file_request).encode('utf-8'), ('', PORT))
+        # ack the download as the follow-up of the request
+        file_request['step'] = 1
+        udp_s.sendto(udp_encode(file_request), ('', PORT))
+        if file_request['status'] == 'OK':
+            return
+
+    print('Download of {} incomplete, issue DWN again to resume it'.format(file_name))
 
 def REMOVE_THREAD(input_commands, udp_s):
     '''
@@ -486,11 +1589,12 @@ def REMOVE_THREAD(input_commands, udp_s):
     thread_request = {
         'command': 'RMV',
         'username': user_info['username'],
-        'password': user_info['password'],
         'thread_title': thread_title
     }
 
     response = udp_send_request(udp_s, thread_request)
+    if response is None:
+        return
 
     # if the thread does not exist
     if response['status'] == 'NO_THREAD':
@@ -508,11 +1612,12 @@ def EXIT_USER(input_commands, udp_s):
     global user_info
     thread_request = {
         'command': 'XIT',
-        'username': user_info['username'],
-        'password': user_info['password']
+        'username': user_info['username']
     }
 
     response = udp_send_request(udp_s, thread_request)
+    if response is None:
+        return
 
     # if the user is online
     if response['status'] == 'OK':
@@ -521,6 +1626,106 @@ def EXIT_USER(input_commands, udp_s):
     elif response['status'] == 'FAIL':
         print('Uer {} is not online'.format(user_info['username']))
 
+def SUBSCRIBE_THREAD(input_commands, udp_s):
+    '''
+    Subscribe to the new, edited and deleted messages of the thread.
+    '''
+    global user_info
+    thread_title = input_commands.split()[1]
+    thread_request = {
+        'command': 'SUB',
+        'username': user_info['username'],
+        'thread_title': thread_title,
+        'event_port': event_startup()
+    }
+
+    response = udp_send_request(udp_s, thread_request)
+    if response is None:
+        return
+
+    # if the thread does not exist
+    if response['status'] == 'NO_THREAD':
+        print('Thread {} does not exist'.format(thread_title))
+    elif response['status'] == 'FAIL':
+        print('Cannot subscribe to Thread {}'.format(thread_title))
+    elif response['status'] == 'OK':
+        print('Subscribed to Thread {}'.format(thread_title))
+
+def UNSUBSCRIBE_THREAD(input_commands, udp_s):
+    '''
+    Stop receiving the changes of the thread.
+    '''
+    global user_info
+    thread_title = input_commands.split()[1]
+    thread_request = {
+        'command': 'UNSUB',
+        'username': user_info['username'],
+        'thread_title': thread_title
+    }
+
+    response = udp_send_request(udp_s, thread_request)
+    if response is None:
+        return
+
+    # if the user is not subscribed to the thread
+    if response['status'] == 'FAIL':
+        print('Not subscribed to Thread {}'.format(thread_title))
+    elif response['status'] == 'OK':
+        print('Unsubscribed from Thread {}'.format(thread_title))
+
+def matched(response):
+    '''
+    The number of matching messages of a SRC response, the server ranks at most its limit of them.
+    '''
+    return '{}+'.format(response['total']) if response.get('truncated') else response['total']
+
+def SEARCH_MESSAGES(input_commands, udp_s):
+    '''
+    Find the messages of all the threads matching the terms and "quoted phrases".
+    thread:title and user:name limit the search, page:N shows the Nth page of the results.
+    '''
+    global user_info
+    filters, terms = {}, []
+    for term in input_commands.split()[1:]:
+        name, separator, value = term.partition(':')
+        if separator and name in SEARCH_FILTERS and value:
+            filters[name] = value
+        else:
+            terms.append(term)
+    page = int(filters['page']) if filters.get('page', '').isdigit() and int(filters['page']) > 0 else 1
+
+    search_request = {
+        'command': 'SRC',
+        'username': user_info['username'],
+        'query': ' '.join(terms),
+        'offset': (page - 1) * SEARCH_PAGE,
+        'limit': SEARCH_PAGE
+    }
+    if 'thread' in filters:
+        search_request['thread_title'] = filters['thread']
+    if 'user' in filters:
+        search_request['author'] = filters['user']
+
+    response = udp_send_request(udp_s, search_request)
+    if response is None:
+        return
+
+    # if the search is limited to a thread that does not exist
+    if response['status'] == 'NO_THREAD':
+        print('Thread {} does not exist'.format(filters['thread']))
+    elif response['status'] == 'NO_MSG':
+        print('No messages match {}'.format(search_request['query']))
+    elif response['status'] == 'FAIL':
+        print('Invalid search')
+    elif not response['results']:
+        print('No page {} of {} matching messages'.format(page, matched(response)))
+    elif response['status'] == 'OK':
+        print('Page {} of {} matching messages:'.format(page, matched(response)))
+        for title, message in response['results']:
+            print('{}: {}'.format(title, message.strip()))
+        if response['more']:
+            print('Add page:{} for more'.format(page + 1))
+
 ########################################################################################################################
 #                                                                                                                      #
 #                                                  MAIN FUNCTION                                                       #                                                                                                                                                           
@@ -528,4 +1733,9 @@ def EXIT_USER(input_commands, udp_s):
 ########################################################################################################################
 if __name__ == '__main__':
     PORT = port_checker()
+    option_parser()
+    reassembler = Reassembler(REASSEMBLY_LIMIT, REASSEMBLY_TIMEOUT)
+    rtt = RttEstimator()
+    if options['cache-size'] > 0:
+        download_cache = DownloadCache(CACHE_DIR, options['cache-size'])
     client_startup(PORT)
\ No newline at end of file
@@ -0,0 +1,117 @@
+'''
+Throughput of the file download path over loopback.
+
+Usage: python3 benchmark_download.py [size in MB]
+
+Sends a file of the given size (1024 MB by default) through tcp_send_file of the server,
+once with os.sendfile and once with the buffered fallback, next to the 1024 byte
+read/send loop the server used before, and prints the throughput of each in GB/s.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import sys
+import time
+import tempfile
+import threading
+from socket import *
+
+import server
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+RECEIVE_BUFFER = 1 << 20
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def legacy_send_file(tcp_soc, f):
+    '''
+    The download loop of the server before tcp_send_file.
+    '''
+    while True:
+        data = f.read(1024)
+        if not data:
+            break
+        tcp_soc.send(data)
+
+def fallback_send_file(tcp_soc, f):
+    '''
+    tcp_send_file as on a platform without os.sendfile.
+    '''
+    sendfile = os.sendfile
+    del os.sendfile
+    try:
+        server.tcp_send_file(tcp_soc, f)
+    finally:
+        os.sendfile = sendfile
+
+def receive(tcp_soc, received):
+    '''
+    Drain the connection and count the bytes.
+    '''
+    buffer = bytearray(RECEIVE_BUFFER)
+    while True:
+        size = tcp_soc.recv_into(buffer)
+        if not size:
+            break
+        received[0] += size
+    tcp_soc.close()
+
+def measure(path, send_file):
+    '''
+    Seconds and bytes to send the file over a loopback connection.
+    '''
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sender = socket(AF_INET, SOCK_STREAM)
+    sender.connect(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+
+    received = [0]
+    thread = threading.Thread(target=receive, args=(receiver, received))
+    thread.start()
+
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        send_file(sender, f)
+    sender.close()
+    thread.join()
+    return time.perf_counter() - start, received[0]
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  MAIN FUNCTION                                                       #
+#                                                                                                                      #
+########################################################################################################################
+if __name__ == '__main__':
+    size = int(sys.argv[1]) << 20 if len(sys.argv) > 1 else 1 << 30
+
+    with tempfile.NamedTemporaryFile(dir='.') as f:
+        chunk = os.urandom(1 << 20)
+        for _ in range(size // len(chunk)):
+            f.write(chunk)
+        f.write(chunk[:size % len(chunk)])
+        f.flush()
+
+        candidates = [('1024 byte send', legacy_send_file), ('buffered sendall', fallback_send_file)]
+        if hasattr(os, 'sendfile'):
+            candidates.append(('sendfile', server.tcp_send_file))
+
+        for name, send_file in candidates:
+            seconds, received = measure(f.name, send_file)
+            if received != size:
+                print('{}: received {} of {} bytes'.format(name, received, size))
+                continue
+            print('{:>16}: {:.2f} GB/s'.format(name, size / seconds / 1e9))
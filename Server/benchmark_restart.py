@@ -0,0 +1,134 @@
+'''
+Cold start of the forum server from its snapshot and journal.
+
+Usage: python3 benchmark_restart.py [threads] [messages per thread] [journaled operations]
+
+Builds a forum of the given number of threads (100000 by default) with the given number of
+indexed messages each (5 by default) and an upload in every tenth thread through the files
+backend, saves a snapshot, journals the given number of further posts (10000 by default)
+and then measures the restart a server does in a new process: loading the snapshot and
+replaying the journal, until it answers requests and until its search index is complete.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import sys
+import gc
+import time
+import hashlib
+import tempfile
+import subprocess
+
+from thread_store import ThreadStore
+from blob_store import BlobStore
+from search_index import SearchIndex
+from journal import Journal
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+WORDS = ['forum', 'thread', 'message', 'server', 'client', 'restart', 'journal', 'snapshot', 'upload', 'search']
+RUNS = 5 # restarts measured, the median is printed
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def components(root, journal):
+    '''
+    The thread store, blob store and search index of a server keeping its state in root.
+    '''
+    return (ThreadStore(root=os.path.join(root, 'threads'), journal=journal),
+            BlobStore(root=os.path.join(root, 'blobs'), journal=journal),
+            SearchIndex(journal=journal))
+
+def post(thread_store, search_index, title, index):
+    '''
+    Post an indexed message, as the MSG handler does.
+    '''
+    message = 'message {} of {} about the {} and the {}'.format(index, title, WORDS[index % len(WORDS)], WORDS[len(title) % len(WORDS)])
+    thread_store.post(title, 'hans', message, then=lambda msg_id: search_index.add(title, msg_id, 'hans', message))
+
+def build(root, threads, messages, operations):
+    '''
+    Build the forum, save its snapshot and journal the operations after it.
+    '''
+    journal = Journal(os.path.join(root, 'state'))
+    journal.load()
+    thread_store, blob_store, search_index = components(root, journal)
+    for number in range(threads):
+        title = 't{}'.format(number)
+        thread_store.create(title, 'hans')
+        for index in range(messages):
+            post(thread_store, search_index, title, index)
+        if number % 10 == 0:
+            content = 'file of {}'.format(title).encode('utf-8')
+            partial = blob_store.partial_path(title, 'notes.txt', number)
+            with open(partial, 'wb') as f:
+                f.write(content)
+            blob_store.store(title, 'notes.txt', partial, hashlib.sha256(content).hexdigest(), {'size': len(content)})
+            thread_store.upload(title, 'hans', 'notes.txt')
+
+    generation = journal.rotate()
+    journal.save(generation, {'threads': thread_store.snapshot(), 'blobs': blob_store.snapshot(), 'search': search_index.snapshot()})
+    for index in range(operations):
+        post(thread_store, search_index, 't{}'.format(index % threads), messages + index)
+
+def restart(root):
+    '''
+    Seconds until the server answers requests, i.e. the threads and the files are restored,
+    and until the search index is restored in the background too.
+    '''
+    start = time.perf_counter()
+    gc.disable()
+    journal = Journal(os.path.join(root, 'state'))
+    snapshot, operations = journal.load()
+    thread_store, blob_store, search_index = components(root, journal)
+    thread_store.restore(snapshot['threads'])
+    blob_store.restore(snapshot['blobs'])
+    replayers = {'threads': thread_store, 'blobs': blob_store}
+    searches = []
+    for operation in operations:
+        if operation[0] == 'search':
+            searches.append(operation[1:])
+        else:
+            replayers[operation[0]].replay(operation[1:])
+    thread_store.replayed()
+    blob_store.replayed()
+    gc.enable()
+    search_index.restore(snapshot['search'], searches)
+    serving = time.perf_counter()
+
+    with search_index.lock: # released once the index is complete
+        end = time.perf_counter()
+    return serving - start, end - start
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  MAIN FUNCTION                                                       #
+#                                                                                                                      #
+########################################################################################################################
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['restart']: # one measured restart, in the process started for it
+        print(*restart(sys.argv[2]))
+        sys.exit()
+
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    operations = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'threads'))
+        build(root, threads, messages, operations)
+        print('{} threads of {} messages, snapshot of {:.1f} MB, {} journaled operations'.format(
+            threads, messages, os.path.getsize(os.path.join(root, 'state', 'snapshot.1')) / 1e6, operations * 2))
+        command = [sys.executable, os.path.abspath(__file__), 'restart', root]
+        times = sorted([[float(value) for value in subprocess.check_output(command).split()] for _ in range(RUNS)])
+        print('restart: answering after {:.3f} s, search index complete after {:.3f} s, median of {}'.format(
+            times[RUNS // 2][0], times[RUNS // 2][1], RUNS))
@@ -0,0 +1,95 @@
+'''
+Latency of SRC queries over a large forum.
+
+Usage: python3 benchmark_search.py [messages]
+
+Indexes the given number of messages (1000000 by default) with words drawn from a Zipf
+distribution over a vocabulary of 50000 words, spread over threads of 100 messages,
+and prints the median and the 99th percentile latency of the index for kinds of queries.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import sys
+import time
+import random
+import itertools
+
+from search_index import SearchIndex
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+VOCABULARY = 50000
+USERS = 1000
+THREAD_SIZE = 100 # messages per thread
+MESSAGE_WORDS = (4, 24)
+QUERIES = 1000 # per kind of query
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def build(count):
+    '''
+    An index of count messages and the messages it was built from.
+    '''
+    words = ['w{}'.format(rank) for rank in range(VOCABULARY)]
+    weights = list(itertools.accumulate([1 / (rank + 1) for rank in range(VOCABULARY)]))
+    index = SearchIndex()
+    messages = []
+    for number in range(count):
+        message = ' '.join(random.choices(words, cum_weights=weights, k=random.randint(*MESSAGE_WORDS)))
+        title, msg_id = 't{}'.format(number // THREAD_SIZE), number % THREAD_SIZE + 1
+        index.add(title, msg_id, 'u{}'.format(random.randrange(USERS)), message)
+        messages.append((title, message))
+    return index, messages
+
+def queries(messages, kind):
+    '''
+    Queries of the kind, made of words of random messages so that they match.
+    '''
+    for _ in range(QUERIES):
+        title, message = random.choice(messages)
+        words = message.split()
+        start = random.randrange(len(words) - 1)
+        if kind == 'two terms':
+            yield ' '.join(random.sample(words, 2)), None
+        elif kind == 'phrase':
+            yield '"{} {}"'.format(words[start], words[start + 1]), None
+        elif kind == 'term in a thread':
+            yield words[start], title
+        elif kind == 'frequent term':
+            yield 'w{}'.format(random.randrange(10)), None
+
+def measure(index, messages, kind):
+    '''
+    Median and 99th percentile of the seconds per query.
+    '''
+    seconds = []
+    for query, title in queries(messages, kind):
+        start = time.perf_counter()
+        index.search(query, title)
+        seconds.append(time.perf_counter() - start)
+    seconds.sort()
+    return seconds[len(seconds) // 2], seconds[len(seconds) * 99 // 100]
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  MAIN FUNCTION                                                       #
+#                                                                                                                      #
+########################################################################################################################
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    start = time.perf_counter()
+    index, messages = build(count)
+    print('{} messages indexed in {:.1f} s'.format(count, time.perf_counter() - start))
+    for kind in ['two terms', 'phrase', 'term in a thread', 'frequent term']:
+        median, tail = measure(index, messages, kind)
+        print('{:>16}: {:8.3f} ms median {:8.3f} ms p99'.format(kind, median * 1000, tail * 1000))
@@ -0,0 +1,113 @@
+'''
+Latency and throughput of the storage backends.
+
+Usage: python3 benchmark_storage.py [seconds]
+
+Prints the microseconds of every operation of the handlers on one thread, and then runs
+8 threads posting messages and 8 threads reading pages of 200 records and looking up
+message authors, as the handlers of concurrent requests do, against each backend for the
+given number of seconds (5 by default) and prints the operations per second of each.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+
+from thread_store import ThreadStore
+from sqlite_store import SqliteStore
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+THREADS = 16 # forum threads the operations are spread over
+WRITERS = 8
+READERS = 8
+PAGE = 200 # records per read
+PREFILL = 2000 # messages per thread before the measurement
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def latencies(store):
+    '''
+    Microseconds per post, page read, author lookup, edit and delete on one thread.
+    '''
+    store.create('single', 'hans')
+    operations = [
+        ('post', lambda index: store.post('single', 'hans', 'a message of the benchmark')),
+        ('read', lambda index: store.read('single', index, 0, PAGE)),
+        ('author', lambda index: store.author('single', index + 1)),
+        ('edit', lambda index: store.edit('single', index + 1, 'an edited message')),
+        ('delete', lambda index: store.delete('single', index + 1)),
+    ]
+    result = []
+    for name, operation in operations:
+        start = time.perf_counter()
+        for index in range(PREFILL):
+            operation(index)
+        result.append((name, (time.perf_counter() - start) / PREFILL * 1e6))
+    return result
+
+def writer(store, stop, counts):
+    '''
+    Post messages until stopped.
+    '''
+    while not stop.is_set():
+        store.post('t{}'.format(random.randrange(THREADS)), 'hans', 'a message of the benchmark')
+        counts[0] += 1
+
+def reader(store, stop, counts):
+    '''
+    Read pages and look up authors until stopped.
+    '''
+    while not stop.is_set():
+        title = 't{}'.format(random.randrange(THREADS))
+        store.read(title, random.randrange(PREFILL), 0, PAGE)
+        store.author(title, random.randrange(1, PREFILL))
+        counts[1] += 1
+
+def measure(store, seconds):
+    '''
+    Posts and reads per second.
+    '''
+    for index in range(THREADS):
+        store.create('t{}'.format(index), 'hans')
+        for _ in range(PREFILL):
+            store.post('t{}'.format(index), 'hans', 'a message written before the benchmark')
+
+    stop = threading.Event()
+    counts = [0, 0]
+    workers = [threading.Thread(target=writer, args=(store, stop, counts)) for _ in range(WRITERS)]
+    workers += [threading.Thread(target=reader, args=(store, stop, counts)) for _ in range(READERS)]
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return counts[0] / seconds, counts[1] / seconds
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  MAIN FUNCTION                                                       #
+#                                                                                                                      #
+########################################################################################################################
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as root:
+        for name, store in [('files', ThreadStore(root=root)), ('sqlite', SqliteStore(os.path.join(root, 'forum.db')))]:
+            print('{:>6}: {}'.format(name, ' '.join(['{} {:.0f} us'.format(*latency) for latency in latencies(store)])))
+            posts, reads = measure(store, seconds)
+            print('{:>6}: {:8.0f} posts/s {:8.0f} reads/s concurrently'.format(name, posts, reads))
@@ -0,0 +1,258 @@
+'''
+Blob store of the forum server.
+
+Every uploaded file is stored once, as a blob named after the SHA-256 of its content and
+sharded into directories by the first two digits of the hash:
+
+    blobs/ab/abcdef...
+
+An index maps every (thread, file name) to the hash of its blob and every blob counts the
+files referring to it. Uploading the same content to many threads adds references to one
+blob, and a blob is deleted once its last reference is removed, e.g. with its thread.
+
+Uploads are received into partial files under blobs/partial and moved into place once their
+content is verified. An interrupted upload keeps its partial file to resume from, until it was
+not written to for PARTIAL_TIMEOUT seconds; the stale ones are deleted at startup and then
+at most every PARTIAL_SWEEP seconds, when an upload starts.
+
+With a journal, every change of the index is journaled before it is made, so a blob is only
+deleted once the journal dropped its last reference. The index is restored from the snapshot
+and the journal, and the reference counts are counted again from it.
+
+With a storage backend that keeps the files, e.g. the SQLite one, every reference is committed
+to the backend before it is counted and the files of a thread are deleted with the thread, so
+the index is loaded from the backend at startup instead, and the blobs it does not refer to,
+e.g. of an upload cut short by a crash, are deleted.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import time
+import threading
+import collections
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+HASH_DIGITS = 64 # hex digits of a SHA-256
+SHARD_DIGITS = 2 # hex digits of the hash naming the directory of a blob
+PARTIAL_TIMEOUT = 24 * 3600 # seconds an interrupted upload can be resumed after its last write
+PARTIAL_SWEEP = 600 # seconds between the sweeps of the stale partial files
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      BLOB STORE                                                      #
+#                                                                                                                      #
+########################################################################################################################
+class BlobStore:
+    '''
+    All the uploaded files of the forum, deduplicated by content.
+    '''
+    def __init__(self, root='blobs', journal=None, storage=None):
+        files = storage.files() if storage is not None else None
+        self.root = root
+        self.journal = journal # None keeps the files of this run only
+        self.storage = storage if files is not None else None # keeps the files instead of the journal
+        self.released = set() # hashes the replay dropped a reference to
+        self.index = {} # (thread title, file name) -> hash of its blob
+        self.refcounts = {} # hash -> files referring to the blob
+        self.metadata = {} # hash -> {'size', 'digest_algorithm', 'digest', 'digests'} of the blob
+        self.lock = threading.Lock()
+        self.swept = 0 # time of the last sweep of the partial files
+        os.makedirs(os.path.join(root, 'partial'), exist_ok=True)
+        self.expire_partials()
+        if files is not None:
+            for title, file_name, content_hash, metadata in files:
+                self.index[(title, file_name)] = content_hash
+                self.metadata[content_hash] = metadata
+            self.refcounts = dict(collections.Counter(self.index.values()))
+            self.sweep()
+
+    def sweep(self):
+        '''
+        Delete the blobs without a reference in the index loaded from the storage backend.
+        '''
+        for shard in os.listdir(self.root):
+            if len(shard) != SHARD_DIGITS or not os.path.isdir(os.path.join(self.root, shard)):
+                continue
+            for content_hash in os.listdir(os.path.join(self.root, shard)):
+                if content_hash not in self.refcounts:
+                    os.remove(os.path.join(self.root, shard, content_hash))
+
+    def path(self, content_hash):
+        '''
+        The path of the blob.
+        '''
+        return os.path.join(self.root, content_hash[:SHARD_DIGITS], content_hash)
+
+    def partial_path(self, title, file_name, transfer_id):
+        '''
+        The path an upload is received into before it becomes a blob.
+        '''
+        return os.path.join(self.root, 'partial', '{}-{}.{}.part'.format(title, file_name, transfer_id))
+
+    def expire_partials(self):
+        '''
+        Delete the partial files of the uploads not resumed within PARTIAL_TIMEOUT, with their digests.
+        '''
+        now = time.time()
+        with self.lock:
+            if now - self.swept < PARTIAL_SWEEP:
+                return
+            self.swept = now
+        directory = os.path.join(self.root, 'partial')
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if now - os.path.getmtime(path) > PARTIAL_TIMEOUT:
+                    os.remove(path)
+            except OSError: # finished or deleted meanwhile
+                pass
+
+    def lookup(self, title, file_name):
+        '''
+        The hash and metadata of the file in the thread, (None, None) if the file does not exist.
+        '''
+        with self.lock:
+            content_hash = self.index.get((title, file_name))
+            if content_hash is None:
+                return None, None
+            return content_hash, self.metadata[content_hash]
+
+    def open(self, title, file_name, count=1):
+        '''
+        The hash and metadata of the file in the thread and count files open on its blob, (None, None, [])
+        if the file does not exist. The blob is opened under the lock, so a thread removed meanwhile
+        cannot delete it first, and the open files keep reading it once it is deleted.
+        '''
+        with self.lock:
+            content_hash = self.index.get((title, file_name))
+            if content_hash is None:
+                return None, None, []
+            return content_hash, self.metadata[content_hash], [open(self.path(content_hash), 'rb') for _ in range(count)]
+
+    def store(self, title, file_name, partial_path, content_hash, metadata):
+        '''
+        Move a verified upload into its blob, or drop it if the blob already exists,
+        and make the file in the thread refer to the blob.
+        '''
+        with self.lock:
+            if content_hash in self.refcounts:
+                os.remove(partial_path)
+            else:
+                os.makedirs(os.path.dirname(self.path(content_hash)), exist_ok=True)
+                os.replace(partial_path, self.path(content_hash)) # readers see the whole blob or none of it
+                self.refcounts[content_hash] = 0
+                self.metadata[content_hash] = metadata
+            self.reference(title, file_name, content_hash)
+
+    def link(self, title, file_name, content_hash):
+        '''
+        Make the file in the thread refer to an existing blob, False if the blob does not exist.
+        '''
+        with self.lock:
+            if content_hash not in self.refcounts:
+                return False
+            self.reference(title, file_name, content_hash)
+            return True
+
+    def remove_thread(self, title):
+        '''
+        Drop the files of the thread, the blobs without references are deleted.
+        '''
+        with self.lock:
+            self.record('remove_thread', title)
+            for key in [key for key in self.index if key[0] == title]:
+                self.release(self.index.pop(key))
+
+    def reference(self, title, file_name, content_hash):
+        '''
+        Add a reference to the blob, a file uploaded again drops its reference to the old blob.
+        The caller holds the lock.
+        '''
+        self.record('reference', title, file_name, content_hash, self.metadata[content_hash])
+        self.refcounts[content_hash] += 1
+        previous = self.index.get((title, file_name))
+        self.index[(title, file_name)] = content_hash
+        if previous is not None:
+            self.release(previous)
+
+    def release(self, content_hash):
+        '''
+        Drop a reference to the blob, the caller holds the lock.
+        '''
+        self.refcounts[content_hash] -= 1
+        if self.refcounts[content_hash] == 0:
+            del self.refcounts[content_hash], self.metadata[content_hash]
+            # a download still reading the blob keeps its open file
+            os.remove(self.path(content_hash))
+
+    def record(self, *operation):
+        '''
+        Journal the change of the index, or commit a new reference to the storage backend keeping the files.
+        The backend drops the files of a thread with the thread.
+        '''
+        if self.storage is not None:
+            if operation[0] == 'reference':
+                self.storage.keep_file(*operation[1:])
+        elif self.journal is not None:
+            self.journal.append('blobs', *operation)
+
+    def snapshot(self):
+        '''
+        The index and the metadata of the blobs.
+        '''
+        with self.lock:
+            return {'index': dict(self.index), 'metadata': dict(self.metadata)}
+
+    def restore(self, state):
+        '''
+        Load the index and the metadata of the blobs from a snapshot.
+        '''
+        self.index = state['index']
+        self.metadata = state['metadata']
+
+    def replay(self, operation):
+        '''
+        Apply a journaled change to the index, the blobs that lost their references are deleted by replayed.
+        '''
+        name, title = operation[0], operation[1]
+        if name == 'reference':
+            file_name, content_hash, metadata = operation[2:]
+            previous = self.index.get((title, file_name))
+            if previous is not None:
+                self.released.add(previous)
+            self.index[(title, file_name)] = content_hash
+            self.metadata[content_hash] = metadata
+        elif name == 'remove_thread':
+            for key in [key for key in self.index if key[0] == title]:
+                self.released.add(self.index.pop(key))
+
+    def replayed(self):
+        '''
+        Count the references to the blobs again and delete the blobs that lost the last one.
+        '''
+        self.refcounts = dict(collections.Counter(self.index.values()))
+        self.metadata = {content_hash: metadata for content_hash, metadata in self.metadata.items() if content_hash in self.refcounts}
+        for content_hash in self.released:
+            if content_hash not in self.refcounts and os.path.exists(self.path(content_hash)):
+                os.remove(self.path(content_hash))
+        self.released = set()
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def valid_hash(content_hash):
+    '''
+    Check the hash of the client, it becomes part of a file name.
+    '''
+    return isinstance(content_hash, str) and len(content_hash) == HASH_DIGITS and \
+        all([digit in '0123456789abcdef' for digit in content_hash])
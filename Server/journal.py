@@ -0,0 +1,161 @@
+'''
+Journal of the forum server.
+
+The state of the forum kept in memory (the metadata of the threads, the index of the blobs
+and the search index) survives a restart through two kinds of files in the state directory:
+
+    snapshot.N   the state as it was when journal.N was started, pickled
+    journal.N    the operations since then, one JSON list per line
+
+Every component appends its operations to the journal under the lock it changes its state
+with, after the change. A snapshot is taken while the operations go on: the journal is
+rotated first, so every operation of the older journals is in the snapshot and the newer
+ones may be. The operations carry what a component needs to skip the ones its snapshot
+already holds, so a restart loads the latest snapshot and replays its journal and the
+later ones, instead of reading the threads. Once a snapshot is saved the older files are
+deleted.
+
+A crash may cut the last line of a journal short, the replay stops there.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import json
+import time
+import pickle
+import threading
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+SNAPSHOT = 'snapshot.'
+JOURNAL = 'journal.'
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                       JOURNAL                                                        #
+#                                                                                                                      #
+########################################################################################################################
+class Journal:
+    '''
+    The operations since the last snapshot of the state, and the snapshot.
+    '''
+    def __init__(self, root='state'):
+        self.root = root
+        self.generation = 0 # of the journal written to, and of the snapshot it follows
+        self.entries = 0 # operations in the journal written to
+        self.fd = None
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def generations(self, prefix):
+        '''
+        The generations of the snapshots or of the journals, in ascending order.
+        '''
+        return sorted([int(name[len(prefix):]) for name in os.listdir(self.root)
+                       if name.startswith(prefix) and name[len(prefix):].isdigit()])
+
+    def path(self, prefix, generation):
+        return os.path.join(self.root, '{}{}'.format(prefix, generation))
+
+    def exists(self):
+        '''
+        Check if a state was saved by an earlier run.
+        '''
+        return bool(self.generations(SNAPSHOT) or self.generations(JOURNAL))
+
+    def load(self):
+        '''
+        The latest snapshot, None if there is none, and the operations journaled since then.
+        The journal is then opened for the operations of this run.
+        '''
+        snapshots = self.generations(SNAPSHOT)
+        self.generation = snapshots[-1] if snapshots else 0
+        snapshot = None
+        if snapshots:
+            with open(self.path(SNAPSHOT, self.generation), 'rb') as f:
+                snapshot = pickle.load(f)
+
+        operations = []
+        journals = [generation for generation in self.generations(JOURNAL) if generation >= self.generation]
+        for generation in journals:
+            with open(self.path(JOURNAL, generation), 'rb') as f:
+                end = 0
+                for line in f:
+                    try:
+                        operations.append(json.loads(line))
+                    except ValueError: # cut short by a crash
+                        break
+                    end += len(line)
+            self.generation = generation
+            self.entries = len(operations)
+
+        # the next operations follow the last complete one
+        self.fd = os.open(self.path(JOURNAL, self.generation), os.O_WRONLY | os.O_CREAT, 0o644)
+        if journals:
+            os.ftruncate(self.fd, end)
+        os.lseek(self.fd, 0, os.SEEK_END)
+        return snapshot, operations
+
+    def append(self, *operation):
+        '''
+        Journal the operation.
+        '''
+        line = (json.dumps(operation, separators=(',', ':')) + '\n').encode('utf-8')
+        with self.lock:
+            os.write(self.fd, line)
+            self.entries += 1
+
+    def rotate(self):
+        '''
+        Start a new journal and return its generation, the snapshot of that generation is taken next.
+        '''
+        with self.lock:
+            os.close(self.fd)
+            self.generation += 1
+            self.entries = 0
+            self.fd = os.open(self.path(JOURNAL, self.generation), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            return self.generation
+
+    def save(self, generation, snapshot):
+        '''
+        Save the snapshot of the generation and delete the files it supersedes.
+        '''
+        path = self.path(SNAPSHOT, generation)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno()) # a crash keeps the previous snapshot until this one is whole
+        os.replace(path + '.tmp', path)
+        for prefix in [SNAPSHOT, JOURNAL]:
+            for older in self.generations(prefix):
+                if older < generation:
+                    os.remove(self.path(prefix, older))
+
+    def start(self, capture, interval):
+        '''
+        Take a snapshot with capture every interval seconds, if operations were journaled since the last one.
+        '''
+        snapshotter = threading.Thread(target=self.snapshotter, args=(capture, interval))
+        snapshotter.daemon = True # the main thread can exit when the server is stopped
+        snapshotter.start()
+
+    def snapshotter(self, capture, interval):
+        '''
+        Take the periodic snapshots, off the request path.
+        '''
+        while True:
+            time.sleep(interval)
+            if self.entries == 0:
+                continue
+            try:
+                generation = self.rotate()
+                self.save(generation, capture())
+            except OSError as e:
+                print('Snapshot of the state failed: {}'.format(e))
@@ -0,0 +1,310 @@
+'''
+Search index of the forum server.
+
+An inverted index from every term to the messages containing it, kept up to date by the
+commands that change messages: posting a message adds it, editing a message replaces it,
+deleting a message or removing its thread drops it. A message is only ever reindexed on its
+own, nothing is rebuilt.
+
+A query is a list of terms and "quoted phrases", a message matches if it contains all the
+terms and every phrase as consecutive terms. The matches are ranked with BM25, the newer
+message first on a tie, and returned a page at a time. The scan starts from the shortest
+list among the postings of the terms and the messages of the thread or user the search is
+scoped to, so a rare term or a small thread keeps a search fast whatever the size of the forum.
+Terms found in most messages would make every search rank a large part of the forum, so only
+the newest RANK_LIMIT messages containing all the terms and phrases are ranked, and the search
+tells when more matched.
+
+With a journal, every change is journaled under the lock of the index, and the index is
+restored from the snapshot and the journal instead of reading the threads again. The index
+is the largest part of the snapshot, so it is restored in the background while the server
+already answers the other commands, searches and changes wait for the lock until it is done.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import re
+import sys
+import gc
+import math
+import pickle
+import heapq
+import itertools
+import threading
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+TERM = re.compile(r'\w+') # letters, digits and underscores of any script
+QUERY = re.compile(r'"([^"]*)"?|(\S+)') # a quoted phrase, the closing quote may be missing, or a bare word
+K1 = 1.2 # BM25 saturation of the occurrences of a term
+B = 0.75 # BM25 normalisation by the length of the message
+RANK_LIMIT = 1000 # newest messages containing all the terms that are ranked, bounds the time of a search for frequent terms
+SNAPSHOT_CHUNK = 10000 # entries of a table of the index pickled at once, the restore holds the GIL for one chunk at a time
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                     SEARCH INDEX                                                     #
+#                                                                                                                      #
+########################################################################################################################
+class SearchIndex:
+    '''
+    The terms of all the messages of the forum.
+    '''
+    def __init__(self, journal=None):
+        self.journal = journal # None keeps the index of this run only
+        self.postings = {} # term -> {document id: occurrences of the term in the message}
+        self.documents = {} # document id -> (thread title, message id, username, terms of the message)
+        self.ids = {} # (thread title, message id) -> document id, ids grow with every post and edit
+        self.threads = {} # thread title -> document ids of its messages
+        self.authors = {} # username -> document ids of the messages
+        self.length = 0 # terms of all the messages, for their average length
+        self.next_id = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, title, msg_id, username, message):
+        '''
+        Index the message, a message indexed before is replaced, e.g. after an edit.
+        '''
+        terms = tokenize(message)
+        with self.lock:
+            self.record('add', title, msg_id, username, message)
+            self.insert(title, msg_id, username, terms)
+
+    def insert(self, title, msg_id, username, terms):
+        '''
+        Index the terms of the message, the caller holds the lock.
+        '''
+        self.discard((title, msg_id))
+        document = next(self.next_id)
+        self.ids[(title, msg_id)] = document
+        self.documents[document] = (title, msg_id, username, terms)
+        self.threads.setdefault(title, set()).add(document)
+        self.authors.setdefault(username, set()).add(document)
+        self.length += len(terms)
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+            postings[document] = postings.get(document, 0) + 1
+
+    def remove(self, title, msg_id):
+        '''
+        Drop the message, e.g. once it is deleted.
+        '''
+        with self.lock:
+            self.record('remove', title, msg_id)
+            self.discard((title, msg_id))
+
+    def remove_thread(self, title):
+        '''
+        Drop all the messages of the thread.
+        '''
+        with self.lock:
+            self.record('remove_thread', title)
+            self.drop_thread(title)
+
+    def drop_thread(self, title):
+        '''
+        Drop all the messages of the thread, the caller holds the lock.
+        '''
+        for document in list(self.threads.get(title, ())):
+            self.discard(self.documents[document][:2])
+
+    def discard(self, key):
+        '''
+        Drop the message of the (thread title, message id) if it is indexed, the caller holds the lock.
+        '''
+        document = self.ids.pop(key, None)
+        if document is None:
+            return
+        title, msg_id, username, terms = self.documents.pop(document)
+        for owners, name in [(self.threads, title), (self.authors, username)]:
+            owners[name].discard(document)
+            if not owners[name]:
+                del owners[name]
+        self.length -= len(terms)
+        for term in set(terms):
+            postings = self.postings[term]
+            del postings[document]
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query, title=None, username=None, offset=0, limit=10):
+        '''
+        The (thread title, message id) of the matches of the query from the offset on, at most limit
+        of them in the order of their rank, the number of the matches ranked, at most RANK_LIMIT, and
+        whether more messages matched than were ranked. The search is limited to the messages of the
+        thread and of the user if they are given.
+        '''
+        terms, phrases = parse_query(query)
+        if not terms:
+            return [], 0, False
+
+        with self.lock:
+            postings = [self.postings.get(term) for term in terms]
+            if not all(postings):
+                return [], 0, False
+
+            # scan the shortest list from the newest message on and look the messages up in the others,
+            # the postings of a term are in the order the messages were indexed
+            lists = postings + [owners.get(name, set()) for owners, name in [(self.threads, title), (self.authors, username)] if name is not None]
+            lists.sort(key=len)
+            matches = reversed(lists[0]) if isinstance(lists[0], dict) else sorted(lists[0], reverse=True)
+            for other in lists[1:]:
+                matches = filter(other.__contains__, matches)
+            if phrases: # before the cut, an older match of the phrase is found past newer matches of its terms
+                matches = filter(lambda document: all([contains(self.documents[document][3], phrase) for phrase in phrases]), matches)
+            matches = list(itertools.islice(matches, RANK_LIMIT + 1))
+            truncated = len(matches) > RANK_LIMIT
+            del matches[RANK_LIMIT:]
+            if not matches:
+                return [], 0, False
+
+            # BM25 weights the terms found in fewer messages higher
+            count = len(self.documents)
+            average = self.length / count
+            weights = [(occurrences, math.log(1 + (count - len(occurrences) + 0.5) / (len(occurrences) + 0.5))) for occurrences in postings]
+
+            def rank(document):
+                norm = K1 * (1 - B + B * len(self.documents[document][3]) / average)
+                return sum([weight * occurrences[document] * (K1 + 1) / (occurrences[document] + norm) for occurrences, weight in weights]), document
+
+            ranked = heapq.nlargest(offset + limit, matches, key=rank)[offset:]
+            return [self.documents[document][:2] for document in ranked], len(matches), truncated
+
+    def record(self, *operation):
+        '''
+        Journal the change, the caller holds the lock.
+        '''
+        if self.journal is not None:
+            self.journal.append('search', *operation)
+
+    def tables(self):
+        '''
+        The tables of the index besides the postings.
+        '''
+        return [self.documents, self.ids, self.threads, self.authors]
+
+    def snapshot(self):
+        '''
+        The whole index, pickled in chunks. The lock is only held to copy the tables.
+        '''
+        with self.lock:
+            postings = {term: documents.copy() for term, documents in self.postings.items()}
+            documents, ids = self.documents.copy(), self.ids.copy() # their values are never changed in place
+            threads = {title: owned.copy() for title, owned in self.threads.items()}
+            authors = {username: owned.copy() for username, owned in self.authors.items()}
+            length = self.length
+        return [length, chunks(postings_items(postings), len)] + [chunks(table.items()) for table in [documents, ids, threads, authors]]
+
+    def restore(self, state, operations):
+        '''
+        Load the index from a snapshot, None if there is none, and replay its journaled changes in the
+        background. The lock is held until the index is complete.
+        '''
+        self.lock.acquire()
+        loader = threading.Thread(target=self.load, args=(state, operations))
+        loader.daemon = True # the main thread can exit when the server is stopped
+        loader.start()
+
+    def load(self, state, operations):
+        '''
+        Load the index in the thread started by restore, then release the lock.
+        '''
+        gc.disable() # a collection would go through the loaded index again and again, none of it is garbage
+        try:
+            if state is not None:
+                self.length = state[0]
+                for part in state[1]:
+                    for term, postings in pickle.loads(part):
+                        if term in self.postings:
+                            self.postings[term].update(postings)
+                        else:
+                            self.postings[term] = postings
+                for table, parts in zip(self.tables(), state[2:]):
+                    for part in parts:
+                        table.update(pickle.loads(part))
+                self.next_id = itertools.count(max(self.documents, default=0) + 1)
+            for operation in operations:
+                self.replay(operation)
+        finally:
+            gc.enable()
+            self.lock.release()
+
+    def replay(self, operation):
+        '''
+        Apply a journaled change, the caller holds the lock. The changes replace or drop messages,
+        so the ones the snapshot holds already change nothing.
+        '''
+        name, title = operation[0], operation[1]
+        if name == 'add':
+            msg_id, username, message = operation[2:]
+            self.insert(title, msg_id, username, tokenize(message))
+        elif name == 'remove':
+            self.discard((title, operation[2]))
+        elif name == 'remove_thread':
+            self.drop_thread(title)
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def tokenize(text):
+    '''
+    The terms of the text in their order, lower case. The terms are interned, so the messages
+    share one copy of every term.
+    '''
+    return tuple([sys.intern(term) for term in TERM.findall(text.lower())])
+
+def parse_query(query):
+    '''
+    The distinct terms of the query and its phrases of more than one term, a word like e-mail is a phrase too.
+    '''
+    terms, phrases = [], []
+    for phrase, word in QUERY.findall(query):
+        words = tokenize(phrase if phrase else word)
+        if len(words) > 1:
+            phrases.append(words)
+        terms.extend([term for term in words if term not in terms])
+    return terms, phrases
+
+def chunks(items, size=lambda value: 1):
+    '''
+    The (key, value) items pickled in chunks of SNAPSHOT_CHUNK entries, an item has size entries.
+    '''
+    parts, part, entries = [], [], 0
+    for item in items:
+        part.append(item)
+        entries += size(item[1])
+        if entries >= SNAPSHOT_CHUNK:
+            parts.append(pickle.dumps(part, protocol=pickle.HIGHEST_PROTOCOL))
+            part, entries = [], 0
+    if part:
+        parts.append(pickle.dumps(part, protocol=pickle.HIGHEST_PROTOCOL))
+    return parts
+
+def postings_items(postings):
+    '''
+    The (term, part of its postings) items of the postings, a frequent term is split into parts of SNAPSHOT_CHUNK.
+    '''
+    for term, documents in postings.items():
+        if len(documents) <= SNAPSHOT_CHUNK:
+            yield term, documents
+        else:
+            documents = iter(documents.items())
+            for _ in range(0, len(postings[term]), SNAPSHOT_CHUNK):
+                yield term, dict(itertools.islice(documents, SNAPSHOT_CHUNK))
+
+def contains(terms, phrase):
+    '''
+    Check if the phrase occurs in the terms of a message.
+    '''
+    first, size = phrase[0], len(phrase)
+    return any([terms[position:position + size] == phrase for position, term in enumerate(terms) if term == first])
@@ -3,7 +3,10 @@ Created Mar 15, 2022
 
 @author: Wang Liao, z5306312
 
-Usage: python3 server.py [port]
+Usage: python3 server.py [port] [--engine thread|asyncio|pool] [--workers N] [--queue-size N]
+                         [--backlog N] [--stats SECONDS] [--compact-ratio RATIO] [--chunk-size BYTES]
+                         [--response-cache BYTES] [--storage files|sqlite] [--snapshot-interval SECONDS]
+                         [--reset-db]
 
 Python 3.9.7
 '''
@@ -15,11 +18,29 @@ Python 3.9.7
 ########################################################################################################################
 import os
 import sys
+import gc
 import threading
+import asyncio
+import queue
 import json
 import time
+import struct
+import itertools
+import secrets
+import hashlib
+import zlib
+import lzma
+import bz2
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from socket import *
 from _thread import *
+from storage import STORAGES
+from thread_store import ThreadStore
+from sqlite_store import SqliteStore
+from blob_store import BlobStore, valid_hash
+from journal import Journal
+from search_index import SearchIndex
 
 ########################################################################################################################
 #                                                                                                                      #
@@ -27,11 +48,112 @@ from _thread import *
 #                                                                                                                      #
 ########################################################################################################################
 PORT = None
+USAGE = '''Usage: python3 server.py [port] [--engine thread|asyncio|pool] [--workers N] [--queue-size N]
+                         [--backlog N] [--stats SECONDS] [--compact-ratio RATIO] [--chunk-size BYTES]
+                         [--response-cache BYTES] [--storage files|sqlite] [--snapshot-interval SECONDS]
+                         [--reset-db]'''
+ENGINES = ['thread', 'asyncio', 'pool']
+ORDERED_ENGINES = ['pool'] # engines running the requests of one client in the order they arrive
+options = {
+    'engine': 'thread',
+    'storage': 'files', # backend of the threads, see storage.py
+    'workers': 8, # worker threads of the pool and asyncio engines
+    'queue-size': 16, # pending requests one client may have queued in the pool
+    'backlog': 1024, # pending requests of all clients before the pool and asyncio engines answer BUSY
+    'stats': 0, # seconds between two pool statistics reports, 0 to disable
+    'compact-ratio': 0.5, # share of dead records in a thread log that triggers its compaction
+    'chunk-size': 1 << 18, # bytes of an uploaded file received at once
+    'response-cache': 16 << 20, # bytes of encoded LST and RDT responses kept for identical requests, 0 to disable
+    'snapshot-interval': 60, # seconds between two snapshots of the state of the files backend, 0 to keep no state across restarts
+    'reset-db': False, # a flag, delete the threads of the SQLite database at startup
+}
+STATE_ROOT = 'state' # directory of the snapshots and the journal, see journal.py
+TRANSACTION_TIMEOUT = 60 # seconds a handler waits for the follow-up datagram of its client
+SESSION_TIMEOUT = 1800 # seconds without a request before a session expires and its user is logged out
+SESSION_BITS = 64 # bits of a session id, it stands for the username and the password in every request after AUTH
+PUSH_INTERVAL = 0.5 # seconds the events of a burst are coalesced before they are pushed to the subscribers
+PUSH_SIZE = 8192 # bytes of events per pushed datagram before compression
+SEARCH_PAGE = 10 # results of a SRC request that does not give a limit
+MAX_SEARCH_PAGE = 100 # results of a SRC request at most
+MAX_READ_PAGE = 1000 # records of an RDT request at most, without a limit the whole thread is read
+REQUEST_FIELDS = {
+    'AUTH': ['username'], 'CRT': ['thread_title'], 'MSG': ['thread_title'], 'DLT': ['thread_title'], 'RDT': ['thread_title'],
+    'EDT': ['thread_title'], 'UPD': ['thread_title', 'file_name'], 'DWN': ['thread_title', 'file_name'], 'RMV': ['thread_title'],
+    'SUB': ['thread_title'], 'UNSUB': ['thread_title'],
+} # text fields the handler of every command reads, the other fields are checked by the handlers
+MAX_DATAGRAM = 65535
+FRAGMENT_SIZE = 1024 # bytes of payload per fragment, larger messages are split
+FRAGMENT_MAGIC = b'FRG'
+FRAGMENT_HEADER = struct.Struct('!3sIHH') # magic, message id, fragment index, fragment count
+REASSEMBLY_LIMIT = 1 << 20 # bytes of incomplete requests buffered at most
+REASSEMBLY_TIMEOUT = 30 # seconds before the fragments of an incomplete request are dropped
+SENT_LIMIT = 16 << 20 # bytes of fragmented responses kept for selective retransmission
+REPLY_LIMIT = 16 << 20 # bytes of replies kept to answer retransmitted requests
+TRANSFER_TIMEOUT = 30 # seconds a transfer token waits for its TCP connection
+TOKEN_SIZE = 16 # bytes of a transfer token, the client sends it first on the TCP connection
+DATA_BACKLOG = 128 # TCP connections waiting to be accepted by the data listener
+ACCEPT_RETRY = 0.1 # seconds the data listener waits after a failed accept, e.g. out of file descriptors
+TRANSFER_BUFFER = 1 << 20 # bytes per read of a file sent without os.sendfile
+RANGE_HEADER = struct.Struct('!QQ') # offset and length of the bytes of a file, sent before them
+MAX_STREAMS = 16 # TCP connections of one download
+DIGEST_CHUNK = 4 << 20 # bytes of a file covered by one chunk digest, a corrupted chunk is sent again on its own
+DIGEST_ALGORITHMS = ['crc32', 'blake2b', 'sha256']
+TRANSFER_ID_DIGITS = 32 # hex digits of a transfer id, it names the partial file of a transfer
+COMPRESSIONS = { # name -> (compress, decompressor factory)
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompressobj), # the fastest level keeps up with the link
+    'lzma': (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor),
+    'bz2': (bz2.compress, bz2.BZ2Decompressor),
+}
+COMPRESSION_NAMES = [None, 'zlib', 'lzma', 'bz2'] # 0 is no compression
+COMPRESSION_CODES = {name: code for code, name in enumerate(COMPRESSION_NAMES) if name is not None}
+DECOMPRESSION_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError)
+COMPRESSED_MAGIC = 0xC5 # first byte of a compressed message
+COMPRESSED_HEADER = struct.Struct('!BBII') # magic, compression code, request id, size of the message before compression
+COMPRESSION_THRESHOLD = FRAGMENT_SIZE # bytes of a message above which it is compressed, smaller ones fit in one datagram
+COMPRESSION_FRAME = 1 << 18 # bytes of a file compressed at once in a compressed range
+FRAME_HEADER = struct.Struct('!II') # size of a frame before and after compression, equal if it is sent as it is
+COMPRESSION_SAMPLE = 1 << 16 # bytes compressed at the start, the middle and the end of a file to estimate its ratio
+COMPRESSIBLE_RATIO = 0.9 # a file whose samples compress worse than this is sent as it is
+CODECS = ['binary', 'json'] # in the order of preference
+BINARY_MAGIC = 0xB1 # first byte of a binary message, a json message starts with '{'
+BINARY_HEADER = struct.Struct('!BBIQ') # magic, command code, request id, session id
+REQUEST_ID_OFFSET = 2 # of the request id in the binary and the compressed headers, after the magic and a code
+VALUE_HEADER = struct.Struct('!BI') # type, length
+HEADER_FIELDS = ['command', 'request_id', 'session_id']
+TYPE_NONE, TYPE_BOOL, TYPE_INT, TYPE_FLOAT, TYPE_STR, TYPE_LIST, TYPE_DICT = range(7)
+COMMAND_NAMES = [None, 'AUTH', 'CRT', 'LST', 'MSG', 'DLT', 'RDT', 'EDT', 'UPD', 'DWN', 'RMV', 'XIT', 'NACK',
+                 'SUB', 'UNSUB', 'SRC'] # 0 is a response
+COMMAND_CODES = {name: code for code, name in enumerate(COMMAND_NAMES) if name is not None}
+FIELD_NAMES = [None, 'username', 'password', 'thread_title', 'message', 'message_id', 'file_name', 'file_size',
+               'status', 'type', 'threads', 'messages', 'since_id', 'version', 'limit', 'next_cursor', 'more',
+               'reset', 'retry_after', 'step', 'codecs', 'codec', 'missing', 'token', 'transfer_id',
+               'offset', 'streams', 'tokens', 'digest_algorithm', 'digests', 'ranges',
+               'content_hash', 'compressions', 'compression', 'event_port', 'events', 'query', 'author',
+               'results', 'total', 'truncated', 'ordered'] # 0 is a field carrying its own name
+FIELD_CODES = {name: code for code, name in enumerate(FIELD_NAMES) if name is not None}
 clients = set()
-threads = []
+transactions = {} # (client address, request id) -> queue of follow-up datagrams
+transactions_lock = threading.Lock()
+transfers = {} # transfer token -> queue the TCP connection of the transfer is handed over through
+transfers_lock = threading.Lock()
+message_ids = itertools.count(1) # ids of the fragmented messages
+sent_fragments = OrderedDict() # (client address, message id) -> fragments, oldest first
+sent_fragments_size = 0
+sent_fragments_lock = threading.Lock()
+reassembler = None # fragments of incomplete requests
+reply_cache = None # replies of the recent requests
+notifier = None # subscriptions to the changes of threads
+response_cache = None # encoded LST and RDT responses
+sessions = OrderedDict() # session id -> {'username', 'codec', 'address', 'last_used'}, least recently used first
+sessions_lock = threading.Lock()
+client_codecs = {} # client address -> codec of its last request, the response uses the same codec
+client_compressions = {} # client address -> compression of its session, for the large responses
+thread_store = None
 users = {}
-online_users = [] 
-files = [] 
+online_users = {} # username -> session id of the logged in users
+blob_store = None # the uploaded files, stored once per content
+search_index = None # the terms of all the messages
+journal = None # operations since the last snapshot of the state
 
 ########################################################################################################################
 #                                                                                                                      #
@@ -42,17 +164,47 @@ def port_checker():
     '''
     Check if the port number is valid.
     '''
-    if len(sys.argv) != 2:
-        print('Usage: python3 server.py [port]')
+    if len(sys.argv) < 2:
+        print(USAGE)
         exit()
 
     port = int(sys.argv[1])
     if port < 1024 or port > 65535:
-        print('Usage: python3 server.py [port]')
+        print(USAGE)
         exit()
 
     return port
 
+def option_parser():
+    '''
+    Parse the optional switches given after the port, e.g. --engine asyncio.
+    '''
+    args = sys.argv[2:]
+    while args:
+        name = args.pop(0)
+        if not name.startswith('--') or name[2:] not in options:
+            print(USAGE)
+            exit()
+
+        # a flag takes no value, e.g. --reset-db
+        if isinstance(options[name[2:]], bool):
+            options[name[2:]] = True
+            continue
+        if not args:
+            print(USAGE)
+            exit()
+
+        # the value takes the type of the default, e.g. --workers 16 becomes an int
+        try:
+            options[name[2:]] = type(options[name[2:]])(args.pop(0))
+        except ValueError:
+            print(USAGE)
+            exit()
+
+    if options['engine'] not in ENGINES or options['storage'] not in STORAGES:
+        print(USAGE)
+        exit()
+
 def process_credentials():
     '''
     Process the credentials file.
@@ -68,6 +220,65 @@ def process_credentials():
             user_info = user_info.strip().split(' ')
             users[user_info[0]] = user_info[1]
 
+def storage_startup():
+    '''
+    Open the backend of the threads. The SQLite database is durable on its own and keeps its threads
+    and the files they refer to without a journal, the journal only restores what the files backend
+    keeps in memory.
+    '''
+    if options['storage'] == 'sqlite':
+        return SqliteStore(reset=options['reset-db'])
+    return ThreadStore(compact_ratio=options['compact-ratio'], journal=journal)
+
+def restore_state():
+    '''
+    Restore the threads, the uploaded files and the search index from the last snapshot and the journal.
+    '''
+    start = time.perf_counter()
+    gc.disable() # a collection would go through the restored state again and again, none of it is garbage
+    try:
+        snapshot, operations = journal.load()
+        if snapshot is not None and snapshot['storage'] != options['storage']:
+            print('The state in {} was saved with --storage {}'.format(STATE_ROOT, snapshot['storage']))
+            exit()
+        if snapshot is not None:
+            thread_store.restore(snapshot['threads'])
+            blob_store.restore(snapshot['blobs'])
+        components = {'threads': thread_store, 'blobs': blob_store}
+        searches = []
+        for operation in operations:
+            if operation[0] == 'search':
+                searches.append(operation[1:])
+            else:
+                components[operation[0]].replay(operation[1:])
+        thread_store.replayed()
+        blob_store.replayed()
+    finally:
+        gc.enable()
+    search_index.restore(snapshot['search'] if snapshot is not None else None, searches) # in the background
+    print('Restored {} threads and {} journaled operations in {:.3f} s'.format(
+        len(thread_store.titles()), len(operations), time.perf_counter() - start))
+
+def rebuild_search():
+    '''
+    Index the messages kept by a durable storage backend again, in the background as a restore does.
+    '''
+    messages = thread_store.messages()
+    if messages is not None:
+        search_index.restore(None, (('add',) + message for message in messages))
+        print('Indexing the messages of {} threads in the background'.format(len(thread_store.titles())))
+
+def capture_state():
+    '''
+    The snapshot of the state, taken while the requests go on.
+    '''
+    return {
+        'storage': options['storage'],
+        'threads': thread_store.snapshot(),
+        'blobs': blob_store.snapshot(),
+        'search': search_index.snapshot(),
+    }
+
 def server_startup(port):
     '''
     Start up the server.
@@ -91,74 +302,1422 @@ def server_startup(port):
 
     udp_socket.close()
 
+def data_listener_startup(port):
+    '''
+    Start the TCP listener of the file transfers, it serves the transfers of every engine.
+    '''
+    tcp_socket = socket(AF_INET, SOCK_STREAM)
+    tcp_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    tcp_socket.bind(('', port))
+    tcp_socket.listen(DATA_BACKLOG)
+
+    listener = threading.Thread(target=data_listener, args=(tcp_socket,))
+    listener.daemon = True # the main thread can exit when the server is stopped
+    listener.start()
+
+def data_listener(tcp_socket):
+    '''
+    Accept the TCP connections of the file transfers, a failed connection must not stop the listener.
+    '''
+    while True:
+        try:
+            tcp_client_socket, tcp_client_address = tcp_socket.accept()
+        except OSError as e: # e.g. out of file descriptors, or reset before it was accepted
+            print('Accepting a file transfer failed: {}'.format(e))
+            time.sleep(ACCEPT_RETRY)
+            continue
+
+        # the token is read off the accepting thread, a slow client does not hold up the others
+        try:
+            thread = threading.Thread(target=route_transfer, args=(tcp_client_socket,))
+            thread.daemon = True
+            thread.start()
+        except RuntimeError as e: # no thread can be started for the connection
+            print('Refused a file transfer: {}'.format(e))
+            tcp_client_socket.close()
+
+def pool_server_startup(port):
+    '''
+    Start up the server with a fixed pool of workers.
+    '''
+    # create a UDP socket
+    udp_socket = socket(AF_INET, SOCK_DGRAM)
+    udp_socket.bind(('', port))
+    udp_socket.settimeout(5)
+
+    pool = WorkerPool(udp_socket, options['workers'], options['queue-size'], options['backlog'])
+    if options['stats'] > 0:
+        monitor = threading.Thread(target=pool_monitor, args=(pool, options['stats']))
+        monitor.daemon = True
+        monitor.start()
+    print("Waiting for clients")
+
+    while True:
+        try:
+            data, add = udp_receive_data(udp_socket)
+            clients.add(add)
+
+            # the queues are full, tell the client when to retry instead of queueing more work
+            if not pool.submit(data, add):
+                reply_cache.forget((add, data.get('request_id')))
+                response = {
+                    'status': 'BUSY',
+                    'request_id': data.get('request_id'),
+                    'retry_after': pool.retry_after(),
+                }
+                udp_send_response(udp_socket, response, add)
+
+        except timeout:
+            pass
+
+    udp_socket.close()
+
+def pool_monitor(pool, interval):
+    '''
+    Print the statistics of the pool every interval seconds.
+    '''
+    while True:
+        time.sleep(interval)
+        print('Pool: {busy}/{workers} workers busy, utilisation {utilisation:.0%}, {queued} queued for {clients} clients '
+              '(deepest {deepest}), {served} served, {rejected} rejected'.format(**pool.stats()))
+
+async def asyncio_server_startup(port):
+    '''
+    Start up the server on a single asyncio event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(lambda: ForumProtocol(loop), local_addr=('0.0.0.0', port))
+    print("Waiting for clients")
+
+    try:
+        await loop.create_future() # serve until the server is stopped
+    finally:
+        transport.close()
+
+class ForumProtocol(asyncio.DatagramProtocol):
+    '''
+    The asyncio engine: every datagram is read on the event loop and its command handler
+    runs as a task in an executor of --workers threads instead of in a thread of its own.
+    An AUTH, UPD or DWN holds its thread while it waits for the follow-ups of the client,
+    so once --backlog requests are pending the requests are answered BUSY as by the pool.
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.executor = ThreadPoolExecutor(max_workers=options['workers'])
+        self.pending = 0 # requests submitted and not finished, only used on the event loop
+        self.busy_time = 0.0
+        self.served = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, add):
+        data = udp_accept(self.transport, data, add)
+        if data is None:
+            return
+
+        clients.add(add)
+        endpoint = ClientEndpoint(self, add)
+
+        # the executor queue is not bounded, tell the client when to retry instead of queueing more work
+        if self.pending >= options['backlog']:
+            reply_cache.forget((add, data.get('request_id')))
+            response = {
+                'status': 'BUSY',
+                'request_id': data.get('request_id'),
+                'retry_after': self.retry_after(),
+            }
+            udp_send_response(self.transport, response, add)
+            return
+
+        self.pending += 1
+        task = self.loop.run_in_executor(self.executor, self.handle, endpoint, data, add)
+        task.add_done_callback(self.finished)
+
+    def handle(self, endpoint, data, add):
+        '''
+        Run the command handler of the request in the executor, return its duration.
+        '''
+        start = time.time()
+        try:
+            client_handler(endpoint, data, add)
+        except Exception as e:
+            print('{} command failed: {}'.format(data.get('command'), e))
+        return time.time() - start
+
+    def finished(self, task):
+        '''
+        Count the request as served, called on the event loop.
+        '''
+        self.pending -= 1
+        self.busy_time += task.result()
+        self.served += 1
+
+    def retry_after(self):
+        '''
+        Seconds until the pending requests are likely to be served.
+        '''
+        service_time = self.busy_time / self.served if self.served else 0.01
+        return round(max(0.1, service_time * self.pending / options['workers']), 2)
+
+class ClientEndpoint:
+    '''
+    Socket-like view of the asyncio transport for one client, so the command
+    handlers can keep calling sendto.
+    '''
+    def __init__(self, protocol, add):
+        self.protocol = protocol
+        self.add = add
+
+    def sendto(self, data, add):
+        # the transport belongs to the event loop, the handler runs in an executor thread
+        self.protocol.loop.call_soon_threadsafe(self.protocol.transport.sendto, data, add)
+
+class WorkerPool:
+    '''
+    A fixed number of workers serving per-client FIFO queues. The requests of one client
+    run in order, the requests of different clients run in parallel. Once a request of a client
+    is answered BUSY, its later requests are answered BUSY too until it is sent again, so a
+    request never runs before the requests the client sent earlier.
+    '''
+    def __init__(self, udp_socket, workers, queue_size, backlog):
+        self.udp_socket = udp_socket
+        self.workers = workers
+        self.queue_size = queue_size
+        self.backlog = backlog
+        self.lock = threading.Lock()
+        self.queues = {} # client address -> deque of its pending requests, present while the client is scheduled
+        self.stalled = {} # client address -> id of its oldest request answered BUSY, until it is queued
+        self.ready = queue.Queue() # clients with pending requests that no worker is serving
+        self.queued = 0
+        self.busy = 0
+        self.busy_time = 0.0
+        self.served = 0
+        self.rejected = 0
+        self.started = time.time()
+
+        for _ in range(workers):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True # the main thread can exit when the server is stopped
+            worker.start()
+
+    def submit(self, data, add):
+        '''
+        Queue the request of the client, False if its queue or the backlog is full or an earlier request of the client was rejected.
+        '''
+        request_id = data.get('request_id')
+        numbered = isinstance(request_id, int) and not isinstance(request_id, bool)
+        with self.lock:
+            client_queue = self.queues.get(add)
+            stalled = self.stalled.get(add)
+            if numbered and stalled is not None and request_id > stalled:
+                self.rejected += 1
+                return False
+            if self.queued >= self.backlog or (client_queue is not None and len(client_queue) >= self.queue_size):
+                self.rejected += 1
+                if numbered and (stalled is None or request_id < stalled):
+                    self.stalled[add] = request_id
+                return False
+            if numbered and request_id == stalled:
+                del self.stalled[add]
+
+            # a client without a queue is not scheduled yet
+            if client_queue is None:
+                client_queue = self.queues[add] = deque()
+                self.ready.put(add)
+            client_queue.append(data)
+            self.queued += 1
+        return True
+
+    def worker(self):
+        '''
+        Serve one request of the next ready client at a time.
+        '''
+        while True:
+            add = self.ready.get()
+            with self.lock:
+                data = self.queues[add].popleft()
+                self.queued -= 1
+                self.busy += 1
+
+            start = time.time()
+            try:
+                client_handler(self.udp_socket, data, add)
+            except Exception as e:
+                print('{} command failed: {}'.format(data.get('command'), e))
+
+            with self.lock:
+                self.busy -= 1
+                self.busy_time += time.time() - start
+                self.served += 1
+
+                # go to the back of the line so one busy client cannot starve the others
+                if self.queues[add]:
+                    self.ready.put(add)
+                else:
+                    del self.queues[add]
+
+    def retry_after(self):
+        '''
+        Seconds until the queued requests are likely to be served.
+        '''
+        with self.lock:
+            service_time = self.busy_time / self.served if self.served else 0.01
+            return round(max(0.1, service_time * self.queued / self.workers), 2)
+
+    def stats(self):
+        '''
+        Queue depths and worker utilisation, used to size the pool.
+        '''
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'utilisation': self.busy_time / (self.workers * (time.time() - self.started)),
+                'queued': self.queued,
+                'clients': len(self.queues),
+                'deepest': max([len(q) for q in self.queues.values()], default=0),
+                'served': self.served,
+                'rejected': self.rejected,
+            }
+
 def client_handler(client_udp_socket, data, add):
     ''' 
     Handle the client requests.
     '''
-    global threads
+    global thread_store
     global users
     global online_users
-    global files
+    global blob_store
 
     user, command = data['username'], data['command']
+    client_udp_socket = RequestSocket(client_udp_socket, data.get('request_id'))
 
     if command != 'AUTH':
         print("{} issued {} command".format(user, command))
 
-    if command == 'AUTH':
-        users, online_users = AUTH_USER(data, add, users, online_users, client_udp_socket)
-        return
-    elif command == 'CRT':
-        threads = CREATE_THREAD(data, add, threads, client_udp_socket)
-        return
-    elif command == 'LST':
-        LIST_THREADS(threads, add, client_udp_socket)
-        return
-    elif command == 'MSG':
-        POST_MESSAGE(data, add, threads, client_udp_socket)
-        return
-    elif command == 'DLT':
-        DELETE_MESSAGE(data, add, threads, client_udp_socket)
-        return
-    elif command == 'RDT':
-        READ_THREAD(data, add, threads, client_udp_socket)
-        return
-    elif command == 'EDT':
-        EDIT_MESSAGE(data, add, threads, client_udp_socket)
+    try:
+        # a request without a text field its handler reads, or with one of another type, never reaches the handler
+        if not all([isinstance(data.get(name), str) for name in REQUEST_FIELDS.get(command, [])]):
+            print('Invalid {} request from {}'.format(command, add))
+            udp_send_response(client_udp_socket, {'status': 'FAIL'}, add)
+            return
+        elif command == 'AUTH':
+            users, online_users = AUTH_USER(data, add, users, online_users, client_udp_socket)
+            return
+        elif command == 'CRT':
+            thread_store = CREATE_THREAD(data, add, thread_store, client_udp_socket)
+            return
+        elif command == 'LST':
+            LIST_THREADS(thread_store, add, client_udp_socket)
+            return
+        elif command == 'MSG':
+            POST_MESSAGE(data, add, thread_store, client_udp_socket)
+            return
+        elif command == 'DLT':
+            DELETE_MESSAGE(data, add, thread_store, client_udp_socket)
+            return
+        elif command == 'RDT':
+            READ_THREAD(data, add, thread_store, client_udp_socket)
+            return
+        elif command == 'EDT':
+            EDIT_MESSAGE(data, add, thread_store, client_udp_socket)
+            return
+        elif command == 'UPD':
+            blob_store = UPLOAD_FILE(data, add, blob_store, thread_store, client_udp_socket)
+            return
+        elif command == 'DWN':
+            DOWNLOAD_FILE(data, add, thread_store, blob_store, client_udp_socket)
+            return
+        elif command == 'RMV':
+            thread_store = REMOVE_THREAD(data, add, thread_store, blob_store, client_udp_socket)
+            return
+        elif command == 'XIT':
+            online_users = EXIT_USER(data, add, online_users, client_udp_socket)
+            return
+        elif command == 'SUB':
+            SUBSCRIBE_THREAD(data, add, thread_store, client_udp_socket)
+            return
+        elif command == 'UNSUB':
+            UNSUBSCRIBE_THREAD(data, add, client_udp_socket)
+            return
+        elif command == 'SRC':
+            SEARCH_MESSAGES(data, add, thread_store, client_udp_socket)
+            return
+    finally:
+        # a request that failed before replying can be retried by the client
+        reply_cache.finish((add, data.get('request_id')))
+
+class RequestSocket:
+    '''
+    The server socket as seen by the handler of one request. It only carries the id of the
+    request: udp_send_response and udp_send_encoded stamp that id into the responses sent
+    through it and keep the last one in the reply cache, sendto itself sends the datagram as is.
+    '''
+    def __init__(self, udp_soc, request_id):
+        self.udp_soc = udp_soc
+        self.request_id = request_id
+
+    def sendto(self, data, add):
+        self.udp_soc.sendto(data, add)
+
+def vanished_status(thread_store, thread_title):
+    '''
+    The status of a request whose thread or message was removed while it ran, e.g. by a concurrent RMV or DLT.
+    '''
+    if not thread_store.exists(thread_title):
+        print('Thread {} does not exist'.format(thread_title))
+        return 'NO_THREAD'
+    print('Message does not exist')
+    return 'NO_MSG'
+
+def record_upload(thread_store, blob_store, thread_title, username, file_name):
+    '''
+    Record the upload of a stored file in its thread, FAIL if a RMV removed the thread meanwhile.
+    '''
+    try:
+        thread_store.upload(thread_title, username, file_name)
+        return 'OK'
+    except KeyError:
+        print('Thread {} does not exist'.format(thread_title))
+        blob_store.remove_thread(thread_title) # the file stored after the RMV dropped the files of the thread
+        return 'FAIL'
+
+def message_id(data):
+    '''
+    The message id of the request, 0 (no message) if it is not a number.
+    '''
+    value = data.get('message_id')
+    if isinstance(value, bool) or not isinstance(value, (int, str)): # e.g. a list, int() would raise TypeError
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+def udp_send_response(udp_soc, response, client_add):
+    ''' 
+    Send the response to the client.
+    '''
+    request_id = getattr(udp_soc, 'request_id', None)
+    if request_id is None:
+        request_id = response.get('request_id')
+    udp_send_encoded(udp_soc, encode_response(response, client_add), client_add, request_id)
+    # print('Sent response {} to client'.format(response))
+
+def udp_send_encoded(udp_soc, encoded, client_add, request_id):
+    '''
+    Send a response encoded by encode_response to the client, with the request id put in.
+    '''
+    payload = stamp_response(encoded, request_id)
+
+    # the last reply of a request is replayed if the client retransmits the request
+    if getattr(udp_soc, 'request_id', None) is not None:
+        reply_cache.store((client_add, udp_soc.request_id), payload)
+    udp_send_payload(udp_soc, payload, client_add)
+
+def encode_response(response, client_add):
+    '''
+    Encode the response without its request id, with the codec and the compression of the client.
+    The same encoded response answers any request, stamp_response puts the request id in.
+    '''
+    response = {name: value for name, value in response.items() if name != 'request_id'}
+    return compress_message(encode_message(response, client_codecs.get(client_add, 'json')), client_compressions.get(client_add))
+
+def stamp_response(encoded, request_id):
+    '''
+    The encoded response with the request id, without encoding it again. A compressed or binary
+    response has a request id field in its header, a json response gets it as its last field.
+    '''
+    if request_id is None:
+        return encoded
+    if encoded[0] in [COMPRESSED_MAGIC, BINARY_MAGIC]:
+        if not isinstance(request_id, int) or not 0 <= request_id < 1 << 32:
+            return encoded
+        payload = bytearray(encoded)
+        struct.pack_into('!I', payload, REQUEST_ID_OFFSET, request_id)
+        return bytes(payload)
+    return encoded[:-1] + ', "request_id": {}}}'.format(json.dumps(request_id)).encode('utf-8')
+
+def udp_send_payload(udp_soc, payload, client_add):
+    '''
+    Send the payload in one datagram, or split it into numbered fragments if it is too large.
+    The fragments are kept for a while so the client can ask for the ones it missed.
+    '''
+    global sent_fragments_size
+    if len(payload) <= FRAGMENT_SIZE:
+        udp_soc.sendto(payload, client_add)
         return
-    elif command == 'UPD':
-        files = UPLOAD_FILE(data, add, files, threads, client_udp_socket)
+
+    message_id = next(message_ids) & 0xFFFFFFFF
+    total = (len(payload) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+    fragments = [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, message_id, index, total) + payload[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+                 for index in range(total)]
+
+    with sent_fragments_lock:
+        sent_fragments[(client_add, message_id)] = fragments
+        sent_fragments_size += len(payload)
+        while sent_fragments_size > SENT_LIMIT and len(sent_fragments) > 1:
+            _, evicted = sent_fragments.popitem(last=False)
+            sent_fragments_size -= sum([len(fragment) - FRAGMENT_HEADER.size for fragment in evicted])
+
+    for fragment in fragments:
+        udp_soc.sendto(fragment, client_add)
+
+def resend_fragments(udp_soc, data, add):
+    '''
+    Retransmit the fragments the client reported missing in its NACK.
+    '''
+    with sent_fragments_lock:
+        fragments = sent_fragments.get((add, data['message_id']))
+    if fragments is None:
+        print('Fragments of message {} to {} are no longer available'.format(data['message_id'], add))
         return
-    elif command == 'DWN':
-        DOWNLOAD_FILE(data, add, threads, files, client_udp_socket)
+
+    for index in data['missing']:
+        if 0 <= index < len(fragments):
+            udp_soc.sendto(fragments[index], add)
+
+def handle_control(udp_soc, data, add):
+    '''
+    Handle the datagrams the receiver answers itself instead of dispatching them to a handler.
+    '''
+    if data.get('command') == 'NACK':
+        resend_fragments(udp_soc, data, add)
+        return True
+
+    if route_followup(udp_soc, data, add):
+        return True
+
+    # a retransmitted request replays the reply of the first copy, or is dropped while the first copy still runs
+    if data.get('request_id') is not None:
+        duplicate, reply = reply_cache.begin((add, data['request_id']))
+        if duplicate:
+            if reply is not None:
+                udp_send_payload(udp_soc, reply, add)
+            return True
+
+    # the session of the request is unknown, e.g. the server restarted since the login
+    if 'username' not in data:
+        response = {
+            'status': 'NO_SESSION',
+            'request_id': data.get('request_id'),
+        }
+        udp_send_response(udp_soc, response, add)
+        return True
+    return False
+
+class Notifier:
+    '''
+    Pushes the changes of threads to the sessions subscribed to them. The handlers queue the events
+    and a thread of its own sends them, the events of a burst are coalesced into one datagram per
+    subscriber every interval, or a few if they are larger than PUSH_SIZE, fragmented like the replies.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self.subscriptions = {} # thread title -> {session id: (event address, session address)}
+        self.pending = {} # (event address, session address) -> events not pushed yet
+        self.lock = threading.Lock()
+        self.ready = threading.Event() # set while events are pending
+        self.udp_soc = socket(AF_INET, SOCK_DGRAM) # pushes never mix with the replies of the request socket
+
+        pusher = threading.Thread(target=self.pusher)
+        pusher.daemon = True # the main thread can exit when the server is stopped
+        pusher.start()
+
+    def subscribe(self, title, session_id, event_address, session_address):
+        '''
+        Push the changes of the thread to the event address of the session.
+        '''
+        with self.lock:
+            self.subscriptions.setdefault(title, {})[session_id] = (event_address, session_address)
+
+    def unsubscribe(self, title, session_id):
+        '''
+        Stop pushing the changes of the thread to the session, False if it was not subscribed.
+        '''
+        with self.lock:
+            if session_id not in self.subscriptions.get(title, {}):
+                return False
+            self.remove(title, session_id)
+            return True
+
+    def drop_session(self, session_id):
+        '''
+        Forget the subscriptions of a closed session.
+        '''
+        with self.lock:
+            for title in [title for title, subscribers in self.subscriptions.items() if session_id in subscribers]:
+                self.remove(title, session_id)
+
+    def drop_thread(self, title):
+        '''
+        Forget the subscriptions of a removed thread.
+        '''
+        with self.lock:
+            self.subscriptions.pop(title, None)
+
+    def remove(self, title, session_id):
+        '''
+        Drop one subscription, the caller holds the lock.
+        '''
+        subscribers = self.subscriptions[title]
+        del subscribers[session_id]
+        if not subscribers:
+            del self.subscriptions[title]
+
+    def publish(self, title, event, origin=None):
+        '''
+        Queue the event for the subscribers of the thread but the session that caused it.
+        An event is [type, thread title, message id, username, message].
+        '''
+        with self.lock:
+            for session_id, addresses in self.subscriptions.get(title, {}).items():
+                if session_id != origin:
+                    self.pending.setdefault(addresses, []).append(event)
+                    self.ready.set()
+
+    def pusher(self):
+        '''
+        Push the pending events, off the request path.
+        '''
+        while True:
+            self.ready.wait()
+            time.sleep(self.interval) # the rest of a burst joins the events that woke the pusher
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.ready.clear()
+
+            for (event_address, session_address), events in pending.items():
+                batch, size = [], 0
+                for event in events:
+                    event_size = len(json.dumps(event))
+                    if batch and size + event_size > PUSH_SIZE:
+                        self.push(event_address, session_address, batch)
+                        batch, size = [], 0
+                    batch.append(event)
+                    size += event_size
+                self.push(event_address, session_address, batch)
+
+    def push(self, event_address, session_address, events):
+        '''
+        Send the events, with the codec and the compression of the session.
+        A push larger than a fragment is fragmented as the replies are, the client reassembles it.
+        '''
+        push = {
+            'status': 'PUSH',
+            'events': events,
+        }
+        payload = compress_message(encode_message(push, client_codecs.get(session_address, 'json')), client_compressions.get(session_address))
+        try:
+            udp_send_payload(self.udp_soc, payload, event_address)
+        except OSError as e:
+            print('Push to {} failed: {}'.format(event_address, e))
+
+class ReplyCache:
+    '''
+    The last reply sent for every recent request, keyed by (client address, request id).
+    At most limit bytes of replies are kept, the oldest are dropped first. A request still
+    running is never dropped, or a retransmission of it would run it a second time.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.replies = OrderedDict() # (client address, request id) -> reply, None while the request runs
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        '''
+        Return (False, None) and mark the request as running if it is new,
+        (True, reply) if it was seen before.
+        '''
+        with self.lock:
+            if key in self.replies:
+                return True, self.replies[key]
+            self.replies[key] = None
+            return False, None
+
+    def get(self, key):
+        '''
+        The reply of the request, None if there is none.
+        '''
+        with self.lock:
+            return self.replies.get(key)
+
+    def store(self, key, payload):
+        '''
+        Keep the reply of the request, replacing an earlier reply of a multi-step request.
+        '''
+        with self.lock:
+            previous = self.replies.pop(key, None)
+            self.size += len(payload) - (len(previous) if previous is not None else 0)
+            self.replies[key] = payload
+            if self.size <= self.limit:
+                return
+
+            # the oldest replies go first, the markers of the running requests stay
+            excess, evicted = self.size - self.limit, []
+            for older, reply in self.replies.items():
+                if excess <= 0 or older == key:
+                    break
+                if reply is not None:
+                    evicted.append(older)
+                    excess -= len(reply)
+            for older in evicted:
+                self.size -= len(self.replies.pop(older))
+
+    def finish(self, key):
+        '''
+        Forget a request that finished without a reply.
+        '''
+        with self.lock:
+            if key in self.replies and self.replies[key] is None:
+                del self.replies[key]
+
+    def forget(self, key):
+        '''
+        Forget the request, e.g. it was rejected before it ran.
+        '''
+        with self.lock:
+            previous = self.replies.pop(key, None)
+            self.size -= len(previous) if previous is not None else 0
+
+class ResponseCache:
+    '''
+    Encoded LST and RDT responses, keyed by the request they answer and tagged with the version of
+    the threads they show. A response of an older version is stale, it is dropped when it is found.
+    At most limit bytes of responses are kept, the least recently used are dropped first.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.responses = OrderedDict() # key -> (version, encoded response), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        '''
+        The encoded response of the version, None if there is none.
+        '''
+        with self.lock:
+            entry = self.responses.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self.drop(key)
+                return None
+            self.responses.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, encoded):
+        '''
+        Keep the encoded response of the version, unless it is larger than the whole cache.
+        '''
+        with self.lock:
+            if key in self.responses:
+                self.drop(key)
+            if len(encoded) > self.limit:
+                return
+            self.responses[key] = (version, encoded)
+            self.size += len(encoded)
+            while self.size > self.limit:
+                self.drop(next(iter(self.responses)))
+
+    def drop(self, key):
+        '''
+        Forget the response, the caller holds the lock.
+        '''
+        version, encoded = self.responses.pop(key)
+        self.size -= len(encoded)
+
+def open_transaction(add, request_id):
+    '''
+    Register a handler that is about to wait for the follow-up datagram of its request.
+    '''
+    with transactions_lock:
+        transactions[(add, request_id)] = queue.Queue()
+
+def close_transaction(add, request_id):
+    '''
+    Forget the transaction, follow-up datagrams arriving later are dropped.
+    '''
+    with transactions_lock:
+        transactions.pop((add, request_id), None)
+
+def await_followup(add, request_id):
+    '''
+    Wait for the follow-up datagram of the transaction, None if the client never sends it.
+    '''
+    with transactions_lock:
+        followups = transactions[(add, request_id)]
+    try:
+        return followups.get(timeout=TRANSACTION_TIMEOUT)
+    except queue.Empty:
+        return None
+
+def route_followup(udp_soc, data, add):
+    '''
+    Hand a follow-up datagram (step > 0) to the handler waiting for it.
+    Only the receiver of the server socket calls this, handlers never read the socket themselves.
+    '''
+    if data.get('step', 0) == 0:
+        return False
+
+    with transactions_lock:
+        followups = transactions.get((add, data.get('request_id')))
+    if followups is not None:
+        followups.put(data)
+        return True
+
+    # the transaction is over, a retransmitted follow-up replays the last reply of the request
+    reply = reply_cache.get((add, data.get('request_id')))
+    if reply is not None:
+        udp_send_payload(udp_soc, reply, add)
+    else:
+        print('Dropped follow-up of an unknown {} request from {}'.format(data.get('command'), add))
+    return True
+
+def open_session(username, codec, add):
+    '''
+    Log the user in from the client address, return the id of its new session.
+    '''
+    with sessions_lock:
+        expire_sessions()
+        session_id = 0
+        while session_id == 0 or session_id in sessions:
+            session_id = secrets.randbits(SESSION_BITS)
+        sessions[session_id] = {'username': username, 'codec': codec, 'address': add, 'last_used': time.time()}
+        online_users[username] = session_id
+    return session_id
+
+def lookup_session(session_id, add):
+    '''
+    The user of the session, None if the session is unknown, expired or used from another address.
+    A session expires SESSION_TIMEOUT seconds after its last request.
+    '''
+    with sessions_lock:
+        expire_sessions()
+        session = sessions.get(session_id)
+        if session is None or session['address'] != add:
+            return None
+        session['last_used'] = time.time()
+        sessions.move_to_end(session_id)
+        return session['username']
+
+def user_online(username):
+    '''
+    Check if the user has a session that did not expire.
+    '''
+    with sessions_lock:
+        expire_sessions()
+        return username in online_users
+
+def close_session(session_id):
+    '''
+    Log the user of the session out, the caller holds sessions_lock.
+    '''
+    session = sessions.pop(session_id, None)
+    if session is not None and online_users.get(session['username']) == session_id:
+        del online_users[session['username']]
+    if session is not None:
+        notifier.drop_session(session_id)
+
+def expire_sessions():
+    '''
+    Close the sessions unused for longer than SESSION_TIMEOUT, the least recently used come first.
+    The caller holds sessions_lock.
+    '''
+    while sessions:
+        session_id, session = next(iter(sessions.items()))
+        if time.time() - session['last_used'] < SESSION_TIMEOUT:
+            break
+        close_session(session_id)
+
+def open_transfer():
+    '''
+    Register a file transfer, return its one-time token and the queue its TCP connection arrives on.
+    '''
+    token = secrets.token_bytes(TOKEN_SIZE)
+    connections = queue.Queue(1)
+    with transfers_lock:
+        transfers[token] = connections
+    return token, connections
+
+def await_transfer(token, connections):
+    '''
+    Wait for the TCP connection of the transfer, None if the client never connects.
+    '''
+    try:
+        return connections.get(timeout=TRANSFER_TIMEOUT)
+    except queue.Empty:
+        with transfers_lock:
+            transfers.pop(token, None)
+        # the connection may have been handed over just before the token was dropped
+        try:
+            return connections.get_nowait()
+        except queue.Empty:
+            return None
+
+def route_transfer(tcp_client_socket):
+    '''
+    Hand the TCP connection to the handler of the transfer named by the token the client sends first.
+    '''
+    try:
+        tcp_client_socket.settimeout(5)
+        token = tcp_receive_exact(tcp_client_socket, TOKEN_SIZE)
+    except OSError: # e.g. reset by the client
+        token = None
+
+    # the token is used once, a second connection with the same token is refused
+    with transfers_lock:
+        connections = transfers.pop(token, None)
+        if connections is not None:
+            connections.put(tcp_client_socket)
+    if connections is None:
+        print('Refused a file transfer with an unknown token')
+        tcp_client_socket.close()
+
+def tcp_receive_exact(tcp_soc, size):
+    '''
+    Receive exactly size bytes, None if the connection closes before.
+    '''
+    data = b''
+    while len(data) < size:
+        chunk = tcp_soc.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def send_range(token, connections, f, compression=None):
+    '''
+    Wait for the TCP connection of the transfer and send it the byte range of the open file it asks for,
+    in compressed frames if the transfer has a compression.
+    '''
+    tcp_client_socket = await_transfer(token, connections)
+    if tcp_client_socket is None:
+        print('No connection for the download of {}'.format(f.name))
         return
-    elif command == 'RMV':
-        threads = REMOVE_THREAD(data, add, threads, client_udp_socket)
+
+    try:
+        header = tcp_receive_exact(tcp_client_socket, RANGE_HEADER.size)
+        if header is not None:
+            offset, length = RANGE_HEADER.unpack(header)
+            if compression is None:
+                tcp_send_file(tcp_client_socket, f, offset, length)
+            else:
+                tcp_send_frames(tcp_client_socket, f, offset, length, compression)
+    except OSError as e:
+        print('Download of {} interrupted: {}'.format(f.name, e))
+    finally:
+        tcp_client_socket.close()
+
+def tcp_send_file(tcp_soc, f, offset=0, count=None):
+    '''
+    Send count bytes of the file from the offset on, or the rest of the file if count is None,
+    zero-copy through os.sendfile where the platform has it.
+    '''
+    if count == 0:
         return
-    elif command == 'XIT':
-        online_users = EXIT_USER(data, add, online_users, client_udp_socket)
+    if hasattr(os, 'sendfile'):
+        tcp_soc.sendfile(f, offset, count)
         return
 
-def udp_send_response(udp_soc, response, client_add):
-    ''' 
-    Send the response to the client.
+    # one buffer for the whole file, sendall retries the partial writes
+    f.seek(offset)
+    buffer = bytearray(TRANSFER_BUFFER)
+    view = memoryview(buffer)
+    remaining = count
+    while remaining is None or remaining > 0:
+        size = f.readinto(view[:TRANSFER_BUFFER if remaining is None else min(remaining, TRANSFER_BUFFER)])
+        if not size:
+            break
+        tcp_soc.sendall(view[:size])
+        if remaining is not None:
+            remaining -= size
+
+def tcp_send_frames(tcp_soc, f, offset, count, compression):
     '''
-    udp_soc.sendto(json.dumps(response).encode('utf-8'), client_add)
-    # print('Sent response {} to client'.format(response))
+    Send count bytes of the file from the offset on in frames of compressed bytes, each after its size
+    before and after compression. A frame that does not shrink is sent as it is.
+    '''
+    compress = COMPRESSIONS[compression][0]
+    f.seek(offset)
+    remaining = count
+    while remaining > 0:
+        data = f.read(min(remaining, COMPRESSION_FRAME))
+        if not data:
+            break
+        frame = compress(data)
+        if len(frame) >= len(data):
+            frame = data
+        tcp_soc.sendall(FRAME_HEADER.pack(len(data), len(frame)))
+        tcp_soc.sendall(frame)
+        remaining -= len(data)
+
+def tcp_receive_frame(tcp_soc, compression, limit):
+    '''
+    Receive one frame of a compressed range and return its bytes, None if the connection closes
+    or the frame is larger than limit or does not decompress to its size.
+    '''
+    header = tcp_receive_exact(tcp_soc, FRAME_HEADER.size)
+    if header is None:
+        return None
+    size, sent = FRAME_HEADER.unpack(header)
+    if size == 0 or size > min(limit, COMPRESSION_FRAME) or sent > size:
+        return None
+    frame = tcp_receive_exact(tcp_soc, sent)
+    if frame is None or sent == size:
+        return frame
+    return decompress(frame, compression, size)
+
+def tcp_receive_ranges(tcp_soc, path, file_size, ranges, algorithm, digests, content=None, compression=None):
+    '''
+    Receive the byte ranges of a file, each sent after its offset and length, and write them into the file.
+    The digests of the chunks they cover are added to digests, and the bytes to the content hash if there is one,
+    while they stream through one buffer of chunk-size bytes, whatever the size of the file, or frame by frame
+    if the transfer has a compression. The chunks received before the connection closes are kept.
+    '''
+    buffer = bytearray(options['chunk-size'])
+    view = memoryview(buffer)
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.truncate(file_size)
+        for start, end in ranges:
+            header = tcp_receive_exact(tcp_soc, RANGE_HEADER.size)
+            if header is None or RANGE_HEADER.unpack(header) != (start, end - start):
+                return
+
+            f.seek(start)
+            chunk_digests = ChunkDigests(algorithm, start, digests)
+            remaining = end - start
+            while remaining > 0:
+                if compression is None:
+                    size = tcp_soc.recv_into(view[:min(remaining, len(buffer))])
+                    if not size:
+                        return
+                    data = view[:size]
+                else:
+                    data = tcp_receive_frame(tcp_soc, compression, remaining)
+                    if data is None:
+                        return
+                f.write(data)
+                chunk_digests.update(data)
+                if content is not None:
+                    content.update(data)
+                remaining -= len(data)
+            # the last chunk of the file is shorter than the others
+            if end == file_size:
+                chunk_digests.close()
+
+def content_hash_of(path):
+    '''
+    The SHA-256 of the file, read through one buffer.
+    '''
+    content = hashlib.sha256()
+    buffer = bytearray(TRANSFER_BUFFER)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            content.update(view[:size])
+    return content.hexdigest()
+
+def choose_compression(compressions):
+    '''
+    The first compression the client offers that the server supports, None if there is none.
+    '''
+    if not isinstance(compressions, list):
+        return None
+    return ([compression for compression in compressions if compression in COMPRESSIONS] + [None])[0]
+
+def compression_ratio(f, compression):
+    '''
+    The size of samples of the open file after compression over their size, 1 if the file is empty.
+    The samples are taken at the start, the middle and the end of the file.
+    '''
+    size = os.fstat(f.fileno()).st_size
+    if size <= 3 * COMPRESSION_SAMPLE:
+        f.seek(0)
+        sample = f.read()
+    else:
+        sample = b''
+        for offset in [0, size // 2, size - COMPRESSION_SAMPLE]:
+            f.seek(offset)
+            sample += f.read(COMPRESSION_SAMPLE)
+    if not sample:
+        return 1
+    return len(COMPRESSIONS[compression][0](sample)) / len(sample)
+
+def decompress(data, compression, size):
+    '''
+    Decompress data that was size bytes before compression, None if it does not decompress to them.
+    At most size bytes are decompressed, whatever the data claims.
+    '''
+    try:
+        data = COMPRESSIONS[compression][1]().decompress(data, size)
+    except DECOMPRESSION_ERRORS:
+        return None
+    return data if len(data) == size else None
+
+def load_chunk_digests(path, chunks):
+    '''
+    The digests of the chunks a partial file holds, None for the chunks it does not hold.
+    '''
+    try:
+        with open(path + '.digests') as f:
+            digests = json.load(f)
+        if os.path.exists(path) and isinstance(digests, list) and len(digests) == chunks:
+            return digests
+    except (OSError, ValueError):
+        pass
+    return [None] * chunks
+
+def save_chunk_digests(path, digests):
+    '''
+    Keep the digests of the chunks a partial file holds, so a resumed upload skips them.
+    '''
+    with open(path + '.digests', 'w') as f:
+        json.dump(digests, f)
+
+def chunk_ranges(indexes, file_size):
+    '''
+    The byte ranges of the chunks, adjacent chunks are merged.
+    '''
+    ranges = []
+    for index in sorted(indexes):
+        start, end = index * DIGEST_CHUNK, min((index + 1) * DIGEST_CHUNK, file_size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+class Crc32:
+    '''
+    zlib.crc32 with the interface of the hashlib digests.
+    '''
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+def new_digest(algorithm):
+    '''
+    An empty digest of the algorithm.
+    '''
+    if algorithm == 'crc32':
+        return Crc32()
+    return hashlib.new(algorithm)
+
+def file_digest(algorithm, digests):
+    '''
+    The digest of a file, computed over the digests of its chunks.
+    '''
+    digest = new_digest(algorithm)
+    for chunk_digest in digests:
+        digest.update(chunk_digest.encode('utf-8'))
+    return digest.hexdigest()
+
+class ChunkDigests:
+    '''
+    Digests of the chunks of a file, computed while its bytes stream through from the start of a chunk on.
+    '''
+    def __init__(self, algorithm, offset, digests):
+        self.algorithm = algorithm
+        self.index = offset // DIGEST_CHUNK
+        self.filled = 0 # bytes of the current chunk
+        self.digest = new_digest(algorithm)
+        self.digests = digests # chunk index -> digest
+
+    def update(self, data):
+        '''
+        Add the next bytes of the file.
+        '''
+        while len(data) > 0:
+            size = min(len(data), DIGEST_CHUNK - self.filled)
+            self.digest.update(data[:size])
+            self.filled += size
+            data = data[size:]
+            if self.filled == DIGEST_CHUNK:
+                self.close()
+
+    def close(self):
+        '''
+        Finish the current chunk, e.g. the last chunk of the file.
+        '''
+        if self.filled > 0:
+            self.digests[self.index] = self.digest.hexdigest()
+        self.index += 1
+        self.filled = 0
+        self.digest = new_digest(self.algorithm)
+
+def valid_transfer_id(transfer_id):
+    '''
+    Check the transfer id of the client, it becomes part of a file name.
+    '''
+    return isinstance(transfer_id, str) and len(transfer_id) == TRANSFER_ID_DIGITS and \
+        all([digit in '0123456789abcdef' for digit in transfer_id])
+
+def valid_count(value, low, high=None):
+    '''
+    Check that the value of the client is an integer from low to high, a bool is not one.
+    '''
+    return isinstance(value, int) and not isinstance(value, bool) and low <= value and (high is None or value <= high)
 
 def udp_receive_data(udp_soc):
     ''' 
-    Receive the data from the client.
+    Receive the next request of a client for a handler, the receiver answers the other datagrams itself.
     '''
     while True:
         try:
-            data, add = udp_soc.recvfrom(1024)
-            data = json.loads(data.decode('utf-8'))
+            data, add = udp_soc.recvfrom(MAX_DATAGRAM)
+            data = udp_accept(udp_soc, data, add)
+            if data is None:
+                continue
             # print('Received data {} from client'.format(data))
             return data, add
         except timeout:
             continue
 
+def udp_accept(udp_soc, raw, add):
+    '''
+    Decode the datagram of the client and answer it if it is for the receiver, return the request
+    for a handler or None. A malformed datagram is dropped, it must not stop the receiver.
+    '''
+    try:
+        data = udp_decode(raw, add)
+        if data is None or handle_control(udp_soc, data, add):
+            return None
+        return data
+    except (ValueError, IndexError, KeyError, TypeError, struct.error): # e.g. truncated, not UTF-8, or a field of the wrong type
+        print('Dropped a malformed datagram from {}'.format(add))
+        return None
+
+def udp_decode(raw, add):
+    '''
+    Decode the datagram of the client, None while it is a fragment of an incomplete request.
+    '''
+    if raw[:len(FRAGMENT_MAGIC)] == FRAGMENT_MAGIC:
+        raw = reassembler.add(raw, add)
+        if raw is None:
+            return None
+    raw, request_id = decompress_message(raw, REASSEMBLY_LIMIT)
+    if raw is None:
+        print('Dropped a compressed request from {} that does not decompress'.format(add))
+        return None
+    data = decode_message(raw)
+    if not isinstance(data, dict): # valid JSON, but not a request
+        raise ValueError('not a request')
+    if request_id != 0: # the request id of a compressed message is in its header
+        data['request_id'] = request_id
+    client_codecs[add] = 'binary' if raw[0] == BINARY_MAGIC else 'json'
+
+    # every request after AUTH names its session instead of its user, the user of an unknown session is unknown
+    if data.get('command') != 'AUTH':
+        data.pop('username', None)
+        username = lookup_session(data.get('session_id'), add)
+        if username is not None:
+            data['username'] = username
+    return data
+
+class Reassembler:
+    '''
+    Buffers the fragments of incomplete messages until all of them arrived. At most limit bytes
+    are buffered, the oldest incomplete messages are dropped first.
+    '''
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.size = 0
+        self.messages = OrderedDict() # (address, message id) -> [fragment count, {index: chunk}, first arrival]
+
+    def add(self, raw, add):
+        '''
+        Buffer the fragment, return the whole message once its last fragment arrived.
+        '''
+        magic, message_id, index, total = FRAGMENT_HEADER.unpack_from(raw)
+        chunk = raw[FRAGMENT_HEADER.size:]
+        key = (add, message_id)
+        self.expire()
+
+        # a fragment out of its own count, or of a message that can never fit in the buffer, is dropped at once
+        if total == 0 or index >= total or total * FRAGMENT_SIZE > self.limit:
+            return None
+        message = self.messages.get(key)
+        if message is None:
+            message = self.messages[key] = [total, {}, time.time()]
+        if total != message[0] or index in message[1]:
+            return None
+
+        message[1][index] = chunk
+        self.size += len(chunk)
+        if len(message[1]) == message[0]:
+            self.drop(key)
+            return b''.join([message[1][i] for i in range(message[0])])
+
+        while self.size > self.limit:
+            self.drop(next(iter(self.messages)))
+        return None
+
+    def expire(self):
+        '''
+        Drop the incomplete messages that waited longer than the timeout.
+        '''
+        while self.messages:
+            key, (total, chunks, started) = next(iter(self.messages.items()))
+            if time.time() - started < self.timeout:
+                break
+            self.drop(key)
+
+    def drop(self, key):
+        '''
+        Forget the fragments of the message.
+        '''
+        total, chunks, started = self.messages.pop(key)
+        self.size -= sum([len(chunk) for chunk in chunks.values()])
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   CODEC FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def encode_message(message, codec):
+    '''
+    Encode the message with the codec.
+    The binary codec packs the command, the request id and the session id into a fixed header,
+    the other fields follow as (field code, type, length, value).
+    '''
+    if codec == 'json':
+        return json.dumps(message).encode('utf-8')
+
+    header = BINARY_HEADER.pack(BINARY_MAGIC, COMMAND_CODES.get(message.get('command'), 0),
+                                message.get('request_id') or 0, message.get('session_id') or 0)
+    fields = [encode_field(name, value) for name, value in message.items() if name not in HEADER_FIELDS]
+    return header + b''.join(fields)
+
+def compress_message(payload, compression, request_id=0):
+    '''
+    Compress an encoded message larger than the threshold behind a header naming the compression and
+    carrying the request id, the message is sent as it is if there is no compression or it does not shrink.
+    '''
+    if compression is None or len(payload) <= COMPRESSION_THRESHOLD:
+        return payload
+    compressed = COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, COMPRESSION_CODES[compression], request_id, len(payload)) + \
+        COMPRESSIONS[compression][0](payload)
+    return compressed if len(compressed) < len(payload) else payload
+
+def decompress_message(raw, limit):
+    '''
+    The encoded message of a compressed message and the request id in its header, 0 if there is none.
+    Other messages are returned as they are. None if it does not decompress or would be larger than limit.
+    '''
+    if raw[0] != COMPRESSED_MAGIC:
+        return raw, 0
+    magic, code, request_id, size = COMPRESSED_HEADER.unpack_from(raw)
+    if not 0 < code < len(COMPRESSION_NAMES) or size > limit:
+        return None, 0
+    return decompress(raw[COMPRESSED_HEADER.size:], COMPRESSION_NAMES[code], size), request_id
+
+def decode_message(raw):
+    '''
+    Decode a message of either codec, the first byte tells them apart.
+    '''
+    if raw[0] != BINARY_MAGIC:
+        return json.loads(raw.decode('utf-8'))
+
+    magic, command, request_id, session_id = BINARY_HEADER.unpack_from(raw)
+    message = {'request_id': request_id}
+    if command != 0:
+        message['command'] = COMMAND_NAMES[command]
+    if session_id != 0:
+        message['session_id'] = session_id
+
+    position = BINARY_HEADER.size
+    while position < len(raw):
+        name, value, position = decode_field(raw, position)
+        message[name] = value
+    return message
+
+def encode_field(name, value):
+    '''
+    Encode one field, unknown field names are carried along with the field.
+    '''
+    if name in FIELD_CODES:
+        return struct.pack('!B', FIELD_CODES[name]) + encode_value(value)
+    return struct.pack('!B', 0) + encode_value(name) + encode_value(value)
+
+def decode_field(raw, position):
+    '''
+    Decode the field at the position, return its name, its value and the position after it.
+    '''
+    code = raw[position]
+    position += 1
+    if code == 0:
+        name, position = decode_value(raw, position)
+    else:
+        name = FIELD_NAMES[code]
+    value, position = decode_value(raw, position)
+    return name, value, position
+
+def encode_value(value):
+    '''
+    Encode the value as its type, its length and its bytes.
+    '''
+    if value is None:
+        kind, data = TYPE_NONE, b''
+    elif isinstance(value, bool):
+        kind, data = TYPE_BOOL, struct.pack('!?', value)
+    elif isinstance(value, int):
+        kind, data = TYPE_INT, struct.pack('!q', value)
+    elif isinstance(value, float):
+        kind, data = TYPE_FLOAT, struct.pack('!d', value)
+    elif isinstance(value, str):
+        kind, data = TYPE_STR, value.encode('utf-8')
+    elif isinstance(value, (list, tuple)):
+        kind, data = TYPE_LIST, b''.join([encode_value(item) for item in value])
+    elif isinstance(value, dict):
+        kind, data = TYPE_DICT, b''.join([encode_value(key) + encode_value(item) for key, item in value.items()])
+    else:
+        raise TypeError('Cannot encode {}'.format(type(value).__name__))
+    return VALUE_HEADER.pack(kind, len(data)) + data
+
+def decode_value(raw, position):
+    '''
+    Decode the value at the position, return it and the position after it.
+    '''
+    kind, length = VALUE_HEADER.unpack_from(raw, position)
+    start = position + VALUE_HEADER.size
+    end = start + length
+    if kind == TYPE_NONE:
+        value = None
+    elif kind == TYPE_BOOL:
+        value = struct.unpack_from('!?', raw, start)[0]
+    elif kind == TYPE_INT:
+        value = struct.unpack_from('!q', raw, start)[0]
+    elif kind == TYPE_FLOAT:
+        value = struct.unpack_from('!d', raw, start)[0]
+    elif kind == TYPE_STR:
+        value = bytes(raw[start:end]).decode('utf-8')
+    elif kind == TYPE_LIST:
+        value = []
+        position = start
+        while position < end:
+            item, position = decode_value(raw, position)
+            value.append(item)
+    else:
+        value = {}
+        position = start
+        while position < end:
+            key, position = decode_value(raw, position)
+            value[key], position = decode_value(raw, position)
+    return value, end
+
 ########################################################################################################################
 #                                                                                                                      #
 #                                                COMMAND FUNCTIONS                                                     #                                                                                                       
@@ -174,12 +1733,15 @@ def AUTH_USER(data, add, users, online_users, client_udp_socket):
         'status': 'OK',
     }
     username = data['username']
+    codecs = data.get('codecs', ['json'])
+    compressions = data.get('compressions')
 
-    # if the username is in online_users, then the user is already logged in 
-    if username in online_users:
+    # if the user has a session, then the user is already logged in
+    if user_online(username):
         response['type'] = 'ONLINE'
         response['status'] = 'ERROR'
         print('{} has already logged in'.format(username))
+        udp_send_response(client_udp_socket, response, add)
         return users, online_users
     elif username in users:
         # if the username is in users list then the user is an old user
@@ -189,9 +1751,17 @@ def AUTH_USER(data, add, users, online_users, client_udp_socket):
         # if the username is not in users then create a new user
         response['type'] = 'NEW'
         response['status'] = 'PWDNEED'
+
+    # the password comes back as the follow-up of this request
+    request_id = data.get('request_id')
+    open_transaction(add, request_id)
     udp_send_response(client_udp_socket, response, add)
+    data = await_followup(add, request_id)
+    close_transaction(add, request_id)
 
-    data, add = udp_receive_data(client_udp_socket)
+    if data is None:
+        print('{} did not send a password'.format(username))
+        return users, online_users
     password = data['password']
 
     print("Client authenticating")
@@ -202,7 +1772,6 @@ def AUTH_USER(data, add, users, online_users, client_udp_socket):
             response['type'] = 'OLD_SUC'
             response['status'] = 'OK'
             print('{} successful login'.format(username))
-            online_users.append(username)
         else:
         # if the password is incorrect, then the user is not logged in
             response['type'] = 'PWD'
@@ -215,16 +1784,25 @@ def AUTH_USER(data, add, users, online_users, client_udp_socket):
         print('Welcome, {}'.format(username))
         
         users[username] = password # update the users list
-        online_users.append(username)
 
         # write the new user to credentials.txt
         with open('credentials.txt', 'a+') as f:
             f.write('\n{} {}'.format(username, password))
+
+    # open a session that uses the preferred codec of the client both sides support
+    if response['status'] == 'OK':
+        codec = ([codec for codec in codecs if codec in CODECS] + ['json'])[0]
+        response['session_id'] = open_session(username, codec, add)
+        response['codec'] = codec
+        # the large messages of the session are compressed with the first compression of the client the server supports
+        client_compressions[add] = response['compression'] = choose_compression(compressions)
+        # a client only pipelines its requests if they run in order, e.g. MSG then EDT of the same message
+        response['ordered'] = options['engine'] in ORDERED_ENGINES
     
     udp_send_response(client_udp_socket, response, add)
     return users, online_users
 
-def CREATE_THREAD(data, add, threads, client_udp_socket):
+def CREATE_THREAD(data, add, thread_store, client_udp_socket):
     '''
     Create a new thread.
     '''
@@ -234,23 +1812,19 @@ def CREATE_THREAD(data, add, threads, client_udp_socket):
     }
     thread_title, thread_creator = data['thread_title'], data['username']
 
-    # if the thread title is in the threads list, then the thread already exists
-    if thread_title in threads:
+    # if the thread title is in the thread store, then the thread already exists
+    if not thread_store.create(thread_title, thread_creator):
         response['status'] = 'FAIL'
         print('Thread {} exists'.format(thread_title))
     else:
-        # if the thread title is not in the threads list, then create a new thread
+        # if the thread title is not in the thread store, then a new thread has been created
         response['status'] = 'OK'
         print('Thread {} created'.format(thread_title))
-
-        threads.append(thread_title)
-        with open(thread_title, 'w+') as f:
-            f.write('{}\n'.format(thread_creator)) # write the thread creator to the thread
     
     udp_send_response(client_udp_socket, response, add)
-    return threads
+    return thread_store
         
-def LIST_THREADS(threads, add, client_udp_socket):
+def LIST_THREADS(thread_store, add, client_udp_socket):
     '''
     List all the threads.
     '''
@@ -258,6 +1832,15 @@ def LIST_THREADS(threads, add, client_udp_socket):
     response = {
         'status': 'OK',
     }
+    # the list is encoded again only after a thread was created or removed
+    key = ('LST', client_codecs.get(add, 'json'), client_compressions.get(add))
+    version = thread_store.version()
+    encoded = response_cache.get(key, version)
+    if encoded is not None:
+        udp_send_encoded(client_udp_socket, encoded, add, client_udp_socket.request_id)
+        return
+
+    threads = thread_store.titles()
     
     # if there are no threads to list
     if len(threads) == 0:
@@ -267,9 +1850,11 @@ def LIST_THREADS(threads, add, client_udp_socket):
         response['status'] = 'OK'
         response['threads'] = threads
     
-    udp_send_response(client_udp_socket, response, add)
+    encoded = encode_response(response, add)
+    response_cache.put(key, version, encoded)
+    udp_send_encoded(client_udp_socket, encoded, add, client_udp_socket.request_id)
 
-def POST_MESSAGE(data, add, threads, client_udp_socket):
+def POST_MESSAGE(data, add, thread_store, client_udp_socket):
     '''
     Post a message to a thread.
     '''
@@ -277,27 +1862,34 @@ def POST_MESSAGE(data, add, threads, client_udp_socket):
     response = {
         'status': 'OK',
     }
-    thread_title, thread_creator, msg_content = data['thread_title'], data['username'], data['message']
+    thread_title, thread_creator, msg_content = data['thread_title'], data['username'], data.get('message')
 
-    # if the thread title is not in the threads list, then the thread does not exist
-    if thread_title not in threads:
+    # if the message is not text, it never reaches the store
+    if not isinstance(msg_content, str):
+        response['status'] = 'FAIL'
+        print('Invalid message from {}'.format(thread_creator))
+    # if the thread title is not in the thread store, then the thread does not exist
+    elif not thread_store.exists(thread_title):
         response['status'] = 'FAIL'
         print('Incorrect thread specified')
     else:
-        # if the thread title is in the threads list, then add the message to the thread
-        response['status'] = 'OK'
-        msg_index = 0
-        with open(thread_title, 'r') as f:
-            for line in f:
-                msg_index += 1
-        with open(thread_title, 'a+') as f:
-            f.write('{} {}: {}\n'.format(str(msg_index), thread_creator, msg_content))
-        print('Message posted to {} thread'.format(thread_title))
+        # if the thread title is in the thread store, then append the message to the thread
+        try:
+            # the index is updated under the same lock as the store so that the writes apply in the same order
+            msg_index = thread_store.post(thread_title, thread_creator, msg_content,
+                                          then=lambda msg_id: search_index.add(thread_title, msg_id, thread_creator, msg_content))
+        except KeyError: # removed by a RMV since the check
+            response['status'] = 'FAIL'
+            print('Incorrect thread specified')
+        else:
+            response['status'] = 'OK'
+            print('Message posted to {} thread'.format(thread_title))
+            notifier.publish(thread_title, ['MSG', thread_title, msg_index, thread_creator, msg_content], data.get('session_id'))
 
     udp_send_response(client_udp_socket, response, add)
-    return threads
+    return thread_store
         
-def DELETE_MESSAGE(data, add, threads, client_udp_socket):
+def DELETE_MESSAGE(data, add, thread_store, client_udp_socket):
     '''
     Delete a message from a thread.
     '''
@@ -305,55 +1897,36 @@ def DELETE_MESSAGE(data, add, threads, client_udp_socket):
     response = {
         'status': 'OK',
     }
-    thread_title, thread_creator, msg_index = data['thread_title'], data['username'], data['message_id']
+    thread_title, thread_creator, msg_index = data['thread_title'], data['username'], message_id(data)
 
-    # if the thread title is not in the threads list
-    if thread_title not in threads:
+    # if the thread title is not in the thread store
+    if not thread_store.exists(thread_title):
         response['status'] = 'NO_THREAD'
         print('Thread {} does not exist'.format(thread_title))
-        udp_send_response(client_udp_socket, response, add)
-    
     else:
-        # if the msg index is out of range
-        if int(msg_index) <= 0:
-            response['status'] = 'NO_MSG'
-            print('Index of message: {} is out of range'.format(msg_index))
-            udp_send_response(client_udp_socket, response, add)
-
-        # find the line that contains the message index and corresponding line number
-        line_to_remove = ''
-        line_num = 0
-        with open(thread_title, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                if msg_index == line.split()[0]:
-                    line_to_remove = line
-                    line_num = lines.index(line)
-                    break
+        try:
+            author = thread_store.author(thread_title, msg_index)
 
-        # if thread is empty, no msg in the thread
-        if line_to_remove == '':
-            response['status'] = 'NO_MSG'
-            print('The message does not exist') 
-        # if the user is not the creator of the thread
-        elif thread_creator != lines[line_num].split(' ')[1][:-1]:
-            response['status'] = 'FAIL'
-            print('Message cannot be deleted')
-        else:
-            # if the user is the creator of the thread, then delete the message
-            response['status'] = 'OK'
-            print('Message has been deleted')
-
-            # remove the message from the thread
-            with open(thread_title, 'r') as f:
-                lines = f.readlines()
-                lines.remove(line_to_remove)
-            with open(thread_title, 'w') as f:
-                f.writelines(lines)
+            # if the message is not in the thread
+            if author is None:
+                response['status'] = 'NO_MSG'
+                print('The message does not exist') 
+            # if the user is not the creator of the message
+            elif thread_creator != author:
+                response['status'] = 'FAIL'
+                print('Message cannot be deleted')
+            else:
+                # if the user is the creator of the message, then delete the message
+                thread_store.delete(thread_title, msg_index, then=lambda result: search_index.remove(thread_title, msg_index))
+                response['status'] = 'OK'
+                print('Message has been deleted')
+                notifier.publish(thread_title, ['DLT', thread_title, msg_index, thread_creator, None], data.get('session_id'))
+        except KeyError: # the thread or the message was removed since the check
+            response['status'] = vanished_status(thread_store, thread_title)
     
-        udp_send_response(client_udp_socket, response, add)
+    udp_send_response(client_udp_socket, response, add)
 
-def READ_THREAD(data, add, threads, client_udp_socket):
+def READ_THREAD(data, add, thread_store, client_udp_socket):
     '''
     Return the messages in the thread.
     '''
@@ -362,29 +1935,59 @@ def READ_THREAD(data, add, threads, client_udp_socket):
         'status': 'OK',
     }
     thread_title = data['thread_title']
+    since_id, version, limit = data.get('since_id', 0), data.get('version', 0), data.get('limit')
+
+    # if the cursor or the page are not of their type or out of range, e.g. a limit of 0 would never advance the cursor
+    if not valid_count(since_id, 0) or not valid_count(version, 0) or (limit is not None and not valid_count(limit, 1, MAX_READ_PAGE)):
+        response['status'] = 'FAIL'
+        print('Invalid read of Thread {}'.format(thread_title))
+        udp_send_response(client_udp_socket, response, add)
+        return
+
+    # the page is read and encoded again only after a write to the thread
+    key = ('RDT', thread_title, since_id, version, limit, client_codecs.get(add, 'json'), client_compressions.get(add))
+    encoded = response_cache.get(key, thread_store.version(thread_title))
+    if encoded is not None:
+        print('Thread {} read'.format(thread_title))
+        udp_send_encoded(client_udp_socket, encoded, add, client_udp_socket.request_id)
+        return
 
-    # if the thread title is not in the threads list, then the thread does not exist
-    if thread_title not in threads:
+    # if the thread title is not in the thread store, then the thread does not exist
+    if not thread_store.exists(thread_title):
         response['status'] = 'FAIL'
         print('Thread {} does not exist'.format(thread_title))
     else:
-        # if the thread title exists, then get the messages from the thread
-        response['messages'] = []
-        with open(thread_title, 'r') as f:
-            lines = f.readlines()
-        response['messages'] = lines[1:]
+        # if the thread title exists, then get the messages after the cursor of the client
+        try:
+            page = thread_store.read(thread_title, since_id, version, limit)
+        except KeyError: # removed by a RMV since the check
+            response['status'] = 'FAIL'
+            print('Thread {} does not exist'.format(thread_title))
+            udp_send_response(client_udp_socket, response, add)
+            return
+        response['messages'] = page['records']
+        response['next_cursor'] = page['cursor']
+        response['version'] = page['version']
+        response['more'] = page['more']
+        response['reset'] = page['reset']
     
         # if the thread is empty,
-        if len(response['messages']) == 0:
+        if page['empty']:
             response['status'] = 'NO_MSG'
             print('Thread {} read'.format(thread_title))
         else:
             response['status'] = 'OK'
             print('Thread {} read'.format(thread_title))
 
+        # tagged with the version the page was read at, a later write makes it stale
+        encoded = encode_response(response, add)
+        response_cache.put(key, page['version'], encoded)
+        udp_send_encoded(client_udp_socket, encoded, add, client_udp_socket.request_id)
+        return
+
     udp_send_response(client_udp_socket, response, add)
 
-def EDIT_MESSAGE(data, add, threads, client_udp_socket):
+def EDIT_MESSAGE(data, add, thread_store, client_udp_socket):
     '''
     Edit a message in a thread.
     '''
@@ -392,56 +1995,43 @@ def EDIT_MESSAGE(data, add, threads, client_udp_socket):
     response = {
         'status': 'OK',
     }
-    thread_title, thread_creator, msg_index, msg_content = data['thread_title'], data['username'], data['message_id'], data['message']
+    thread_title, thread_creator, msg_index, msg_content = data['thread_title'], data['username'], message_id(data), data.get('message')
 
-    # if the thread title is not in the threads list
-    if thread_title not in threads:
+    # if the message is not text, it never reaches the store
+    if not isinstance(msg_content, str):
+        response['status'] = 'FAIL'
+        print('Invalid message from {}'.format(thread_creator))
+    # if the thread title is not in the thread store
+    elif not thread_store.exists(thread_title):
         response['status'] = 'NO_THREAD'
         print('Thread {} does not exist'.format(thread_title))
-        udp_send_response(client_udp_socket, response, add)
     else:
     # if thread exists
-        # if the msg index is out of range
-        if int(msg_index) <= 0:
-            response['status'] = 'NO_MSG'
-            print('Index of message: {} is out of range'.format(msg_index))
-            udp_send_response(client_udp_socket, response, add)
-    
-        # find the line that contains the message index
-        line_to_edit = ''
-        line_num = 0
-        with open(thread_title, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                if msg_index == line.split()[0]:
-                    line_to_edit = line
-                    line_num = lines.index(line)
-                    break
+        try:
+            author = thread_store.author(thread_title, msg_index)
 
-        # if msg is not in the thread
-        if line_to_edit == '':
-            response['status'] = 'NO_MSG'
-            print('Message does not exist'.format(msg_index))
-        # if the user is not the creator of the thread
-        elif thread_creator != lines[line_num].split(' ')[1][:-1]:
-            response['status'] = 'FAIL'
-            print('Message cannot be edited') 
-        else:
-        # if the user is the creator of the thread, then edit the message
-            response['status'] = 'OK'
-            print('Message has been edited'.format(msg_index))
-
-            # rewrite the message
-            lines[line_num] = '{} {}: {}\n'.format(msg_index, thread_creator, msg_content)
-            
-            # add the messages to the thread
-            with open(thread_title, 'w+') as f:
-                f.writelines(lines)
+            # if msg is not in the thread
+            if author is None:
+                response['status'] = 'NO_MSG'
+                print('Message does not exist')
+            # if the user is not the creator of the message
+            elif thread_creator != author:
+                response['status'] = 'FAIL'
+                print('Message cannot be edited') 
+            else:
+            # if the user is the creator of the message, then edit the message
+                thread_store.edit(thread_title, msg_index, msg_content,
+                                  then=lambda result: search_index.add(thread_title, msg_index, thread_creator, msg_content))
+                response['status'] = 'OK'
+                print('Message has been edited')
+                notifier.publish(thread_title, ['EDT', thread_title, msg_index, thread_creator, msg_content], data.get('session_id'))
+        except KeyError: # the thread or the message was removed since the check
+            response['status'] = vanished_status(thread_store, thread_title)
         
-        udp_send_response(client_udp_socket, response, add)
-    return threads
+    udp_send_response(client_udp_socket, response, add)
+    return thread_store
 
-def UPLOAD_FILE(data, add, files, threads, client_udp_socket):
+def UPLOAD_FILE(data, add, blob_store, thread_store, client_udp_socket):
     '''
     Upload a file to the thread.
     '''
@@ -449,54 +2039,103 @@ def UPLOAD_FILE(data, add, files, threads, client_udp_socket):
     response = {
         'status': 'OK',
     }
-    thread_title, thread_creator, file_name, file_size = data['thread_title'], data['username'], data['file_name'], data['file_size']
-    
-    # if the thread title is not in the threads list
-    if thread_title not in threads:
+    thread_title, thread_creator, file_name, file_size = data['thread_title'], data['username'], data['file_name'], data.get('file_size')
+    algorithm, digests = data.get('digest_algorithm'), data.get('digests')
+
+    # if the size of the file is not a count of bytes
+    if not valid_count(file_size, 0):
+        response['status'] = 'FAIL'
+        print('Upload of {} to Thread {} without a valid size'.format(file_name, thread_title))
+        udp_send_response(client_udp_socket, response, add)
+        return blob_store
+    chunks = (file_size + DIGEST_CHUNK - 1) // DIGEST_CHUNK
+
+    # if the thread title is not in the thread store
+    if not thread_store.exists(thread_title):
         response['status'] = 'FAIL'
         print('Thread {} does not exist'.format(thread_title))
         udp_send_response(client_udp_socket, response, add)
+    # if the server already holds the content, then the file refers to its blob without a transfer
+    elif valid_hash(data.get('content_hash')) and blob_store.link(thread_title, file_name, data['content_hash']):
+        response['status'] = record_upload(thread_store, blob_store, thread_title, thread_creator, file_name)
+        if response['status'] == 'OK':
+            print('{} uploaded file {} to {} thread, its content is already stored'.format(thread_creator, file_name, thread_title))
+        udp_send_response(client_udp_socket, response, add)
+    # if the digests of the chunks do not describe the file
+    elif algorithm not in DIGEST_ALGORITHMS or not isinstance(digests, list) or len(digests) != chunks:
+        response['status'] = 'FAIL'
+        print('Upload of {} to Thread {} without valid digests'.format(file_name, thread_title))
+        udp_send_response(client_udp_socket, response, add)
     else:
-    # if the thread title is in the threads list, then upload the file
+    # if the thread title is in the thread store, then upload the file
+        token, connections = open_transfer()
+
+        # the file is received into the blob store, an interrupted upload resumes with the chunks not held yet
+        transfer_id = data.get('transfer_id')
+        if not valid_transfer_id(transfer_id):
+            transfer_id = token.hex()
+        blob_store.expire_partials()
+        partial_file = blob_store.partial_path(thread_title, file_name, transfer_id)
+        verified = load_chunk_digests(partial_file, chunks)
+        ranges = chunk_ranges([index for index in range(chunks) if verified[index] != digests[index]], file_size)
+        # the client only offers a compression if samples of the file compress well
+        compression = choose_compression(data.get('compressions'))
+
         response['status'] = 'UPLOAD_FILE'
+        response['token'] = token.hex()
+        response['ranges'] = ranges
+        response['compression'] = compression
         udp_send_response(client_udp_socket, response, add)
+        del response['token'], response['ranges'], response['compression']
 
-        # create tcp socket to receive the file
-        tcp_receive_socket = socket(AF_INET, SOCK_STREAM)
-        tcp_receive_socket.bind(('', PORT))
-        tcp_receive_socket.listen(1)
-        tcp_receive_socket.settimeout(5)
-        tcp_client_socket, tcp_client_address = tcp_receive_socket.accept()
+        # the client sends the file on a connection to the data listener
+        tcp_client_socket = await_transfer(token, connections)
+        if tcp_client_socket is None:
+            print('No connection for the upload of {} to Thread {}'.format(file_name, thread_title))
+            response['status'] = 'INCOMPLETE'
+            response['ranges'] = ranges
+            udp_send_response(client_udp_socket, response, add)
+            return blob_store
 
-        # receive the file
-        download_file = open('{}-{}'.format(thread_title, file_name), 'wb')
-        while True:
-            try:
-                data = tcp_client_socket.recv(1024)
-                if not data:
-                    break
-                download_file.write(data)
-            except:
-                break
-        tcp_client_socket.close()
-        download_file.close()
+        # receive the chunks, their digests and the hash of a whole file are computed while they stream through
+        received = {}
+        content = hashlib.sha256() if ranges == [[0, file_size]] else None
+        try:
+            tcp_receive_ranges(tcp_client_socket, partial_file, file_size, ranges, algorithm, received, content, compression)
+        except OSError as e:
+            print('Upload of {} to Thread {} interrupted: {}'.format(file_name, thread_title, e))
+        finally:
+            tcp_client_socket.close()
+        for index, digest in received.items():
+            verified[index] = digest
+        missing = [index for index in range(chunks) if verified[index] != digests[index]]
 
-        # if the file size is not the same
-        if int(file_size) != os.path.getsize('{}-{}'.format(thread_title, file_name)):
-            response['status'] = 'FAIL'
+        # if chunks are missing or corrupted, the client sends them again
+        if missing:
+            save_chunk_digests(partial_file, verified)
+            print('Upload of {} to Thread {} is missing {} of {} chunks'.format(file_name, thread_title, len(missing), chunks))
+            response['status'] = 'INCOMPLETE'
+            response['ranges'] = chunk_ranges(missing, file_size)
             udp_send_response(client_udp_socket, response, add)
         else:
-            # if the file size is the same, then add the file to the thread
-            response['status'] = 'OK'
-            with open(thread_title, 'a') as f:
-                f.write('{} uploaded {}\n'.format(thread_creator, file_name))
-            print('{} uploaded file {} to {} thread'.format(thread_creator, file_name, thread_title))
-            files.append('{}-{}'.format(thread_title, file_name)) # add the file to the files list
+            # if all the chunks match, then the file becomes a blob named by its hash, a resumed upload is read again for it
+            content_hash = content.hexdigest() if content is not None else content_hash_of(partial_file)
+            blob_store.store(thread_title, file_name, partial_file, content_hash, {
+                'size': file_size,
+                'digest_algorithm': algorithm,
+                'digest': file_digest(algorithm, digests),
+                'digests': digests,
+            })
+            if os.path.exists(partial_file + '.digests'):
+                os.remove(partial_file + '.digests')
+            response['status'] = record_upload(thread_store, blob_store, thread_title, thread_creator, file_name)
+            if response['status'] == 'OK':
+                print('{} uploaded file {} to {} thread'.format(thread_creator, file_name, thread_title))
             udp_send_response(client_udp_socket, response, add)
 
-    return files
+    return blob_store
 
-def DOWNLOAD_FILE(data, add, threads, files, client_udp_socket):
+def DOWNLOAD_FILE(data, add, thread_store, blob_store, client_udp_socket):
     '''
     Download a file from the thread.
     '''
@@ -505,48 +2144,85 @@ def DOWNLOAD_FILE(data, add, threads, files, client_udp_socket):
     }
     thread_title, file_name = data['thread_title'], data['file_name']
 
-    # if the thread title is not in the threads list
-    if thread_title not in threads:
+    # if the thread title is not in the thread store
+    if not thread_store.exists(thread_title):
         response['status'] = 'FAIL'
         print('Thread {} does not exist'.format(thread_title))
         udp_send_response(client_udp_socket, response, add)
     else:
-        # if the file is not in the files list
-        if '{}-{}'.format(thread_title, file_name) not in files:
-            response['status'] = 'FILE_NOT_FOUND'
-            print('{} does not exist in Thread {}'.format(file_name, thread_title))
-            udp_send_response(client_udp_socket, response, add)
-        else:
-            # if the file is in the files list, then send the file
-            response['status'] = 'FILE_FOUND'
-            response['file_size'] = os.stat('{}-{}'.format(thread_title, file_name)).st_size
+        # the blob is opened with the lookup, for every TCP connection the client downloads the file with,
+        # a RMV of the thread meanwhile deletes it but the open files keep reading it
+        streams = min(data['streams'], MAX_STREAMS) if valid_count(data.get('streams'), 1) else 1
+        content_hash, metadata, files = blob_store.open(thread_title, file_name, streams)
+        try:
+            send_blob(data, add, thread_title, file_name, content_hash, metadata, files, client_udp_socket)
+        finally:
+            for f in files:
+                f.close()
+
+def send_blob(data, add, thread_title, file_name, content_hash, metadata, files, client_udp_socket):
+    '''
+    Answer the download of the file with the files open on its blob, one for each stream.
+    '''
+    response = {
+        'status': 'OK',
+    }
+    # if the file is not in the blob store
+    if content_hash is None:
+        response['status'] = 'FILE_NOT_FOUND'
+        print('{} does not exist in Thread {}'.format(file_name, thread_title))
+        udp_send_response(client_udp_socket, response, add)
+    # if the client has cached the same content, it uses its copy without a transfer
+    elif data.get('content_hash') == content_hash:
+        response['status'] = 'NOT_MODIFIED'
+        print('{} in Thread {} not modified since its download'.format(file_name, thread_title))
+        udp_send_response(client_udp_socket, response, add)
+    else:
+        # if the file is in the blob store, then send its blob
+        response['status'] = 'FILE_FOUND'
+        response['file_size'] = metadata['size']
+        response['content_hash'] = content_hash # the client caches the file under its hash
+        response['transfer_id'] = content_hash[:TRANSFER_ID_DIGITS] # the same content resumes the same partial download
+        response['digest_algorithm'] = metadata['digest_algorithm']
+        response['digests'] = metadata['digests']
+
+        # the file is compressed on the fly, unless samples of it do not compress well
+        compression = choose_compression(data.get('compressions'))
+        if compression is not None and compression_ratio(files[0], compression) > COMPRESSIBLE_RATIO:
+            compression = None
+        response['compression'] = compression
+
+        # a token for every TCP connection the client downloads the file with
+        pending_transfers = [open_transfer() for _ in files]
+        response['tokens'] = [token.hex() for token, connections in pending_transfers]
+
+        # the client acks the download as the follow-up of this request
+        request_id = data.get('request_id')
+        open_transaction(add, request_id)
+        try:
             udp_send_response(client_udp_socket, response, add)
 
-            # create tcp socket to send the file to the client
-            tcp_send_socket = socket(AF_INET, SOCK_STREAM)
-            tcp_send_socket.bind(('', PORT))
-            tcp_send_socket.listen(1)
-            tcp_send_socket.settimeout(5)
-            tcp_client_socket, tcp_client_address = tcp_send_socket.accept()
-
-            # send the file
-            with open('{}-{}'.format(thread_title, file_name), 'rb') as f:
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        break
-                    tcp_client_socket.send(data)
-            tcp_client_socket.close()
-            tcp_send_socket.close()
+            # the client receives the file on connections to the data listener, their ranges are sent in parallel
+            senders = []
+            for (token, connections), f in zip(pending_transfers, files):
+                sender = threading.Thread(target=send_range, args=(token, connections, f, compression))
+                sender.start()
+                senders.append(sender)
+            for sender in senders:
+                sender.join()
 
-            data, add = udp_receive_data(client_udp_socket)
+            data = await_followup(add, request_id)
+        finally:
+            close_transaction(add, request_id)
 
-            if data['status'] == 'OK':
-                print('{} downloaded from Thread {}'.format(file_name, thread_title))
-            elif data['status'] == 'FAIL':
-                print('{} failed to download file {} from {} thread'.format(data['username'], file_name, thread_title))
+        if data is None:
+            print('No ack for the download of {} from Thread {}'.format(file_name, thread_title))
+        elif data['status'] == 'OK':
+            print('{} downloaded from Thread {}'.format(file_name, thread_title))
+        elif data['status'] == 'FAIL':
+            print('{} failed to download file {} from {} thread'.format(data['username'], file_name, thread_title))
 
-def REMOVE_THREAD(data, add, threads, client_udp_socket):
+def REMOVE_THREAD(data, add, thread_store, blob_store, client_udp_socket):
     '''
     Remove a thread.
     '''
@@ -555,28 +2231,36 @@ def REMOVE_THREAD(data, add, threads, client_udp_socket):
     }
     thread_title, thread_creator = data['thread_title'], data['username']
 
-    # if the thread title is not in the threads list
-    if thread_title not in threads:
+    # if the thread title is not in the thread store
+    if not thread_store.exists(thread_title):
         response['status'] = 'NO_THREAD'
         print('Thread {} does not exist'.format(thread_title))
         udp_send_response(client_udp_socket, response, add)
     else:
-        with open(thread_title, 'r') as f:
-            lines = f.readlines()
-    
+        try:
+            creator = thread_store.creator(thread_title)
+            if thread_creator == creator:
+                thread_store.remove(thread_title, then=lambda result: search_index.remove_thread(thread_title))
+        except KeyError: # removed by another RMV since the check
+            creator = None
+        # if the thread was removed meanwhile
+        if creator is None:
+            response['status'] = 'NO_THREAD'
+            print('Thread {} does not exist'.format(thread_title))
         # if the user is not the creator of the thread
-        if thread_creator != lines[0].split(' ')[0].rstrip():
+        elif thread_creator != creator:
             response['status'] = 'FAIL'
             print('Thread {} cannot be removed'.format(thread_title))     
         else:
-            # if the user is the creator of the thread, then remove the thread
+            # if the user is the creator of the thread, the thread is removed, then its files, matches and subscriptions
             response['status'] = 'OK'
             print('Thread {} removed'.format(thread_title))
-            os.remove(thread_title)
-            threads.remove(thread_title)
+            blob_store.remove_thread(thread_title) # the blobs no other thread refers to are deleted
+            notifier.publish(thread_title, ['RMV', thread_title, None, thread_creator, None], data.get('session_id'))
+            notifier.drop_thread(thread_title)
 
         udp_send_response(client_udp_socket, response, add)
-    return threads
+    return thread_store
 
 def EXIT_USER(data, add, online_users, client_udp_socket):
     '''
@@ -587,19 +2271,101 @@ def EXIT_USER(data, add, online_users, client_udp_socket):
     }
     user_name = data['username']
 
-    # if the user is not in the online users list
-    if user_name not in online_users:
+    # if the user is not in the online users
+    if not user_online(user_name):
         response['status'] = 'FAIL'
         print('User {} is not online'.format(user_name))
     else:
         response['status'] = 'OK'
         print('{} exited'.format(user_name))
-        online_users.remove(user_name)
+        with sessions_lock:
+            close_session(data.get('session_id'))
 
     print("Waiting for clients")
     udp_send_response(client_udp_socket, response, add)
     return online_users
 
+def SUBSCRIBE_THREAD(data, add, thread_store, client_udp_socket):
+    '''
+    Push the new, edited and deleted messages of the thread to the event port of the client.
+    '''
+    response = {
+        'status': 'OK',
+    }
+    thread_title, event_port = data['thread_title'], data.get('event_port')
+
+    # if the thread title is not in the thread store
+    if not thread_store.exists(thread_title):
+        response['status'] = 'NO_THREAD'
+        print('Thread {} does not exist'.format(thread_title))
+    # if the client has no port to receive the events on
+    elif not isinstance(event_port, int) or not 0 < event_port < 65536:
+        response['status'] = 'FAIL'
+        print('Subscription to Thread {} without an event port'.format(thread_title))
+    else:
+        # the events go to the same host as the replies
+        response['status'] = 'OK'
+        notifier.subscribe(thread_title, data['session_id'], (add[0], event_port), add)
+        print('{} subscribed to Thread {}'.format(data['username'], thread_title))
+
+    udp_send_response(client_udp_socket, response, add)
+
+def UNSUBSCRIBE_THREAD(data, add, client_udp_socket):
+    '''
+    Stop pushing the changes of the thread to the client.
+    '''
+    response = {
+        'status': 'OK',
+    }
+    thread_title = data['thread_title']
+
+    # if the client is not subscribed to the thread
+    if not notifier.unsubscribe(thread_title, data['session_id']):
+        response['status'] = 'FAIL'
+        print('{} is not subscribed to Thread {}'.format(data['username'], thread_title))
+    else:
+        response['status'] = 'OK'
+        print('{} unsubscribed from Thread {}'.format(data['username'], thread_title))
+
+    udp_send_response(client_udp_socket, response, add)
+
+def SEARCH_MESSAGES(data, add, thread_store, client_udp_socket):
+    '''
+    Find the messages matching the query, in the thread and by the author if they are given.
+    '''
+    response = {
+        'status': 'OK',
+    }
+    query, thread_title, author = data.get('query'), data.get('thread_title'), data.get('author')
+    offset, limit = data.get('offset', 0), data.get('limit', SEARCH_PAGE)
+
+    # if the query, its filters or its page are not of their type or out of range
+    if not isinstance(query, str) or not all([value is None or isinstance(value, str) for value in [thread_title, author]]) or \
+            not valid_count(offset, 0) or not valid_count(limit, 1, MAX_SEARCH_PAGE):
+        response['status'] = 'FAIL'
+        print('Invalid search from {}'.format(data['username']))
+    # if the search is limited to a thread that does not exist
+    elif thread_title is not None and not thread_store.exists(thread_title):
+        response['status'] = 'NO_THREAD'
+        print('Thread {} does not exist'.format(thread_title))
+    else:
+        # the index gives the ranked ids of the page, the messages are read from their threads
+        matches, total, truncated = search_index.search(query, thread_title, author, offset, limit)
+        results = []
+        for title, msg_id in matches:
+            record = thread_store.message(title, msg_id)
+            if record is not None: # deleted since the search
+                results.append([title, record])
+        response['status'] = 'OK' if total > 0 else 'NO_MSG'
+        response['results'] = results
+        response['total'] = total
+        response['truncated'] = truncated # more messages matched than the total ranked
+        response['next_cursor'] = offset + len(matches)
+        response['more'] = offset + len(matches) < total
+        print('{} matches of {}'.format(total, query))
+
+    udp_send_response(client_udp_socket, response, add)
+
 ########################################################################################################################
 #                                                                                                                      #
 #                                                  MAIN FUNCTION                                                       #                                                                                                                                                           
@@ -607,5 +2373,26 @@ def EXIT_USER(data, add, online_users, client_udp_socket):
 ########################################################################################################################
 if __name__ == '__main__':
     PORT = port_checker()
+    option_parser()
     process_credentials()
-    server_startup(PORT)
\ No newline at end of file
+    if options['snapshot-interval'] > 0 and options['storage'] == 'files':
+        journal = Journal(STATE_ROOT)
+    thread_store = storage_startup()
+    blob_store = BlobStore(journal=journal, storage=thread_store)
+    reassembler = Reassembler(REASSEMBLY_LIMIT, REASSEMBLY_TIMEOUT)
+    reply_cache = ReplyCache(REPLY_LIMIT)
+    notifier = Notifier(PUSH_INTERVAL)
+    response_cache = ResponseCache(options['response-cache'])
+    search_index = SearchIndex(journal=journal)
+    if journal is not None:
+        restore_state()
+        journal.start(capture_state, options['snapshot-interval'])
+    else:
+        rebuild_search()
+    data_listener_startup(PORT)
+    if options['engine'] == 'asyncio':
+        asyncio.run(asyncio_server_startup(PORT))
+    elif options['engine'] == 'pool':
+        pool_server_startup(PORT)
+    else:
+        server_startup(PORT)
\ No newline at end of file
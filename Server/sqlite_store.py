@@ -0,0 +1,451 @@
+'''
+SQLite backend of the storage interface.
+
+All the threads are kept in one database in WAL mode, so the readers see the last committed
+state without blocking the writer and the writer commits without blocking the readers:
+
+    threads(id, title, creator, next_id, next_seq, version, rewritten)
+    records(thread, seq, msg_id, username, line), keyed by (thread, seq) and indexed by (thread, msg_id)
+    meta(name, value), the version of the list of threads and the last version given out
+    files(title, file_name, hash, metadata), the blob every uploaded file refers to
+
+The records of a thread are its live messages and uploads in the order of their sequence ids.
+Editing a message updates its line in place and deleting a message deletes its row, so a
+message is found through the index instead of a scan of the thread. The files of a thread
+are deleted in the transaction that removes it.
+
+Writes go through one connection. The first write waiting commits the writes waiting at the
+same time in one transaction, so a burst of posts shares one commit and no write waits for
+a thread of its own to be scheduled. Reads borrow a connection from a pool. Every statement is a constant, so the statement cache of a
+connection prepares it once and reuses it for every later request.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import json
+import sqlite3
+import threading
+import queue
+from storage import Storage, clean
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+BATCH_SIZE = 256 # writes committed in one transaction at most
+STATEMENT_CACHE = 64 # prepared statements kept by every connection
+BUSY_TIMEOUT = 10 # seconds a connection waits for a lock, e.g. while the log is checkpointed
+SCAN_SIZE = 10000 # rows fetched at once by a scan of all the messages
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS threads (id INTEGER PRIMARY KEY, title TEXT NOT NULL UNIQUE, creator TEXT NOT NULL, '
+    'next_id INTEGER NOT NULL, next_seq INTEGER NOT NULL, version INTEGER NOT NULL, rewritten INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS records (thread INTEGER NOT NULL, seq INTEGER NOT NULL, msg_id INTEGER, '
+    'username TEXT NOT NULL, line TEXT NOT NULL, PRIMARY KEY (thread, seq)) WITHOUT ROWID',
+    'CREATE UNIQUE INDEX IF NOT EXISTS records_message ON records (thread, msg_id)', # unique, so the planner prefers it to the key
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS files (title TEXT NOT NULL, file_name TEXT NOT NULL, hash TEXT NOT NULL, '
+    'metadata TEXT NOT NULL, PRIMARY KEY (title, file_name)) WITHOUT ROWID',
+    "INSERT OR IGNORE INTO meta VALUES ('listing', 0), ('version', 0)",
+]
+SELECT_THREAD = 'SELECT id, next_id, next_seq FROM threads WHERE title = ?'
+SELECT_VERSIONS = 'SELECT id, version, rewritten FROM threads WHERE title = ?'
+SELECT_VERSION = 'SELECT version FROM threads WHERE title = ?'
+SELECT_CREATOR = 'SELECT creator FROM threads WHERE title = ?'
+SELECT_TITLES = 'SELECT title FROM threads ORDER BY id'
+SELECT_META = 'SELECT value FROM meta WHERE name = ?'
+SELECT_AUTHOR = 'SELECT username FROM threads LEFT JOIN records ON thread = id AND msg_id = ? WHERE title = ?' # no row without the thread
+SELECT_MESSAGE = 'SELECT line FROM records WHERE thread = (SELECT id FROM threads WHERE title = ?) AND msg_id = ?'
+SELECT_PAGE = 'SELECT seq, line FROM records WHERE thread = ? AND seq > ? ORDER BY seq LIMIT ?'
+SELECT_FILES = 'SELECT title, file_name, hash, metadata FROM files'
+SELECT_MESSAGES = 'SELECT title, msg_id, username, line FROM records JOIN threads ON thread = id WHERE msg_id IS NOT NULL'
+SELECT_LIVE = 'SELECT EXISTS (SELECT 1 FROM records WHERE thread = ?)'
+INSERT_THREAD = 'INSERT INTO threads (title, creator, next_id, next_seq, version, rewritten) VALUES (?, ?, 1, 1, ?, ?)'
+INSERT_RECORD = 'INSERT INTO records VALUES (?, ?, ?, ?, ?)'
+UPDATE_NEXT = 'UPDATE threads SET next_id = ?, next_seq = ?, version = ? WHERE id = ?'
+UPDATE_REWRITTEN = 'UPDATE threads SET version = ?, rewritten = ? WHERE id = ?'
+UPDATE_LINE = 'UPDATE records SET line = ? WHERE thread = ? AND msg_id = ?'
+UPDATE_META = 'UPDATE meta SET value = ? WHERE name = ?'
+DELETE_MESSAGE = 'DELETE FROM records WHERE thread = ? AND msg_id = ?'
+DELETE_RECORDS = 'DELETE FROM records WHERE thread = ?'
+DELETE_THREAD = 'DELETE FROM threads WHERE id = ?'
+INSERT_FILE = 'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)'
+DELETE_FILES = 'DELETE FROM files WHERE title = ?'
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                     SQLITE STORE                                                     #
+#                                                                                                                      #
+########################################################################################################################
+class Write:
+    '''
+    A write waiting for its commit, and its outcome.
+    '''
+    def __init__(self, function, args, then):
+        self.function = function
+        self.args = args
+        self.then = then # called with the result once committed, before the next commit
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.done = threading.Event() # set once the write is committed, or when it leads the next commit
+
+class SqliteStore(Storage):
+    '''
+    All the threads of the forum, in a SQLite database.
+    '''
+    def __init__(self, path='forum.db', reset=False):
+        self.path = path
+        self.readers = queue.Queue() # idle read connections
+        self.pending = [] # writes waiting for their commit, in the order they were submitted
+        self.committing = False # a write leads the commit of the pending writes
+        self.lock = threading.Lock()
+        self.connection = self.connect() # of the leading write only
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+        # the threads are kept across restarts unless a reset is asked for, the versions go on either way
+        if reset:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM records')
+            self.connection.execute('DELETE FROM threads')
+            self.connection.execute('DELETE FROM files')
+            self.connection.execute('COMMIT')
+        self.last_version = self.connection.execute(SELECT_META, ('version',)).fetchone()[0]
+
+    def connect(self):
+        '''
+        A connection to the database in WAL mode, transactions are begun explicitly.
+        '''
+        connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                     check_same_thread=False, cached_statements=STATEMENT_CACHE)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL') # a commit reaches the log, the checkpoints are synced
+        return connection
+
+    def fetch(self, statement, parameters):
+        '''
+        The first row of a read on a connection of the pool, None if there is none.
+        '''
+        try:
+            connection = self.readers.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+        try:
+            # fetchall steps the statement to its end, so the connection keeps no snapshot while idle
+            rows = connection.execute(statement, parameters).fetchall()
+            return rows[0] if rows else None
+        finally:
+            self.readers.put(connection)
+
+    def query(self, function, *args):
+        '''
+        Run the reads of function on a connection of the pool, in one transaction so they see one state.
+        '''
+        try:
+            connection = self.readers.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+        try:
+            connection.execute('BEGIN')
+            try:
+                return function(connection, *args)
+            finally:
+                connection.execute('COMMIT')
+        finally:
+            self.readers.put(connection)
+
+    def submit(self, function, *args, then=None):
+        '''
+        Run function in a transaction of the writer connection and wait until it is committed.
+        The first write waiting leads: it commits every write waiting with it in one transaction
+        and hands the lead to a write that arrived meanwhile. then is called with the result of a
+        committed write by the leader, so the writes reach it in the order they were committed.
+        '''
+        write = Write(function, args, then)
+        with self.lock:
+            self.pending.append(write)
+            lead = not self.committing
+            self.committing = True
+        if not lead:
+            write.done.wait() # committed by the leader, or made the leader
+        if not write.finished:
+            self.commit()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def commit(self):
+        '''
+        Commit the waiting writes in one transaction. A write that fails, e.g. of a missing thread or
+        message, is rolled back to its savepoint and fails on its own, the transaction always ends.
+        '''
+        with self.lock:
+            batch, self.pending = self.pending[:BATCH_SIZE], self.pending[BATCH_SIZE:]
+
+        error = None
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+            for write in batch:
+                self.connection.execute('SAVEPOINT write')
+                try:
+                    write.result = write.function(*write.args)
+                except Exception as e: # anything the write changed before it failed is undone
+                    write.error = e
+                    self.connection.execute('ROLLBACK TO write')
+                self.connection.execute('RELEASE write')
+            self.connection.execute(UPDATE_META, (self.last_version, 'version'))
+        except Exception as e:
+            error = e
+        finally:
+            try:
+                if self.connection.in_transaction:
+                    self.connection.execute('COMMIT' if error is None else 'ROLLBACK')
+            except sqlite3.Error as e:
+                error = e
+                if self.connection.in_transaction:
+                    self.connection.execute('ROLLBACK')
+            if error is not None:
+                print('Commit of {} writes failed: {}'.format(len(batch), error))
+                for write in batch:
+                    write.result, write.error = None, error
+            for write in batch:
+                if write.error is None and write.then is not None:
+                    try:
+                        write.then(write.result)
+                    except Exception as e: # the write is committed whatever follows it
+                        print('Write after the commit failed: {}'.format(e))
+
+            with self.lock:
+                if self.pending:
+                    self.pending[0].done.set() # the next leader
+                else:
+                    self.committing = False
+            for write in batch:
+                write.finished = True
+                write.done.set()
+
+    def next_version(self):
+        '''
+        A new version, run by the leading write.
+        '''
+        self.last_version += 1
+        return self.last_version
+
+    def thread(self, title):
+        '''
+        The id, next message id and next sequence id of the thread, run by the leading write.
+        '''
+        row = self.connection.execute(SELECT_THREAD, (title,)).fetchone()
+        if row is None:
+            raise KeyError(title)
+        return row
+
+    def exists(self, title):
+        '''
+        Check if the thread exists.
+        '''
+        return self.fetch(SELECT_VERSION, (title,)) is not None
+
+    def titles(self):
+        '''
+        The titles of all the threads.
+        '''
+        return self.query(lambda connection: [title for title, in connection.execute(SELECT_TITLES)])
+
+    def version(self, title=None):
+        '''
+        The version of the thread, or of the list of threads if no title is given.
+        None if the thread does not exist.
+        '''
+        row = self.fetch(SELECT_META, ('listing',)) if title is None else self.fetch(SELECT_VERSION, (title,))
+        return row[0] if row is not None else None
+
+    def creator(self, title):
+        '''
+        The creator of the thread.
+        '''
+        row = self.fetch(SELECT_CREATOR, (title,))
+        if row is None:
+            raise KeyError(title)
+        return row[0]
+
+    def create(self, title, creator):
+        '''
+        Create a new thread, False if the thread already exists.
+        '''
+        return self.submit(self.insert_thread, title, creator)
+
+    def insert_thread(self, title, creator):
+        '''
+        The write of create, run by the leading write.
+        '''
+        if self.connection.execute(SELECT_THREAD, (title,)).fetchone() is not None:
+            return False
+        version = self.next_version()
+        self.connection.execute(INSERT_THREAD, (title, creator, version, version))
+        self.connection.execute(UPDATE_META, (self.next_version(), 'listing'))
+        return True
+
+    def remove(self, title, then=None):
+        '''
+        Remove the thread and its records.
+        '''
+        self.submit(self.delete_thread, title, then=then)
+
+    def delete_thread(self, title):
+        '''
+        The write of remove, run by the leading write.
+        '''
+        thread = self.thread(title)[0]
+        self.connection.execute(DELETE_RECORDS, (thread,))
+        self.connection.execute(DELETE_THREAD, (thread,))
+        self.connection.execute(DELETE_FILES, (title,))
+        self.connection.execute(UPDATE_META, (self.next_version(), 'listing'))
+
+    def files(self):
+        '''
+        The files of the threads as (thread title, file name, hash of the blob, metadata of the blob).
+        '''
+        return self.query(lambda connection: [(title, file_name, content_hash, json.loads(metadata))
+                                              for title, file_name, content_hash, metadata in connection.execute(SELECT_FILES)])
+
+    def keep_file(self, title, file_name, content_hash, metadata):
+        '''
+        Keep the blob the file of the thread refers to, committed before the blob store counts the reference.
+        '''
+        self.submit(self.connection.execute, INSERT_FILE, (title, file_name, content_hash, json.dumps(metadata)))
+
+    def messages(self):
+        '''
+        An iterator over the messages of all the threads as (thread title, message id, username, message).
+        '''
+        return self.scan()
+
+    def scan(self):
+        '''
+        The messages of messages, read in one transaction of a connection of its own, a chunk at a time.
+        '''
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN')
+            cursor = connection.execute(SELECT_MESSAGES)
+            for rows in iter(lambda: cursor.fetchmany(SCAN_SIZE), []):
+                for title, msg_id, username, line in rows:
+                    # the record is '{message id} {username}: {message}' and a newline
+                    yield title, msg_id, username, line[len('{} {}: '.format(msg_id, username)):-1]
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def post(self, title, username, message, then=None):
+        '''
+        Append a message to the thread and return its id.
+        '''
+        return self.submit(self.insert_record, title, username, message, None, then=then)
+
+    def upload(self, title, username, file_name):
+        '''
+        Record that the user uploaded the file to the thread.
+        '''
+        self.submit(self.insert_record, title, username, None, file_name)
+
+    def insert_record(self, title, username, message, file_name):
+        '''
+        The write of post, or of upload if a file name is given, run by the leading write.
+        '''
+        thread, next_id, next_seq = self.thread(title)
+        if file_name is not None:
+            self.connection.execute(INSERT_RECORD, (thread, next_seq, None, username, '{} uploaded {}\n'.format(username, file_name)))
+            self.connection.execute(UPDATE_NEXT, (next_id, next_seq + 1, self.next_version(), thread))
+            return None
+        self.connection.execute(INSERT_RECORD, (thread, next_seq, next_id, username, '{} {}: {}\n'.format(next_id, username, clean(message))))
+        self.connection.execute(UPDATE_NEXT, (next_id + 1, next_seq + 1, self.next_version(), thread))
+        return next_id
+
+    def author(self, title, msg_id):
+        '''
+        The author of the message, None if the message does not exist.
+        '''
+        row = self.fetch(SELECT_AUTHOR, (msg_id, title))
+        if row is None:
+            raise KeyError(title)
+        return row[0]
+
+    def message(self, title, msg_id):
+        '''
+        The record of the message, None if the thread or the message does not exist.
+        '''
+        row = self.fetch(SELECT_MESSAGE, (title, msg_id))
+        return row[0] if row is not None else None
+
+    def read(self, title, since_id=0, version=0, limit=None):
+        '''
+        Read the thread from the record after since_id, at most limit records if limit is given.
+        '''
+        return self.query(self.read_page, title, since_id, version, limit)
+
+    def read_page(self, connection, title, since_id, version, limit):
+        '''
+        The reads of read, in one transaction of the connection.
+        '''
+        row = connection.execute(SELECT_VERSIONS, (title,)).fetchone()
+        if row is None:
+            raise KeyError(title)
+        thread, current, rewritten = row
+
+        # a copy older than the last edit or delete cannot be patched, read from the start
+        reset = since_id > 0 and version < rewritten
+        if reset:
+            since_id = 0
+        # one more row than the page tells if more records follow, a negative limit is none
+        rows = connection.execute(SELECT_PAGE, (thread, since_id, -1 if limit is None else limit + 1)).fetchall()
+        more = limit is not None and len(rows) > limit
+        if more:
+            rows = rows[:limit]
+
+        return {
+            'records': [line for seq, line in rows],
+            'cursor': rows[-1][0] if rows else since_id,
+            'version': current,
+            'more': more,
+            'reset': reset,
+            'empty': not rows and not connection.execute(SELECT_LIVE, (thread,)).fetchone()[0],
+        }
+
+    def edit(self, title, msg_id, message, then=None):
+        '''
+        Replace the content of the message, it keeps its place in the thread.
+        '''
+        self.submit(self.update_message, title, msg_id, message, then=then)
+
+    def update_message(self, title, msg_id, message):
+        '''
+        The write of edit, run by the leading write.
+        '''
+        thread = self.thread(title)[0]
+        row = self.connection.execute(SELECT_AUTHOR, (msg_id, title)).fetchone()
+        if row[0] is None:
+            raise KeyError(msg_id)
+        self.connection.execute(UPDATE_LINE, ('{} {}: {}\n'.format(msg_id, row[0], clean(message)), thread, msg_id))
+        version = self.next_version()
+        self.connection.execute(UPDATE_REWRITTEN, (version, version, thread))
+
+    def delete(self, title, msg_id, then=None):
+        '''
+        Delete the message.
+        '''
+        self.submit(self.delete_message, title, msg_id, then=then)
+
+    def delete_message(self, title, msg_id):
+        '''
+        The write of delete, run by the leading write.
+        '''
+        thread = self.thread(title)[0]
+        if self.connection.execute(DELETE_MESSAGE, (thread, msg_id)).rowcount == 0:
+            raise KeyError(msg_id)
+        version = self.next_version()
+        self.connection.execute(UPDATE_REWRITTEN, (version, version, thread))
@@ -0,0 +1,177 @@
+'''
+Storage interface of the forum server.
+
+The command handlers keep the threads and their messages through the methods of Storage
+only, so the backend is chosen at startup with --storage:
+
+    files   thread_store.ThreadStore, an append-only log per thread (the default)
+    sqlite  sqlite_store.SqliteStore, one SQLite database in WAL mode
+
+Every thread has a version that changes with every write to it, and the list of threads
+has one that changes when a thread is created or removed, the versions of a backend are
+never reused. Every record of a thread has a sequence id, so a thread is read in pages.
+A record is one of the lines
+
+    {message id} {username}: {message}
+    {username} uploaded {file name}
+
+and the methods taking the title of a thread raise KeyError if the thread does not exist.
+remove, post, edit and delete take a function then, called with the result of the write once
+it is applied and before the next write to the thread, so what follows the writes, e.g. the
+search index, sees them in the order the backend applied them.
+
+A backend keeping its state in memory saves it in the snapshots of the journal and replays
+its journaled writes on a restart, see journal.py. A backend that is durable on its own
+keeps the defaults, which save and replay nothing. Such a backend keeps the files of the
+threads too, they go with their thread, and hands its messages to the search index built
+again at startup, so it needs no journal at all.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+STORAGES = ['files', 'sqlite']
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                       STORAGE                                                        #
+#                                                                                                                      #
+########################################################################################################################
+class Storage:
+    '''
+    The threads of the forum, implemented by a backend.
+    '''
+    def exists(self, title):
+        '''
+        Check if the thread exists.
+        '''
+        raise NotImplementedError
+
+    def titles(self):
+        '''
+        The titles of all the threads, in the order they were created.
+        '''
+        raise NotImplementedError
+
+    def version(self, title=None):
+        '''
+        The version of the thread, or of the list of threads if no title is given.
+        None if the thread does not exist.
+        '''
+        raise NotImplementedError
+
+    def creator(self, title):
+        '''
+        The creator of the thread.
+        '''
+        raise NotImplementedError
+
+    def create(self, title, creator):
+        '''
+        Create a new thread, False if the thread already exists.
+        '''
+        raise NotImplementedError
+
+    def remove(self, title, then=None):
+        '''
+        Remove the thread and its records.
+        '''
+        raise NotImplementedError
+
+    def post(self, title, username, message, then=None):
+        '''
+        Append a message to the thread and return its id, the ids of a thread are never reused.
+        '''
+        raise NotImplementedError
+
+    def upload(self, title, username, file_name):
+        '''
+        Record that the user uploaded the file to the thread.
+        '''
+        raise NotImplementedError
+
+    def author(self, title, msg_id):
+        '''
+        The author of the message, None if the message does not exist.
+        '''
+        raise NotImplementedError
+
+    def message(self, title, msg_id):
+        '''
+        The record of the message, None if the thread or the message does not exist.
+        '''
+        raise NotImplementedError
+
+    def read(self, title, since_id=0, version=0, limit=None):
+        '''
+        Read the thread from the record after since_id, at most limit records if limit is given.
+        Returns a dictionary with the records, the cursor to continue from, the version of the
+        thread, whether more records follow, whether the copy of the reader was reset because a
+        record before the cursor changed since its version, and whether the thread is empty.
+        '''
+        raise NotImplementedError
+
+    def edit(self, title, msg_id, message, then=None):
+        '''
+        Replace the content of the message, it keeps its place in the thread.
+        '''
+        raise NotImplementedError
+
+    def delete(self, title, msg_id, then=None):
+        '''
+        Delete the message.
+        '''
+        raise NotImplementedError
+
+    def files(self):
+        '''
+        The files of the threads as (thread title, file name, hash of the blob, metadata of the blob),
+        None if the backend does not keep them.
+        '''
+        return None
+
+    def keep_file(self, title, file_name, content_hash, metadata):
+        '''
+        Keep the blob the file of the thread refers to, if the backend keeps the files.
+        '''
+
+    def messages(self):
+        '''
+        An iterator over the messages of all the threads as (thread title, message id, username, message),
+        None if the backend does not keep them across restarts.
+        '''
+        return None
+
+    def snapshot(self):
+        '''
+        The state kept in memory, for the snapshot of the journal.
+        '''
+        return None
+
+    def restore(self, state):
+        '''
+        Load the state from a snapshot.
+        '''
+
+    def replay(self, operation):
+        '''
+        Apply a journaled write, unless the state holds it already.
+        '''
+
+    def replayed(self):
+        '''
+        Complete the restart once the journal is replayed.
+        '''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def clean(message):
+    '''
+    Keep the message on one line of its record.
+    '''
+    return message.replace('\r', ' ').replace('\n', ' ')
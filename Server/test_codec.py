@@ -0,0 +1,97 @@
+'''
+Codecs of the messages between the client and the server.
+
+Usage: python3 -m unittest test_codec
+
+A message encoded with either codec, compressed or not, decodes to the same message on the
+other side, and the client and the server agree on the codes of the commands and the fields.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import sys
+import unittest
+
+import server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Client'))
+import client
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+MESSAGE = {
+    'command': 'MSG',
+    'request_id': 7,
+    'session_id': 1 << 40,
+    'thread_title': 'thread',
+    'message': 'café ☃',
+    'since_id': -1,
+    'ordered': True,
+    'retry_after': 0.25,
+    'missing': [1, [2, 3], None],
+    'metadata': {'size': 4, 'digests': ['ab', 'cd']}, # not in FIELD_NAMES, carries its own name
+}
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                        TESTS                                                         #
+#                                                                                                                      #
+########################################################################################################################
+class CodecTest(unittest.TestCase):
+    '''
+    Round trips of the messages through the codecs of both sides.
+    '''
+    def test_json_round_trip(self):
+        self.assertEqual(server.decode_message(server.encode_message(MESSAGE, 'json')), MESSAGE)
+
+    def test_binary_round_trip(self):
+        raw = server.encode_message(MESSAGE, 'binary')
+        self.assertEqual(raw[0], server.BINARY_MAGIC)
+        self.assertEqual(server.decode_message(raw), MESSAGE)
+
+    def test_binary_without_header_fields(self):
+        message = server.decode_message(server.encode_message({'status': 'OK'}, 'binary'))
+        self.assertEqual(message, {'status': 'OK', 'request_id': 0})
+
+    def test_binary_rejects_unknown_types(self):
+        with self.assertRaises(TypeError):
+            server.encode_message({'status': {1, 2}}, 'binary')
+
+    def test_client_decodes_server(self):
+        for codec in server.CODECS:
+            self.assertEqual(client.decode_message(server.encode_message(MESSAGE, codec)), MESSAGE)
+
+    def test_server_decodes_client(self):
+        for codec in server.CODECS:
+            self.assertEqual(server.decode_message(client.encode_message(MESSAGE, codec)), MESSAGE)
+
+    def test_codes_agree(self):
+        self.assertEqual(client.FIELD_NAMES, server.FIELD_NAMES)
+        self.assertEqual(client.COMMAND_NAMES, server.COMMAND_NAMES)
+
+    def test_compressed_round_trip(self):
+        payload = server.encode_message(dict(MESSAGE, message='word ' * 1000), 'binary')
+        for compression in server.COMPRESSIONS:
+            raw = server.compress_message(payload, compression, 7)
+            self.assertLess(len(raw), len(payload))
+            self.assertEqual(server.decompress_message(raw, server.REASSEMBLY_LIMIT), (payload, 7))
+
+    def test_small_message_is_not_compressed(self):
+        payload = server.encode_message({'status': 'OK'}, 'json')
+        self.assertEqual(server.compress_message(payload, 'zlib'), payload)
+        self.assertEqual(server.decompress_message(payload, server.REASSEMBLY_LIMIT), (payload, 0))
+
+    def test_decompression_limit(self):
+        payload = server.encode_message({'message': 'word ' * 1000}, 'json')
+        raw = server.compress_message(payload, 'zlib')
+        self.assertEqual(server.decompress_message(raw, len(payload) - 1), (None, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+'''
+Restart of the server with the SQLite backend.
+
+Usage: python3 -m unittest test_restart
+
+The database is durable on its own and needs no journal: a restart keeps its threads and
+the files they refer to, indexes its messages again, and only --reset-db deletes them.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import hashlib
+import tempfile
+import unittest
+
+import server
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                        TESTS                                                         #
+#                                                                                                                      #
+########################################################################################################################
+class SqliteRestartTest(unittest.TestCase):
+    '''
+    Restarts of the SQLite backend, which keeps no state directory.
+    '''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.root = tempfile.TemporaryDirectory()
+        os.chdir(self.root.name)
+        self.options = dict(server.options)
+        server.options.update({'storage': 'sqlite', 'reset-db': False})
+        server.journal = None
+
+    def tearDown(self):
+        server.options.clear()
+        server.options.update(self.options)
+        server.journal = None
+        os.chdir(self.cwd)
+        self.root.cleanup()
+
+    def populate(self):
+        thread_store = server.storage_startup()
+        thread_store.create('t1', 'hans')
+        thread_store.post('t1', 'hans', 'a kept message')
+
+    def test_restart_without_journal_keeps_rows(self):
+        self.populate()
+        thread_store = server.storage_startup()
+        self.assertEqual(thread_store.titles(), ['t1'])
+        self.assertEqual(thread_store.read('t1')['records'], ['1 hans: a kept message\n'])
+
+    def upload(self, blob_store, title, content):
+        content_hash = hashlib.sha256(content).hexdigest()
+        partial = blob_store.partial_path(title, 'notes.txt', 1)
+        with open(partial, 'wb') as f:
+            f.write(content)
+        blob_store.store(title, 'notes.txt', partial, content_hash, {'size': len(content)})
+        return content_hash
+
+    def test_restart_keeps_files(self):
+        self.populate()
+        content_hash = self.upload(server.BlobStore(storage=server.storage_startup()), 't1', b'kept')
+        blob_store = server.BlobStore(storage=server.storage_startup())
+        self.assertEqual(blob_store.lookup('t1', 'notes.txt'), (content_hash, {'size': 4}))
+        self.assertTrue(os.path.exists(blob_store.path(content_hash)))
+
+    def test_restart_deletes_files_of_removed_threads(self):
+        self.populate()
+        thread_store = server.storage_startup()
+        content_hash = self.upload(server.BlobStore(storage=thread_store), 't1', b'gone')
+        thread_store.remove('t1')
+        blob_store = server.BlobStore(storage=server.storage_startup())
+        self.assertEqual(blob_store.lookup('t1', 'notes.txt'), (None, None))
+        self.assertFalse(os.path.exists(blob_store.path(content_hash))) # no reference left, swept at startup
+
+    def test_restart_indexes_messages_again(self):
+        self.populate()
+        server.thread_store = server.storage_startup()
+        server.search_index = server.SearchIndex()
+        server.rebuild_search()
+        with server.search_index.lock: # released once the messages are indexed
+            pass
+        self.assertEqual(server.search_index.search('kept'), ([('t1', 1)], 1, False))
+
+    def test_reset_db_deletes_rows(self):
+        self.populate()
+        server.options['reset-db'] = True
+        self.assertEqual(server.storage_startup().titles(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+'''
+Search index of the forum server.
+
+Usage: python3 -m unittest test_search_index
+
+A message is found by its terms and phrases once it is posted, by its new terms once it is
+edited and no longer once it is deleted or its thread removed, and a snapshot restores the index.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import unittest
+
+from search_index import SearchIndex, RANK_LIMIT, parse_query
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                        TESTS                                                         #
+#                                                                                                                      #
+########################################################################################################################
+class SearchIndexTest(unittest.TestCase):
+    '''
+    Searches of the messages kept up to date by the commands.
+    '''
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add('t1', 1, 'hans', 'The falcon is fast')
+        self.index.add('t1', 2, 'yoda', 'A fast ship, not a falcon')
+        self.index.add('t2', 1, 'hans', 'Slow ships')
+
+    def test_terms(self):
+        self.assertEqual(self.index.search('FALCON fast')[1], 2)
+        self.assertEqual(self.index.search('ship'), ([('t1', 2)], 1, False))
+        self.assertEqual(self.index.search('falcon missing'), ([], 0, False))
+        self.assertEqual(self.index.search(''), ([], 0, False))
+
+    def test_phrase(self):
+        self.assertEqual(self.index.search('"falcon is fast"'), ([('t1', 1)], 1, False))
+        self.assertEqual(self.index.search('"fast falcon"'), ([], 0, False))
+        self.assertEqual(parse_query('e-mail "open quote'), (['e', 'mail', 'open', 'quote'], [('e', 'mail'), ('open', 'quote')]))
+
+    def test_scope(self):
+        self.assertEqual(self.index.search('falcon', username='yoda'), ([('t1', 2)], 1, False))
+        self.assertEqual(self.index.search('slow', title='t1'), ([], 0, False))
+        self.assertEqual(self.index.search('slow', title='t2', username='hans'), ([('t2', 1)], 1, False))
+
+    def test_rank(self):
+        self.index.add('t3', 1, 'hans', 'falcon falcon')
+        self.index.add('t3', 2, 'hans', 'falcon wings')
+        self.index.add('t3', 3, 'hans', 'falcon wings')
+        # the most occurrences first, then the shorter messages, the newer one on a tie
+        self.assertEqual(self.index.search('falcon')[0], [('t3', 1), ('t3', 3), ('t3', 2), ('t1', 1), ('t1', 2)])
+        self.assertEqual(self.index.search('falcon', offset=1, limit=2)[0], [('t3', 3), ('t3', 2)])
+
+    def test_edit_replaces(self):
+        self.index.add('t1', 1, 'hans', 'The eagle is fast')
+        self.assertEqual(self.index.search('falcon'), ([('t1', 2)], 1, False))
+        self.assertEqual(self.index.search('eagle'), ([('t1', 1)], 1, False))
+
+    def test_remove(self):
+        self.index.remove('t1', 2)
+        self.index.remove('t1', 9) # not indexed
+        self.assertEqual(self.index.search('falcon'), ([('t1', 1)], 1, False))
+        self.index.remove_thread('t1')
+        self.assertEqual(self.index.search('fast'), ([], 0, False))
+        self.assertEqual(self.index.search('slow'), ([('t2', 1)], 1, False))
+        self.assertNotIn('falcon', self.index.postings)
+
+    def test_rank_limit(self):
+        for msg_id in range(RANK_LIMIT + 1):
+            self.index.add('t3', msg_id, 'hans', 'common word')
+        results, total, truncated = self.index.search('common', limit=1)
+        self.assertEqual((results, total, truncated), ([('t3', RANK_LIMIT)], RANK_LIMIT, True))
+
+    def test_snapshot_restores(self):
+        restored = SearchIndex()
+        restored.restore(self.index.snapshot(), [('add', 't2', 2, 'yoda', 'a falcon again'), ('remove', 't1', 1)])
+        with restored.lock: # released once the index is loaded
+            pass
+        self.assertEqual(sorted(restored.search('falcon')[0]), [('t1', 2), ('t2', 2)])
+        self.assertEqual(restored.search('ships'), ([('t2', 1)], 1, False))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Group commit of the SQLite backend.
+
+Usage: python3 -m unittest test_sqlite_store
+
+The writes waiting together are committed in one transaction: a write that fails is rolled
+back on its own and raises to its caller, the others are committed, and the transaction
+always ends, so the next batch starts clean.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlite_store import SqliteStore, Write
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                        TESTS                                                         #
+#                                                                                                                      #
+########################################################################################################################
+class SqliteStoreTest(unittest.TestCase):
+    '''
+    Batches of writes committed by SqliteStore.commit.
+    '''
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.store = SqliteStore(os.path.join(self.root.name, 'forum.db'))
+        self.store.create('t1', 'hans')
+
+    def tearDown(self):
+        self.store.connection.close()
+        self.root.cleanup()
+
+    def commit(self, *writes):
+        '''
+        Commit the writes in one batch, as the leader of the waiting writes does.
+        '''
+        with self.store.lock:
+            self.store.pending.extend(writes)
+            self.store.committing = True
+        self.store.commit()
+        self.assertFalse(self.store.connection.in_transaction)
+        self.assertFalse(self.store.committing)
+        for write in writes:
+            self.assertTrue(write.finished)
+
+    def post(self, title, message, then=None):
+        return Write(self.store.insert_record, (title, 'hans', message, None), then)
+
+    def test_mixed_batch(self):
+        committed = []
+        def undone():
+            self.store.insert_record('t1', 'hans', 'undone', None)
+            raise ValueError('fails after a write')
+
+        writes = [
+            self.post('t1', 'first', committed.append),
+            self.post('t2', 'lost', committed.append), # no such thread
+            Write(undone, (), committed.append),
+            Write(self.store.insert_record, ('t1', 'hans', ['not', 'text'], None), committed.append),
+            self.post('t1', 'second', committed.append),
+        ]
+        self.commit(*writes)
+
+        self.assertEqual([write.error is None for write in writes], [True, False, False, False, True])
+        self.assertIsInstance(writes[1].error, KeyError)
+        self.assertIsInstance(writes[2].error, ValueError)
+        self.assertEqual(committed, [1, 2]) # the ids of the committed posts, in their order
+        self.assertEqual(self.store.read('t1')['records'], ['1 hans: first\n', '2 hans: second\n'])
+
+    def test_failed_batch_ends_its_transaction(self):
+        self.store.connection.execute('DROP TABLE meta') # the update of the version fails for the whole batch
+        writes = [self.post('t1', 'first')]
+        self.commit(*writes)
+        self.assertIsNotNone(writes[0].error)
+        self.assertEqual(self.store.read('t1')['records'], [])
+
+    def test_then_failure_keeps_the_write(self):
+        def then(msg_id):
+            raise RuntimeError('after the commit')
+        self.assertEqual(self.store.post('t1', 'hans', 'kept', then=then), 1)
+        self.assertEqual(self.store.read('t1')['records'], ['1 hans: kept\n'])
+
+    def test_submit_raises_the_error_of_its_write(self):
+        with self.assertRaises(KeyError):
+            self.store.post('t2', 'hans', 'lost')
+        self.assertEqual(self.store.post('t1', 'hans', 'kept'), 1)
+
+    def test_concurrent_writes(self):
+        ids = []
+        def post(index):
+            ids.append(self.store.post('t1', 'hans', 'message {}'.format(index)))
+        writers = [threading.Thread(target=post, args=(index,)) for index in range(32)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(sorted(ids), list(range(1, 33)))
+        self.assertEqual(len(self.store.read('t1')['records']), 32)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+'''
+Files backend of the storage interface.
+
+Usage: python3 -m unittest test_thread_store
+
+The records of a thread are appended to its log and read back in pages, an edit or a delete
+supersedes the earlier record of the message, and a compaction keeps only the live records.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import time
+import tempfile
+import unittest
+
+from thread_store import ThreadStore, MIN_DEAD_RECORDS
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                        TESTS                                                         #
+#                                                                                                                      #
+########################################################################################################################
+class ThreadStoreTest(unittest.TestCase):
+    '''
+    Writes and reads of the threads kept in logs.
+    '''
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.store = ThreadStore(self.root.name)
+        self.store.create('t1', 'hans')
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_create_twice(self):
+        self.assertFalse(self.store.create('t1', 'yoda'))
+        self.assertEqual(self.store.creator('t1'), 'hans')
+        self.assertEqual(self.store.titles(), ['t1'])
+
+    def test_post_and_read(self):
+        self.assertEqual(self.store.post('t1', 'hans', 'first'), 1)
+        self.assertEqual(self.store.post('t1', 'yoda', 'second\non one line'), 2)
+        self.store.upload('t1', 'hans', 'notes.txt')
+        page = self.store.read('t1')
+        self.assertEqual(page['records'], ['1 hans: first\n', '2 yoda: second on one line\n', 'hans uploaded notes.txt\n'])
+        self.assertEqual(self.store.author('t1', 2), 'yoda')
+        self.assertEqual(self.store.message('t1', 1), '1 hans: first\n')
+
+    def test_read_in_pages(self):
+        for index in range(5):
+            self.store.post('t1', 'hans', 'message {}'.format(index))
+        first = self.store.read('t1', limit=2)
+        self.assertEqual(len(first['records']), 2)
+        self.assertTrue(first['more'])
+        rest = self.store.read('t1', first['cursor'], first['version'])
+        self.assertEqual(rest['records'], ['3 hans: message 2\n', '4 hans: message 3\n', '5 hans: message 4\n'])
+        self.assertFalse(rest['more'])
+        self.assertFalse(rest['reset'])
+
+    def test_edit_and_delete(self):
+        self.store.post('t1', 'hans', 'first')
+        self.store.post('t1', 'hans', 'second')
+        before = self.store.read('t1')
+        self.store.edit('t1', 1, 'edited')
+        self.store.delete('t1', 2)
+        self.assertEqual(self.store.read('t1')['records'], ['1 hans: edited\n'])
+        self.assertIsNone(self.store.author('t1', 2))
+
+        # a copy older than the edit cannot be patched, it is read again from the start
+        page = self.store.read('t1', before['cursor'], before['version'])
+        self.assertTrue(page['reset'])
+        self.assertEqual(page['records'], ['1 hans: edited\n'])
+
+    def test_ids_are_not_reused(self):
+        self.store.post('t1', 'hans', 'first')
+        self.store.delete('t1', 1)
+        self.assertEqual(self.store.post('t1', 'hans', 'second'), 2)
+        self.assertEqual(self.store.read('t1')['records'], ['2 hans: second\n'])
+
+    def test_then_runs_with_the_write(self):
+        calls = []
+        msg_id = self.store.post('t1', 'hans', 'first', then=lambda result: calls.append(('post', result)))
+        self.store.edit('t1', msg_id, 'edited', then=lambda result: calls.append(('edit', result)))
+        self.store.delete('t1', msg_id, then=lambda result: calls.append(('delete', result)))
+        self.store.remove('t1', then=lambda result: calls.append(('remove', result)))
+        self.assertEqual(calls, [('post', 1), ('edit', None), ('delete', None), ('remove', None)])
+
+    def test_missing_thread(self):
+        with self.assertRaises(KeyError):
+            self.store.post('t2', 'hans', 'lost', then=self.fail)
+        self.assertIsNone(self.store.message('t2', 1))
+
+    def test_remove(self):
+        path = os.path.join(self.root.name, 't1')
+        self.store.remove('t1')
+        self.assertFalse(self.store.exists('t1'))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(self.store.create('t1', 'yoda'))
+
+    def test_compaction_keeps_live_records(self):
+        self.store.post('t1', 'hans', 'kept')
+        for index in range(MIN_DEAD_RECORDS // 2): # a delete makes its message and its tombstone dead, the last one compacts
+            self.store.post('t1', 'hans', 'dropped')
+            self.store.delete('t1', index + 2)
+        thread = self.store.threads['t1']
+        deadline = time.time() + 5
+        while thread.dead > 0 and time.time() < deadline: # compacted in the background
+            time.sleep(0.01)
+        with thread.lock:
+            self.assertEqual(thread.dead, 0)
+        self.assertEqual(self.store.read('t1')['records'], ['1 hans: kept\n'])
+        with open(os.path.join(self.root.name, 't1')) as f:
+            self.assertEqual(f.read(), 'hans\n1 hans: kept\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,539 @@
+'''
+Thread store of the forum server, the files backend of the storage interface.
+
+Every thread is an append-only log named after its title. The first line is the creator,
+the following lines are the records of the thread:
+
+    {message id} {username}: {message}
+    {username} uploaded {file name}
+    {message id} deleted
+
+Editing a message appends its new version and deleting a message appends a tombstone,
+a later record of a message id supersedes the earlier ones.
+
+The metadata of every thread (creator, next message id, message count) and the offsets
+of its live records are kept in memory, so posting, editing and deleting a message are a
+single append and a message is found without reading the thread. A background compactor
+rewrites the log of a thread once too many of its records are dead.
+
+Every record of a thread also gets a sequence id, so a thread can be read in pages from
+the last record a client has, and a version that changes with every write to the thread.
+
+With a journal, every write is journaled with the version it gave the thread, and the
+metadata is restored from the snapshot and the journal instead of reading the logs: the
+replay skips the writes older than the version of a thread in the snapshot and updates
+the metadata of the others without touching the logs, which hold them already. A record
+is written at the size of the log known to the metadata, so the bytes of a write a crash
+cut short before it was journaled are overwritten by the next one.
+'''
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                      LIBRARIES                                                       #
+#                                                                                                                      #
+########################################################################################################################
+import os
+import threading
+import queue
+import pickle
+import itertools
+from storage import Storage, clean
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                   GLOBAL VARIABLES                                                   #
+#                                                                                                                      #
+########################################################################################################################
+MIN_DEAD_RECORDS = 64 # logs with fewer dead records are not worth compacting
+UNPACKING = threading.Lock() # held while the records of a restored thread are unpacked
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                     THREAD STORE                                                     #
+#                                                                                                                      #
+########################################################################################################################
+class Thread:
+    '''
+    In-memory metadata of one thread.
+    '''
+    def __init__(self, title, path, creator):
+        self.title = title
+        self.path = path
+        self.creator = creator
+        self.next_id = 1 # message ids are monotonic and never reused
+        self.count = 0 # messages in the thread
+        self.size = 0 # bytes in the log
+        self.records = [] # [sequence id, offset, length] of every record in the order of the thread
+        self.messages = {} # message id -> [index of its record, username]
+        self.next_seq = 1 # sequence ids of the records are monotonic and never reused
+        self.live = 0 # records that are not deleted
+        self.version = 0 # changes with every write to the thread
+        self.rewritten = 0 # version of the creation, last edit or last delete, older copies of the thread are stale
+        self.lines = 0 # records in the log
+        self.dead = 0 # records in the log superseded by a later record
+        self.compacting = False
+        self.removed = False # set under the lock, so a write waiting for the lock does not outlive the thread
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        '''
+        Unpack the records and the messages of a restored thread the first time they are used,
+        so a restart does not unpack the threads nobody reads or writes.
+        '''
+        if name not in ('records', 'messages'):
+            raise AttributeError(name)
+        with UNPACKING:
+            if 'packed' in self.__dict__:
+                self.records, self.messages = pickle.loads(self.__dict__.pop('packed'))
+        return self.__dict__[name]
+
+    def pack(self):
+        '''
+        The records and the messages, packed for a snapshot, the caller holds the lock.
+        '''
+        with UNPACKING:
+            packed = self.__dict__.get('packed')
+        if packed is None:
+            packed = pickle.dumps((self.records, self.messages), protocol=pickle.HIGHEST_PROTOCOL)
+        return packed
+
+    def log(self):
+        '''
+        Open the log at its end for the next record, KeyError if the thread was removed meanwhile.
+        '''
+        if self.removed:
+            raise KeyError(self.title)
+        f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        f.seek(self.size)
+        return f
+
+    def write(self, f, line):
+        '''
+        Append the record to the log and return its [offset, length].
+        '''
+        record = line.encode('utf-8')
+        if f is not None: # None when a journaled write is replayed, the log holds the record already
+            f.write(record)
+        position = [self.size, len(record)]
+        self.size += len(record)
+        self.lines += 1
+        return position
+
+    def append(self, f, line):
+        '''
+        Append the record to the log and the end of the thread, return the index of the record.
+        '''
+        self.records.append([self.next_seq] + self.write(f, line))
+        self.next_seq += 1
+        self.live += 1
+        return len(self.records) - 1
+
+    def page(self, since_id, limit):
+        '''
+        The records after the sequence id since_id, at most limit of them if limit is given.
+        '''
+        # binary search of the first record after since_id, the records are sorted by sequence id
+        low, high = 0, len(self.records)
+        while low < high:
+            middle = (low + high) // 2
+            if self.records[middle][0] <= since_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        page = []
+        for record in itertools.islice(self.records, low, None):
+            if limit is not None and len(page) == limit:
+                return page, True
+            if record[1] is not None:
+                page.append(record)
+        return page, False
+
+class ThreadStore(Storage):
+    '''
+    All the threads of the forum, in append-only logs.
+    '''
+    def __init__(self, root='.', compact_ratio=0.5, journal=None):
+        self.root = root
+        self.compact_ratio = compact_ratio # share of dead records that triggers the compaction of a log
+        self.journal = journal # None keeps the threads of this run only
+        self.swaps = {} # title -> compacted log of a compaction the replay found journaled last
+        self.threads = {} # title -> Thread, in the order the threads were created
+        self.lock = threading.Lock()
+        self.compactions = queue.Queue() # threads waiting for the compactor
+        self.versions = itertools.count(1) # shared by all the threads, so a recreated thread never reuses a version
+        self.listing = 0 # version of the list of threads, changes when a thread is created or removed
+
+        compactor = threading.Thread(target=self.compactor)
+        compactor.daemon = True # the main thread can exit when the server is stopped
+        compactor.start()
+
+    def exists(self, title):
+        '''
+        Check if the thread exists.
+        '''
+        return title in self.threads
+
+    def titles(self):
+        '''
+        The titles of all the threads.
+        '''
+        with self.lock:
+            return list(self.threads)
+
+    def version(self, title=None):
+        '''
+        The version of the thread, or of the list of threads if no title is given.
+        None if the thread does not exist.
+        '''
+        if title is None:
+            return self.listing
+        thread = self.threads.get(title)
+        return thread.version if thread is not None else None
+
+    def creator(self, title):
+        '''
+        The creator of the thread.
+        '''
+        return self.threads[title].creator
+
+    def create(self, title, creator):
+        '''
+        Create a new thread, False if the thread already exists.
+        '''
+        with self.lock:
+            if title in self.threads:
+                return False
+
+            # the log exists before the thread is visible to other requests
+            thread = Thread(title, os.path.join(self.root, title), creator)
+            header = '{}\n'.format(creator).encode('utf-8')
+            with open(thread.path, 'wb') as f:
+                f.write(header) # write the thread creator to the thread
+            thread.size = len(header)
+            thread.version = thread.rewritten = next(self.versions)
+            self.threads[title] = thread
+            self.listing = next(self.versions)
+            self.record('create', title, creator, thread.version, self.listing)
+        return True
+
+    def remove(self, title, then=None):
+        '''
+        Remove the thread and its log, then is called before a thread of the same title can be created.
+        '''
+        with self.lock:
+            thread = self.threads[title]
+            with thread.lock:
+                thread.removed = True
+                del self.threads[title]
+                self.listing = next(self.versions)
+                self.record('remove', title, self.listing)
+                os.remove(thread.path)
+                if then is not None:
+                    then(None)
+
+    def post(self, title, username, message, then=None):
+        '''
+        Append a message to the thread and return its id, then is called with the id under the lock of the thread.
+        '''
+        thread = self.threads[title]
+        with thread.lock:
+            with thread.log() as f:
+                msg_id = self.append_message(thread, f, username, message, next(self.versions))
+            self.record('post', title, username, message, msg_id, thread.version)
+            if then is not None:
+                then(msg_id)
+        return msg_id
+
+    def append_message(self, thread, f, username, message, version):
+        '''
+        Append the message to the thread, f is None when a journaled post is replayed.
+        '''
+        msg_id = thread.next_id
+        index = thread.append(f, '{} {}: {}\n'.format(msg_id, username, clean(message)))
+        thread.messages[msg_id] = [index, username]
+        thread.next_id += 1
+        thread.count += 1
+        thread.version = version
+        return msg_id
+
+    def upload(self, title, username, file_name):
+        '''
+        Record that the user uploaded the file to the thread.
+        '''
+        thread = self.threads[title]
+        with thread.lock:
+            with thread.log() as f:
+                self.append_upload(thread, f, username, file_name, next(self.versions))
+            self.record('upload', title, username, file_name, thread.version)
+
+    def append_upload(self, thread, f, username, file_name, version):
+        '''
+        Append the record of the upload to the thread.
+        '''
+        thread.append(f, '{} uploaded {}\n'.format(username, file_name))
+        thread.version = version
+
+    def author(self, title, msg_id):
+        '''
+        The author of the message, None if the message does not exist.
+        '''
+        message = self.threads[title].messages.get(msg_id)
+        return message[1] if message is not None else None
+
+    def message(self, title, msg_id):
+        '''
+        The record of the message, None if the thread or the message does not exist.
+        '''
+        thread = self.threads.get(title)
+        if thread is None:
+            return None
+        with thread.lock:
+            message = thread.messages.get(msg_id)
+            if message is None:
+                return None
+            seq, offset, length = thread.records[message[0]]
+            with open(thread.path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length).decode('utf-8')
+
+    def read(self, title, since_id=0, version=0, limit=None):
+        '''
+        Read the thread from the record after since_id, at most limit records if limit is given.
+        Returns a dictionary with the records, the cursor to continue from, the version of the
+        thread, whether more records follow and whether the copy of the reader was reset.
+        '''
+        thread = self.threads[title]
+        with thread.lock:
+            # a copy older than the last edit or delete cannot be patched, read from the start
+            reset = since_id > 0 and version < thread.rewritten
+            if reset:
+                since_id = 0
+            records, more = thread.page(since_id, limit)
+
+            # read the span of the page at once, instead of every record on its own
+            lines = []
+            if records:
+                start = min([offset for seq, offset, length in records])
+                end = max([offset + length for seq, offset, length in records])
+                with open(thread.path, 'rb') as f:
+                    f.seek(start)
+                    span = f.read(end - start)
+                lines = [span[offset - start:offset - start + length].decode('utf-8') for seq, offset, length in records]
+
+            return {
+                'records': lines,
+                'cursor': records[-1][0] if records else since_id,
+                'version': thread.version,
+                'more': more,
+                'reset': reset,
+                'empty': thread.live == 0,
+            }
+
+    def edit(self, title, msg_id, message, then=None):
+        '''
+        Replace the content of the message by appending its new version.
+        '''
+        thread = self.threads[title]
+        with thread.lock:
+            with thread.log() as f:
+                username = self.replace_message(thread, f, msg_id, message, next(self.versions))
+            self.record('edit', title, msg_id, username, message, thread.version)
+            if then is not None:
+                then(None)
+            self.schedule(thread)
+
+    def replace_message(self, thread, f, msg_id, message, version):
+        '''
+        Append the new version of the message and return its author.
+        '''
+        index, username = thread.messages[msg_id]
+        thread.records[index][1:] = thread.write(f, '{} {}: {}\n'.format(msg_id, username, clean(message)))
+        thread.dead += 1 # the previous version
+        thread.version = thread.rewritten = version
+        return username
+
+    def delete(self, title, msg_id, then=None):
+        '''
+        Delete the message by appending a tombstone.
+        '''
+        thread = self.threads[title]
+        with thread.lock:
+            with thread.log() as f:
+                self.delete_message(thread, f, msg_id, next(self.versions))
+            self.record('delete', title, msg_id, thread.version)
+            if then is not None:
+                then(None)
+            self.schedule(thread)
+
+    def delete_message(self, thread, f, msg_id, version):
+        '''
+        Append the tombstone of the message.
+        '''
+        index, username = thread.messages.pop(msg_id)
+        thread.write(f, '{} deleted\n'.format(msg_id))
+        thread.records[index][1:] = [None, 0]
+        thread.count -= 1
+        thread.live -= 1
+        thread.dead += 2 # the message and its tombstone
+        thread.version = thread.rewritten = version
+
+    def schedule(self, thread):
+        '''
+        Hand the thread to the compactor once the share of dead records crosses the threshold.
+        '''
+        if thread.compacting or thread.dead < MIN_DEAD_RECORDS or thread.dead < self.compact_ratio * thread.lines:
+            return
+        thread.compacting = True
+        self.compactions.put(thread)
+
+    def compactor(self):
+        '''
+        Compact the logs handed over by schedule, off the request path.
+        '''
+        while True:
+            thread = self.compactions.get()
+            try:
+                with thread.lock:
+                    if self.threads.get(thread.title) is thread:
+                        self.compact(thread)
+            except OSError as e:
+                print('Compaction of {} failed: {}'.format(thread.title, e))
+            finally:
+                thread.compacting = False
+
+    def compact(self, thread):
+        '''
+        Rewrite the log with the live records in the order of the thread.
+        '''
+        with open(thread.path, 'rb') as f:
+            log = f.read(thread.size)
+
+        # write a new log next to the old one and swap them, a crash keeps the old log intact
+        path = compacted(thread)
+        with open(path, 'wb') as f:
+            f.write('{}\n'.format(thread.creator).encode('utf-8'))
+            for seq, offset, length in thread.records:
+                if offset is not None:
+                    f.write(log[offset:offset + length])
+
+        # journaled before the swap, a restart completes a swap cut short by a crash
+        self.record('compact', thread.title, thread.version)
+        os.replace(path, thread.path)
+        self.relocate(thread)
+
+    def relocate(self, thread):
+        '''
+        Move the live records to their offsets in the compacted log.
+        '''
+        records = []
+        positions = {} # old record index -> new record index
+        size = len('{}\n'.format(thread.creator).encode('utf-8'))
+        for index, (seq, offset, length) in enumerate(thread.records):
+            if offset is not None:
+                positions[index] = len(records)
+                records.append([seq, size, length])
+                size += length
+
+        thread.records = records
+        thread.size = size
+        thread.lines = len(records)
+        thread.dead = 0
+        for message in thread.messages.values():
+            message[0] = positions[message[0]]
+
+    def record(self, *operation):
+        '''
+        Journal the write.
+        '''
+        if self.journal is not None:
+            self.journal.append('threads', *operation)
+
+    def snapshot(self):
+        '''
+        The metadata of the threads, each thread as it is between two writes.
+        '''
+        with self.lock:
+            threads = list(self.threads.values())
+            listing = self.listing
+        state = []
+        for thread in threads:
+            with thread.lock:
+                state.append([thread.title, thread.creator, thread.next_id, thread.count, thread.size, thread.pack(),
+                              thread.next_seq, thread.live, thread.version, thread.rewritten, thread.lines, thread.dead])
+        return {'threads': state, 'listing': listing}
+
+    def restore(self, state):
+        '''
+        Load the metadata of the threads from a snapshot.
+        '''
+        for (title, creator, next_id, count, size, packed,
+             next_seq, live, version, rewritten, lines, dead) in state['threads']:
+            thread = Thread(title, os.path.join(self.root, title), creator)
+            thread.next_id, thread.count, thread.size = next_id, count, size
+            del thread.records, thread.messages
+            thread.packed = packed
+            thread.next_seq, thread.live, thread.version, thread.rewritten = next_seq, live, version, rewritten
+            thread.lines, thread.dead = lines, dead
+            self.threads[title] = thread
+        self.listing = state['listing']
+
+    def replay(self, operation):
+        '''
+        Apply a journaled write to the metadata, unless the thread holds it already.
+        '''
+        name, title = operation[0], operation[1]
+        thread = self.threads.get(title)
+        self.swaps.pop(title, None)
+        if name == 'create':
+            creator, version, listing = operation[2:]
+            if thread is None or thread.version < version:
+                thread = Thread(title, os.path.join(self.root, title), creator)
+                thread.size = len('{}\n'.format(creator).encode('utf-8'))
+                thread.version = thread.rewritten = version
+                self.threads[title] = thread
+            self.listing = max(self.listing, listing)
+        elif name == 'remove':
+            listing = operation[2]
+            if thread is not None and thread.version < listing:
+                del self.threads[title] # a log left behind by a crash is overwritten when the title is reused
+            self.listing = max(self.listing, listing)
+        elif name == 'compact':
+            # the version is the one of the last write before the compaction
+            if thread is not None and thread.version == operation[2] and thread.dead > 0:
+                self.relocate(thread)
+                self.swaps[title] = compacted(thread)
+        elif thread is not None and thread.version < operation[-1]:
+            if name == 'post':
+                self.append_message(thread, None, operation[2], operation[3], operation[5])
+            elif name == 'upload':
+                self.append_upload(thread, None, operation[2], operation[3], operation[4])
+            elif name == 'edit':
+                self.replace_message(thread, None, operation[2], operation[4], operation[5])
+            elif name == 'delete':
+                self.delete_message(thread, None, operation[2], operation[3])
+
+    def replayed(self):
+        '''
+        Complete the swaps of compactions cut short by a crash and continue the versions after the replay.
+        '''
+        for title, path in self.swaps.items():
+            if os.path.exists(path):
+                os.replace(path, self.threads[title].path)
+        self.swaps = {}
+        last = max([self.listing] + [thread.version for thread in self.threads.values()])
+        self.versions = itertools.count(last + 1)
+        for thread in self.threads.values():
+            self.schedule(thread)
+
+########################################################################################################################
+#                                                                                                                      #
+#                                                  HELPER FUNCTIONS                                                    #
+#                                                                                                                      #
+########################################################################################################################
+def compacted(thread):
+    '''
+    The path of the compacted log of the thread, named after its version so that a restart
+    never takes the leftover of an older compaction for it.
+    '''
+    return '{}.{}.compact'.format(thread.path, thread.version)